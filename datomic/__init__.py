@@ -1,6 +1,15 @@
 
 __all__ = [ 
   'DB',
+  'AsyncDB',
+  'BulkLoader',
+  'QueryCache',
+  'EntityCache',
+  'PeerPool',
+  'StatusError',
+  'Replica',
+  'LocalEngine',
+  'DatomIndex',
   'Schema',
   'STRING',
   'KEYWORD',
@@ -30,6 +39,33 @@ from datomic import (
   DB,
   )
 
+from asyncdb import (
+  AsyncDB,
+  )
+
+from bulk import (
+  BulkLoader,
+  )
+
+from cache import (
+  QueryCache,
+  EntityCache,
+  )
+
+from peers import (
+  PeerPool,
+  StatusError,
+  )
+
+from replica import (
+  Replica,
+  )
+
+from local import (
+  LocalEngine,
+  DatomIndex,
+  )
+
 from schema import (
   Schema,
   STRING,
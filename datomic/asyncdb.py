@@ -0,0 +1,124 @@
+# -*- coding: utf-8 -*-
+""" Non-blocking flavour of `DB`, `Query` and `TX`.
+
+Every call is handed to an `Executor` and returns a `Future`. The
+requests themselves go through the regular `DB`, so edn encoding and
+decoding is shared with the blocking client.
+"""
+from datomic import DB, Query, TX
+from executor import Executor, iter_ahead
+
+
+class AsyncDB(object):
+  """ Same arguments as `DB`, plus the number of worker threads.
+
+  >>> adb = AsyncDB("localhost", 8888, "mem", "test", workers=128)
+  >>> futures = [adb.e(eid) for eid in eids]
+  >>> [f.result() for f in futures]
+
+  The urllib3 pool is sized to the worker count so every worker can
+  hold its own keep-alive connection to the peer.
+  """
+
+  def __init__(self, host, port, store, db, schema=None, workers=64, **kwargs):
+    kwargs.setdefault('maxsize', workers)
+    self.sync     = DB(host, port, store, db, schema=schema, **kwargs)
+    self.executor = Executor(workers)
+
+  def __repr__(self):
+    return "<datomic async db %s/%s>" % (self.sync.store, self.sync.db)
+
+  def submit(self, defn, *args, **kwargs):
+    if self.sync.tracer is not None: defn = self.sync.tracer.wrap(defn)
+    return self.executor.submit(defn, *args, **kwargs)
+
+  def create(self):
+    return self.submit(self.sync.create)
+
+  def info(self):
+    return self.submit(self.sync.info)
+
+  def q(self, *args, **kwargs):
+    return self.submit(self.sync.q, *args, **kwargs)
+
+  def e(self, eid):
+    return self.submit(self.sync.e, eid)
+
+  def retract(self, e, a, v):
+    return self.submit(self.sync.retract, e, a, v)
+
+  def tx(self, *args, **kwargs):
+    """ With no arguments returns an `AsyncTX`, otherwise transacts
+    the raw edn and returns a future of the response.
+    """
+    if 0 == len(args): return AsyncTX(TX(self.sync), self)
+    return self.submit(self.sync.tx, *args, **kwargs)
+
+  def tx_schema(self, **kwargs):
+    return self.submit(self.sync.tx_schema, **kwargs)
+
+  def datoms(self, *args, **kwargs):
+    """ Lazy datom generator whose chunks are fetched on a worker,
+    `depth` chunks ahead of the caller.
+    """
+    depth = kwargs.pop('depth', 1) * kwargs.get('chunk', 100)
+    return iter_ahead(self.executor, self.sync.datoms(*args, **kwargs), depth)
+
+  def find(self, *args, **kwargs):
+    " new query builder on current db "
+    return AsyncQuery(Query(*args, db=self.sync, schema=self.sync.schema), self)
+
+
+class AsyncQuery(object):
+  """ Chainable like `Query`, but `all`, `one` and `hashone` return
+  futures.
+
+  >>> f = adb.find('?e ?n').where('?e :person/name ?n').all()
+  >>> f.result()
+  """
+
+  def __init__(self, query, adb):
+    self.query = query
+    self.adb   = adb
+
+  def __repr__(self):
+    return repr(self.query)
+
+  def __getattr__(self, attr):
+    " delegate the builder methods, keeping the chain on self "
+    defn = getattr(self.query, attr)
+    if not callable(defn): return defn
+    def chained(*args, **kwargs):
+      rs = defn(*args, **kwargs)
+      return self if rs is self.query else rs
+    return chained
+
+  def all(self):
+    return self.adb.submit(self.query.all)
+
+  def one(self):
+    return self.adb.submit(self.query.one)
+
+  def hashone(self):
+    return self.adb.submit(self.query.hashone)
+
+
+class AsyncTX(object):
+  """ Accumulates like `TX`, `execute` returns a future.
+  """
+
+  def __init__(self, tx, adb):
+    self.tx  = tx
+    self.adb = adb
+
+  def __repr__(self):
+    return repr(self.tx)
+
+  def __len__(self):
+    return len(self.tx)
+
+  def __getattr__(self, attr):
+    return getattr(self.tx, attr)
+
+  def execute(self, **kwargs):
+    return self.adb.submit(self.tx.execute, **kwargs)
@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+""" Columnar storage for chunks of datoms.
+"""
+from array import array
+
+try:
+  array('q')
+  INT64 = 'q'
+except ValueError:
+  " python 2 has no 'q', 'l' is 64 bits on LP64 platforms "
+  INT64 = 'l'
+
+
+""" Typed value columns, keyed by :db/valueType
+"""
+COLUMNS = {
+  ':db.type/long':    INT64,
+  ':db.type/ref':     INT64,
+  ':db.type/double':  'd',
+  ':db.type/float':   'd',
+}
+
+
+class DatomBlock(object):
+  """ A chunk of datoms stored by column.
+
+  `e`, `a` and `tx` are 64 bit integer arrays, `added` is a bitmap and
+  `v` is an integer or double array when the attribute's valueType (or
+  every value in the chunk) allows it, a list otherwise.
+
+  >>> for block in db.datoms('aevt', a='person/age', blocks=True):
+  ...   block.v            # array('l', [25, 22])
+  ...   block[0].e         # row views are created on access
+  ...   block.to_numpy()   # zero copy for e, a, tx and typed v
+  """
+
+  def __init__(self, datoms, vtype=None):
+    n = len(datoms)
+    self.e     = array(INT64, [d['e']  for d in datoms])
+    self.a     = array(INT64, [d['a']  for d in datoms])
+    self.tx    = array(INT64, [d['tx'] for d in datoms])
+    self.added = bytearray((n + 7) // 8)
+    for i, d in enumerate(datoms):
+      if d['added']: self.added[i >> 3] |= 1 << (i & 7)
+    vs = [d['v'] for d in datoms]
+    code = COLUMNS.get(vtype) or infer_column(vs)
+    try:
+      self.v = array(code, vs) if code else vs
+    except (TypeError, OverflowError):
+      self.v = vs
+
+  def __repr__(self):
+    return "<datomic block, %i datoms>" % len(self)
+
+  def __len__(self):
+    return len(self.e)
+
+  def __getitem__(self, i):
+    if i < 0: i += len(self)
+    if not 0 <= i < len(self): raise IndexError(i)
+    return Datom(self, i)
+
+  def __iter__(self):
+    for i in xrange(len(self)):
+      yield Datom(self, i)
+
+  def is_added(self, i):
+    return bool(self.added[i >> 3] & (1 << (i & 7)))
+
+  def to_numpy(self):
+    """ dict of numpy arrays. `e`, `a`, `tx` and a typed `v` share
+    memory with the block, `added` is unpacked to booleans and an
+    untyped `v` becomes an object array.
+    """
+    try:
+      import numpy as np
+    except ImportError:
+      raise Exception, "DatomBlock.to_numpy requires numpy"
+    n = len(self)
+    ints = lambda x: np.frombuffer(x, dtype='i%i' % x.itemsize)
+    if isinstance(self.v, array):
+      v = np.frombuffer(self.v, dtype='f8' if self.v.typecode == 'd' else 'i%i' % self.v.itemsize)
+    else:
+      v = np.empty(n, dtype=object)
+      v[:] = self.v
+    bits = np.unpackbits(np.frombuffer(bytes(self.added), dtype=np.uint8).reshape(-1, 1), axis=1)
+    return dict(
+      e     = ints(self.e),
+      a     = ints(self.a),
+      tx    = ints(self.tx),
+      v     = v,
+      added = bits[:, ::-1].reshape(-1)[:n].astype(bool),
+    )
+
+
+def infer_column(vs):
+  " array typecode able to hold every value, or None "
+  if not vs: return None
+  kinds = set(type(v) for v in vs)
+  if kinds <= set((int, long)):
+    if all(-2**63 <= v < 2**63 for v in vs): return INT64
+  elif kinds == set((float,)):
+    return 'd'
+  return None
+
+
+class Datom(object):
+  """ Read-only view of one row of a `DatomBlock`, readable as
+  attributes or like the dict `DB.datoms` yields.
+  """
+  __slots__ = ('block', 'i')
+  fields    = ('e', 'a', 'v', 'tx', 'added')
+
+  def __init__(self, block, i):
+    self.block, self.i = block, i
+
+  def __repr__(self):
+    return repr(self.asdict())
+
+  e  = property(lambda self: self.block.e[self.i])
+  a  = property(lambda self: self.block.a[self.i])
+  v  = property(lambda self: self.block.v[self.i])
+  tx = property(lambda self: self.block.tx[self.i])
+  added = property(lambda self: self.block.is_added(self.i))
+
+  def __getitem__(self, k):
+    if k not in self.fields: raise KeyError(k)
+    return getattr(self, k)
+
+  def asdict(self):
+    return dict((k, getattr(self, k)) for k in self.fields)
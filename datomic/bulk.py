@@ -0,0 +1,151 @@
+# -*- coding: utf-8 -*-
+""" Loading more datoms than fit in one transaction.
+"""
+import json
+import os
+import threading
+import time
+
+from datomic import TX, E
+
+
+class BatchTX(TX):
+  """ A `TX` that belongs to a `BulkLoader`.
+
+  Entities of earlier batches can be added to and referenced. They are
+  not tracked as this batch's tempids; the batch is only sent once the
+  batches that create them have committed and resolved their ids.
+  """
+
+  def __init__(self, loader, n):
+    TX.__init__(self, loader.db)
+    self.loader = loader
+    self.n      = n
+    self.deps   = set()
+    self.size   = 0
+
+  def __repr__(self):
+    return "<datomic batch %i, %i pending>" % (self.n, len(self))
+
+  def adopt(self, e):
+    return isinstance(e._tx, BatchTX) and e._tx.loader is self.loader
+
+  def addeav(self, e, a, v):
+    if v is None: return
+    self.size += len(a) + (len(v) if isinstance(v, basestring) else 20)
+    for x in (e, v):
+      if isinstance(x, E) and x._tx is not self and int(x) < 0:
+        self.deps.add(x._tx.n)
+    if e._tx is not self:
+      self.adds.append((e, a, v))
+    else:
+      TX.addeav(self, e, a, v)
+
+
+class BulkLoader(object):
+  """ Splits a large load into size bounded transactions, keeps up to
+  `inflight` of them running, and carries tempids across them.
+
+  >>> bl = BulkLoader(db, max_datoms=5000, inflight=4, state='load.json')
+  >>> for row in rows:
+  ...   person = bl.add("person/", {'name': row.name})
+  ...   bl.add("review/", {'user': person, 'strs': row.stars})
+  >>> bl.finish()
+  {'batches': 212, 'datoms': 1058204, 'datoms/s': 20871.3, ...}
+
+  `add` takes the same arguments as `TX.add`. Entities returned by it
+  may be used in any later `add`, even once their batch was sent; use
+  `bl.add(entity, ...)` rather than `entity.add(...)` for them.
+
+  With `state`, every committed batch and its resolved tempids are
+  saved to that json file. Re-running the same load with the same
+  settings skips the committed batches, and their entities resolve to
+  the saved ids.
+  """
+
+  def __init__(self, db, max_datoms=5000, max_bytes=None, inflight=2, state=None):
+    self.db         = db
+    self.max_datoms = max_datoms
+    self.max_bytes  = max_bytes
+    self.inflight   = inflight
+    self.state      = state
+    self.lock       = threading.Lock()
+    self.pending    = []
+    self.saved      = {}
+    self.counts     = dict(batches=0, datoms=0, skipped=0)
+    self.started    = time.time()
+    if state and os.path.exists(state):
+      with open(state) as f:
+        self.saved = json.load(f)['batches']
+    self.tx         = BatchTX(self, 0)
+
+  def __repr__(self):
+    return "<datomic bulk loader, batch %i, %i in flight>" % (self.tx.n, len(self.pending))
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, exc_type, exc, tb):
+    if exc_type is None: self.finish()
+
+  def add(self, *args, **kwargs):
+    " `TX.add` on the current batch, sending it once full "
+    entity = self.tx.add(*args, **kwargs)
+    if len(self.tx) >= self.max_datoms or \
+       (self.max_bytes and self.tx.size >= self.max_bytes):
+      self.flush()
+    return entity
+
+  def flush(self):
+    " send the current batch and start a new one "
+    tx, self.tx = self.tx, BatchTX(self, self.tx.n + 1)
+    if not len(tx): return
+    if str(tx.n) in self.saved:
+      self.restore(tx, self.saved[str(tx.n)])
+      return
+    while len(self.pending) >= self.inflight:
+      self.pending.pop(0)[1].result()
+    deps = [f for n, f in self.pending if n in tx.deps]
+    self.pending.append((tx.n, self.db.executor.submit(self.commit, tx, deps)))
+
+  def finish(self):
+    " send what is left, wait for every batch, return the stats "
+    self.flush()
+    while self.pending:
+      self.pending.pop(0)[1].result()
+    return self.stats()
+
+  def commit(self, tx, deps):
+    for f in deps: f.result()
+    tempids = tx.tmpents.items()
+    datoms  = len(tx)
+    tx.execute()
+    with self.lock:
+      self.counts['batches'] += 1
+      self.counts['datoms']  += datoms
+      self.saved[str(tx.n)] = dict((str(t), ents[0].eid) for t, ents in tempids)
+      self.save()
+    return tx.resp
+
+  def restore(self, tx, tempids):
+    " resolve a batch committed by an earlier run "
+    for t, ents in tx.tmpents.iteritems():
+      for e in ents:
+        e._eid = tempids[str(t)]
+    self.counts['skipped'] += 1
+
+  def save(self):
+    if not self.state: return
+    tmp = self.state + '.tmp'
+    with open(tmp, 'w') as f:
+      json.dump(dict(batches=self.saved), f)
+    os.rename(tmp, self.state)
+
+  def stats(self):
+    " throughput so far "
+    with self.lock:
+      rs = dict(self.counts)
+    rs['seconds']  = time.time() - self.started
+    rs['datoms/s'] = rs['datoms'] / max(rs['seconds'], 1e-6)
+    rs['inflight'] = len(self.pending)
+    return rs
@@ -0,0 +1,225 @@
+# -*- coding: utf-8 -*-
+""" Query results, kept while the database has not moved, and entities.
+"""
+import copy
+import re
+import threading
+import time
+from collections import OrderedDict
+
+
+_ws = re.compile(r'("(?:[^"\\]|\\.)*")|[\s,]+')
+
+def normalize(q):
+  " query edn with whitespace and commas collapsed, string literals kept "
+  return _ws.sub(lambda m: m.group(1) or u' ', q).strip()
+
+
+class QueryCache(object):
+  """ LRU cache of decoded query results, bounded by entry count and by
+  the size of the responses they were decoded from.
+
+  Every entry is tagged with the basis-t the database had when it was
+  fetched, and is only served while `DB.basis_t` still reports that
+  basis-t. basis-t is polled at most every `poll_ms`, so a result can
+  be up to that old. Results of as-of queries never go stale and are
+  only evicted. Every caller gets its own copy of a result, so
+  changing its rows leaves the cache alone. Entries are keyed by
+  database too, so several `DB`s can share one cache.
+
+  >>> db = DB(HOST, PORT, STORE, DBN, S, cache=QueryCache(max_bytes=2**26))
+  >>> db.q(q) ; db.q(q)
+  >>> db.cache.stats()
+  {'hits': 1, 'misses': 1, 'stale': 0, 'evictions': 0, 'entries': 1, 'bytes': 4120}
+  """
+
+  def __init__(self, maxsize=1000, max_bytes=None, poll_ms=1000):
+    self.maxsize   = maxsize
+    self.max_bytes = max_bytes
+    self.poll_ms   = poll_ms
+    self.entries   = OrderedDict()
+    self.nbytes    = 0
+    self.lock      = threading.Lock()
+    self.counts    = dict(hits=0, misses=0, stale=0, evictions=0)
+
+  def __repr__(self):
+    return "<datomic query cache, %i entries, %i bytes>" % (len(self.entries), self.nbytes)
+
+  def __len__(self):
+    return len(self.entries)
+
+  def key(self, db, q, inputs, limit, offset, history, as_of):
+    " cache key of a query of database `db`, any string naming it "
+    return (db, normalize(q), tuple(inputs or ()), limit or None, offset or None,
+            bool(history), as_of or None)
+
+  def get(self, key, basis_t):
+    """ The result stored for `key`, or None when missing or fetched at
+    another basis-t.
+    """
+    with self.lock:
+      entry = self.entries.pop(key, None)
+      if entry is None:
+        self.counts['misses'] += 1
+        return None
+      t, rs, nbytes = entry
+      if t is not None and t != basis_t:
+        self.nbytes -= nbytes
+        self.counts['stale']  += 1
+        self.counts['misses'] += 1
+        return None
+      self.entries[key] = entry
+      self.counts['hits'] += 1
+    return copy.deepcopy(rs)
+
+  def put(self, key, basis_t, rs, nbytes):
+    " store a result fetched at `basis_t`, None for as-of results "
+    if self.max_bytes and nbytes > self.max_bytes: return
+    rs = copy.deepcopy(rs)
+    with self.lock:
+      old = self.entries.pop(key, None)
+      if old is not None: self.nbytes -= old[2]
+      self.entries[key] = (basis_t, rs, nbytes)
+      self.nbytes += nbytes
+      while len(self.entries) > self.maxsize or \
+            (self.max_bytes and self.nbytes > self.max_bytes):
+        _, (_, _, n) = self.entries.popitem(last=False)
+        self.nbytes -= n
+        self.counts['evictions'] += 1
+
+  def clear(self):
+    with self.lock:
+      self.entries.clear()
+      self.nbytes = 0
+
+  def stats(self):
+    " hit, miss, stale and eviction counts, and the current size "
+    with self.lock:
+      rs = dict(self.counts)
+      rs['entries'] = len(self.entries)
+      rs['bytes']   = self.nbytes
+    return rs
+
+
+class EntityCache(object):
+  """ LRU cache of entities as `DB.e` returns them, shared by every `E`
+  of a `DB`, bounded by entry count and optionally by age.
+
+  Entries are tagged with the basis-t they were read at, that is the
+  basis-t `DB.basis_t` reported, polled at most every `poll_ms`. They
+  are dropped once older than `ttl` seconds, and when a transaction of
+  this `DB` touches the entity, or an entity nested in it as a
+  component. Writes by other clients are only seen after `ttl`, or by
+  asking for a minimum basis-t. Every caller gets its own copy of an
+  entry, so changing it leaves the cache alone. Entities are keyed by
+  their database, a string naming it, and eid, so `DB`s of several
+  databases can share one cache:
+
+  >>> db = DB(HOST, PORT, STORE, DBN, S, entity_cache=EntityCache(maxsize=50000, ttl=60))
+  >>> db.e(item) ; db.e(item)
+  >>> db.e(item, min_t=resp['db-after']['basis-t'])
+  >>> db.entity_cache.stats()
+  {'hits': 1, 'misses': 2, 'stale': 1, 'evictions': 0, 'invalidations': 0, 'entries': 1}
+  """
+
+  def __init__(self, maxsize=10000, ttl=None, poll_ms=1000):
+    self.maxsize = maxsize
+    self.ttl     = ttl
+    self.poll_ms = poll_ms
+    self.entries = OrderedDict()
+    self.parents = {}
+    self.written = OrderedDict()
+    self.lock    = threading.Lock()
+    self.counts  = dict(hits=0, misses=0, stale=0, evictions=0, invalidations=0)
+
+  def __repr__(self):
+    return "<datomic entity cache, %i entries>" % len(self.entries)
+
+  def __len__(self):
+    return len(self.entries)
+
+  def get(self, db, eid, min_t=None):
+    """ The entity stored for `eid` of `db`, or None when missing,
+    expired or read before basis-t `min_t`.
+    """
+    k = (db, eid)
+    with self.lock:
+      entry = self.entries.get(k)
+      if entry is None:
+        self.counts['misses'] += 1
+        return None
+      t, ent, at = entry
+      if (self.ttl is not None and time.time() - at > self.ttl) or \
+         (min_t is not None and t < min_t):
+        self.drop(k)
+        self.counts['stale']  += 1
+        self.counts['misses'] += 1
+        return None
+      self.entries[k] = self.entries.pop(k)
+      self.counts['hits'] += 1
+    return copy.deepcopy(ent)
+
+  def put(self, db, eid, basis_t, ent):
+    " store an entity of `db` read at `basis_t` "
+    ent, k = copy.deepcopy(ent), (db, eid)
+    with self.lock:
+      if any(self.written.get((db, x), -1) > basis_t for x in [eid] + list(nested(ent))):
+        " read before one of our own transactions changed it or a component "
+        return
+      self.drop(k)
+      self.entries[k] = (basis_t, ent, time.time())
+      for child in nested(ent):
+        self.parents.setdefault((db, child), set()).add(k)
+      while len(self.entries) > self.maxsize:
+        self.drop(next(iter(self.entries)))
+        self.counts['evictions'] += 1
+
+  def invalidate(self, db, eids, basis_t=None):
+    """ drop entities of `db` changed by a transaction, and those they
+    are nested in; reads older than `basis_t` are not stored afterwards
+    """
+    with self.lock:
+      for eid in set(eids):
+        todo = [(db, eid)]
+        while todo:
+          k = todo.pop()
+          todo += self.parents.pop(k, ())
+          if self.drop(k): self.counts['invalidations'] += 1
+        if basis_t is not None:
+          self.written.pop((db, eid), None)
+          self.written[db, eid] = basis_t
+      while len(self.written) > self.maxsize:
+        self.written.popitem(last=False)
+
+  def drop(self, k):
+    " remove the entry of a (db, eid) key, the lock held "
+    entry = self.entries.pop(k, None)
+    if entry is None: return False
+    for child in nested(entry[1]):
+      ps = self.parents.get((k[0], child))
+      if ps is None: continue
+      ps.discard(k)
+      if not ps: del self.parents[k[0], child]
+    return True
+
+  def clear(self):
+    with self.lock:
+      self.entries.clear()
+      self.parents.clear()
+      self.written.clear()
+
+  def stats(self):
+    " hit, miss, stale, eviction and invalidation counts, and the size "
+    with self.lock:
+      rs = dict(self.counts)
+      rs['entries'] = len(self.entries)
+    return rs
+
+
+def nested(ent):
+  " ids of the component entities embedded in an entity "
+  for v in ent.itervalues():
+    for x in (v if isinstance(v, (list, tuple, set, frozenset)) else (v,)):
+      if isinstance(x, dict) and len(x) > 1 and 'db/id' in x:
+        yield x['db/id']
+        for y in nested(x): yield y
@@ -0,0 +1,190 @@
+# -*- coding: utf-8 -*-
+""" Columnar export of query results.
+"""
+import calendar
+import re
+from array import array
+from datetime import datetime, timedelta, tzinfo
+from collections import namedtuple, OrderedDict
+
+from block import INT64, infer_column
+from edn import read_forms, Form, Var
+
+
+Categorical = namedtuple('Categorical', 'codes categories')
+
+""" Typed columns, keyed by :db/valueType
+"""
+COLUMNS = {
+  ':db.type/long':    INT64,
+  ':db.type/ref':     INT64,
+  ':db.type/instant': INT64,
+  ':db.type/double':  'd',
+  ':db.type/float':   'd',
+  ':db.type/boolean': 'b',
+}
+CATEGORICAL = (':db.type/string', ':db.type/keyword')
+ENTITY      = ':db.type/ref'
+
+""" valueType of the column of a one variable aggregate, None for the
+type of the variable itself
+"""
+AGGREGATES = {
+  'count':          ':db.type/long',
+  'count-distinct': ':db.type/long',
+  'avg':            ':db.type/double',
+  'median':         ':db.type/double',
+  'variance':       ':db.type/double',
+  'stddev':         ':db.type/double',
+  'sum':            None,
+  'min':            None,
+  'max':            None,
+}
+
+_clause = re.compile(r'\[\s*(\S+)\s+(:[^\s\]]+)\s+(\?[^\s\]]+)')
+
+
+def find_vars(q):
+  """ the :find elements of a query, in order: variables, and
+  aggregates and pulls as lists of their function and arguments
+  >>> find_vars('[:find ?e (count ?v) :where [?e :person/likes ?v]]')
+  ['?e', ['count', '?v']]
+  """
+  try:
+    forms = read_forms(q)
+  except ValueError:
+    return []
+  if len(forms) == 1 and isinstance(forms[0], Form): forms = forms[0]
+  if (':', 'find') not in forms: return []
+  out = []
+  for x in forms[forms.index((':', 'find')) + 1:]:
+    if isinstance(x, tuple): break
+    if isinstance(x, Form) and x.kind == '[':
+      " [?a ?b] tuple and [?e ...] collection finds "
+      out += [y for y in x if y != '...']
+    elif isinstance(x, (Var, Form)):
+      out.append(x)
+  return out
+
+def column(spec, types):
+  """ (name, valueType) of the column of one :find element; an
+  aggregate is named after its function and variables, as count_v
+  """
+  if isinstance(spec, Var): return spec[1:], types.get(spec)
+  args = [x for x in spec[1:] if isinstance(x, Var)]
+  name = '_'.join([unicode(spec[0])] + [x[1:] for x in args])
+  if spec[0] in AGGREGATES and len(spec) == 2 and args:
+    return name, AGGREGATES[spec[0]] or types.get(args[0])
+  return name, None
+
+def var_types(q, schema):
+  """ valueType of each variable the where clauses bind, from the
+  attributes of [?e :ns/attr ?v] patterns.
+  """
+  types = {}
+  for e, a, v in _clause.findall(q):
+    if e.startswith('?'): types.setdefault(e, ENTITY)
+    d = schema.attr(a) if schema else None
+    if d and d.get(':db/valueType'): types.setdefault(v, d[':db/valueType'])
+  return types
+
+class UTC(tzinfo):
+  " zone of the instants read back from a typed column "
+  def utcoffset(self, dt): return timedelta(0)
+  def dst(self, dt):       return timedelta(0)
+  def tzname(self, dt):    return 'UTC'
+
+EPOCH = datetime(1970, 1, 1, tzinfo=UTC())
+
+def micros(dt):
+  " microseconds since the epoch for an aware or utc datetime "
+  return calendar.timegm(dt.utctimetuple()) * 1000000 + dt.microsecond
+
+
+class Column(object):
+  """ Accumulates one result column, typed when its valueType is known.
+  """
+
+  def __init__(self, vtype=None, categorical=False):
+    self.vtype  = vtype
+    self.code   = COLUMNS.get(vtype)
+    self.values = array(self.code) if self.code else []
+    self.cats   = {} if categorical and vtype in CATEGORICAL else None
+
+  def __repr__(self):
+    return "<datomic column %s, %i values>" % (self.vtype, len(self.values))
+
+  def append(self, v):
+    try:
+      if self.cats is not None:
+        x = self.cats.setdefault(v, len(self.cats))
+      elif self.vtype == ':db.type/instant' and v is not None:
+        x = micros(v)
+      else:
+        x = v
+      self.values.append(x)
+    except (TypeError, AttributeError):
+      " nil, a mistyped or an unhashable value, keep python objects "
+      self.values = self.objects() + [v]
+      self.code, self.vtype, self.cats = None, None, None
+
+  def objects(self):
+    " the values so far as the python objects they were appended as "
+    if self.cats is not None:
+      cats = dict((i, k) for k, i in self.cats.iteritems())
+      return [cats[i] for i in self.values]
+    if self.vtype == ':db.type/instant':
+      return [EPOCH + timedelta(microseconds=us) for us in self.values]
+    if self.vtype == ':db.type/boolean':
+      return [bool(b) for b in self.values]
+    return list(self.values)
+
+  def to_numpy(self, np):
+    if self.cats is not None:
+      cats = np.empty(len(self.cats), dtype=object)
+      for k, i in self.cats.iteritems(): cats[i] = k
+      return Categorical(np.array(self.values, dtype=np.int64), cats)
+    if self.code is None:
+      code = infer_column(self.values)
+      if code:
+        return np.array(self.values, dtype='f8' if code == 'd' else 'i8')
+      col = np.empty(len(self.values), dtype=object)
+      col[:] = self.values
+      return col
+    if self.code == 'd':
+      return np.frombuffer(self.values, dtype='f8')
+    col = np.frombuffer(self.values, dtype='i%i' % self.values.itemsize)
+    if self.vtype == ':db.type/instant':
+      return col.astype('i8').view('datetime64[us]')
+    if self.vtype == ':db.type/boolean':
+      return col.astype(bool)
+    return col
+
+
+def to_columns(q, rows, schema=None, categorical=False):
+  """ Fill one column per :find element from an iterable of rows, and
+  return them as numpy arrays keyed by variable name, or by function
+  and variable name for aggregates. Columns are typed from the schema
+  when empty too; untyped ones holding only numbers are typed by them.
+
+  >>> to_columns('[:find ?e ?a :where [?e :person/age ?a]]', rows, db.schema)
+  OrderedDict([('e', array([...])), ('a', array([...]))])
+  >>> to_columns('[:find ?a (count ?e) :where [?e :person/age ?a]]', rows, db.schema)
+  OrderedDict([('a', array([...])), ('count_e', array([...]))])
+  """
+  try:
+    import numpy as np
+  except ImportError:
+    raise Exception, "columnar results require numpy"
+  types = var_types(q, schema)
+  specs = [column(x, types) for x in find_vars(q)]
+  cols  = None
+  for row in rows:
+    if cols is None:
+      if len(specs) != len(row): specs = [(str(i), None) for i in range(len(row))]
+      cols = [Column(vtype, categorical) for _, vtype in specs]
+    for c, v in zip(cols, row):
+      c.append(v)
+  if cols is None:
+    cols = [Column(vtype, categorical) for _, vtype in specs]
+  return OrderedDict((n, c.to_numpy(np)) for (n, _), c in zip(specs, cols))
@@ -1,18 +1,42 @@
 # -*- coding: utf-8 -*-
 """
 """
-import datetime
-import urllib3
+import time
 
 from pprint import pprint as pp
 from termcolor import colored as cl
 import logging
 
-from schema import Schema
-
-from clj import dumps, loads
+from schema import Schema, VALUETYPE
+from block import DatomBlock
+from columns import to_columns
+from registry import AttributeRegistry
+from cache import QueryCache, EntityCache, normalize
+from peers import PeerPool, Traffic, StatusError
+from stats import Stats
+from trace import Tracer
+from local import LocalEngine
+from watch import Watch
+from pull import Pull
+from executor import Executor, iter_ahead, bounded
+from scan import ChunkSizer, DatomCursor
+from edn import iter_vector, TxEncoder, loads, \
+                loads_datoms, loads_datom, loads_rows, loads_row
+
+from clj import dumps
 import json
-from itertools import izip
+import re
+import zlib
+from urllib import urlencode
+import threading
+from collections import OrderedDict, namedtuple
+from itertools import izip, imap
+
+
+""" One query of `DB.q_many`: its rows, or the exception it raised, and
+how long it took in ms
+"""
+QueryResult = namedtuple('QueryResult', 'rows error ms')
 
 
 class DB(object):
@@ -26,15 +50,57 @@ class DB(object):
 
     >>> db = DB("localhost", 8888, "mem", "test", schema=S)
 
+    Several peers serving the same storage share the requests, see
+    `PeerPool` for `balance`, `retries`, `backoff` and ejection.
+    >>> db = DB(["peer1:8888", "peer2:8888"], 8888, "dev", "test", balance='least')
+
     """
     self.host, self.port, self.store, self.db  = host, port, store, db
     self.uri_str = "/data/"+ self.store +"/"
     self.uri_db  = "/data/"+ self.store +"/"+ self.db +"/"
     self.uri_q   = "/api/query"
-    self.pool    = urllib3.connectionpool.HTTPConnectionPool(
-        self.host, port=self.port,
-        timeout=3, maxsize=20,
-        headers={"Accept":"application/edn", "Connection": "Keep-Alive"})
+    self.pool    = PeerPool(self.host, port=self.port,
+        timeout=kwargs.get('timeout', 3), maxsize=kwargs.get('maxsize', 20),
+        headers={"Accept":"application/edn", "Connection": "Keep-Alive"},
+        **dict((k, kwargs[k]) for k in ('balance', 'retries', 'backoff',
+               'eject_after', 'eject_for', 'health_uri') if k in kwargs))
+    "compression: accept gzip/deflate responses, gzip transactions over compress_tx bytes"
+    if kwargs.get('compress'):
+      self.pool.headers['Accept-Encoding'] = 'gzip, deflate'
+    compress_tx = kwargs.get('compress_tx')
+    self.compress_tx = 4096 if compress_tx is True else (compress_tx or 0)
+    self.traffic  = Traffic()
+    "latency, error and pool metrics, opt in with stats=True or a Stats"
+    stats = kwargs.get('stats')
+    self.stats = Stats() if stats is True else \
+                 stats if isinstance(stats, Stats) else None
+    if self.stats is not None:
+      self.stats.gauge('bytes', self.traffic.stats)
+      self.stats.gauge('pool',  self.pool.utilization)
+    "answer Query.all() from local datoms where possible, a LocalEngine or its source"
+    local = kwargs.get('local')
+    self.local = local if isinstance(local, LocalEngine) or local is None \
+                 else LocalEngine(local)
+    "trace spans, opt in with tracer=True or a Tracer"
+    tracer = kwargs.get('tracer')
+    self.tracer = Tracer() if tracer is True else \
+                  tracer if isinstance(tracer, Tracer) else None
+    self.workers  = kwargs.get('workers', 8)
+    self._executor = None
+    self.encoder  = None
+    "attribute registry, opt in with attributes=True or a cache file path"
+    attrs = kwargs.get('attributes')
+    self.attributes = AttributeRegistry(self, path=attrs if isinstance(attrs, basestring) else None) \
+                      if attrs else None
+    "query result cache, opt in with cache=True or a QueryCache"
+    cache = kwargs.get('cache')
+    self.cache  = QueryCache() if cache is True else \
+                  cache if isinstance(cache, QueryCache) else None
+    "shared entity cache, opt in with entity_cache=True or an EntityCache"
+    ecache = kwargs.get('entity_cache')
+    self.entity_cache = EntityCache() if ecache is True else \
+                        ecache if isinstance(ecache, EntityCache) else None
+    self._basis = (None, 0)
     "debugging"
     for d in ('debug_http','debug_loads'):
       setattr(self, d, kwargs.get(d) == True)
@@ -48,13 +114,40 @@ class DB(object):
       if schema is None: return
       logging.warning("I don't know what to do with schema kwarg of type '%s'" % type(schema))
 
+  def attr(self, a):
+    """ Attribute by id or ident from the registry, None without one.
+    >>> db.attr('person/name').valueType
+    u':db.type/string'
+    """
+    if self.attributes is None: return None
+    return self.attributes.get(a)
+
+  @property
+  def types(self):
+    " where attribute definitions come from: the registry, or the schema "
+    return self.attributes if self.attributes is not None else self.schema
+
+  @property
+  def executor(self):
+    " worker threads for background fetches, started on first use "
+    if self._executor is None:
+      self._executor = Executor(self.workers)
+    return self._executor
+
+  def executor_for(self, limit):
+    """ `executor` when it has `limit` workers, else a dedicated one of
+    that size, to shut down once done with
+    """
+    if not limit or limit <= self.workers: return self.executor
+    return Executor(limit)
+
   def create(self):
     """ Creates the database
     >>> db.create()
     True
     """
     data = data={"db-name":self.db}
-    self.rest('POST', self.uri_str, status_codes=(200,201), data=data)
+    self.rest('POST', self.uri_str, status_codes=(200,201), data=data, op='create')
     return True
 
   def info(self):
@@ -62,8 +155,28 @@ class DB(object):
     >>> db.info()
     {:db/alias "store/db", :basis-t ...}
     """
-    return self.rest('GET', self.uri_db + '-/')
+    return self.rest('GET', self.uri_db + '-/', op='info')
+
+  def basis_t(self, max_age=0):
+    """ Current basis-t, reusing the last one read if it is at most
+    `max_age` ms old.
+    >>> db.basis_t(max_age=1000)
+    1042
+    """
+    t, at = self._basis
+    if t is None or (time.time() - at) * 1000.0 > max_age:
+      t = self.info()['basis-t']
+      self._basis = (t, time.time())
+    return t
   
+  def watch(self, since_t=None, **kwargs):
+    """ Iterate over the transactions committed after basis-t `since_t`,
+    as they commit. See `Watch` for `poll_ms`, `batch` and `events`.
+    >>> for delta in db.watch():
+    ...   print delta.t, len(delta.datoms)
+    """
+    return Watch(self, since_t, **kwargs)
+
   def tx_schema(self, **kwargs):
     """ Builds the data structure edn, and puts it in the db
     """
@@ -114,37 +227,181 @@ class DB(object):
       elif isinstance(op, (str,unicode)): ops.append(op)
     if 'debug' in kwargs: pp(ops)
     tx_proc ="[ %s ]" % "".join(ops)
-    x = self.rest('POST', self.uri_db, data={"tx-data": tx_proc})
+    x = self.rest('POST', self.uri_db, data={"tx-data": tx_proc}, op='tx')
+    if isinstance(x, dict) and 'db-after' in x:
+      " our own writes are seen without waiting for the next poll"
+      self._basis = (x['db-after']['basis-t'], time.time())
+      if self.entity_cache is not None:
+        touched = (d['e'] for d in x.get('tx-data') or ())
+        self.entity_cache.invalidate(self.uri_db, touched, x['db-after']['basis-t'])
     return x
   
-  def e(self, eid):
+  def e(self, eid, min_t=None, cache=True):
     """Get an Entity
+
+    With the entity cache enabled it is served from there, when read at
+    basis-t `min_t` or later if given.
+    >>> db.e(item, min_t=1042)
     """
-    ta = datetime.datetime.now()
-    rs = self.rest('GET', self.uri_db + '-/entity', data={'e':int(eid)}, parse=True)
-    tb =  datetime.datetime.now() - ta
-    print cl('<<< fetched entity %s in %sms' % (eid, tb.microseconds/1000.0), 'cyan')
-    return rs
+    c = self.entity_cache if cache else None
+    if c is None:
+      return self.rest('GET', self.uri_db + '-/entity', data={'e':int(eid)}, parse=True,
+                       op='e')
+    ent = c.get(self.uri_db, int(eid), min_t)
+    if ent is not None: return ent
+    t = self.basis_t(max_age=c.poll_ms)
+    ent = self.rest('GET', self.uri_db + '-/entity', data={'e':int(eid)}, parse=True,
+                    op='e')
+    c.put(self.uri_db, int(eid), t, ent)
+    return ent
+
+  def pull(self, eids, pattern='*', depth=1, batch=1000):
+    """ Fetch entities and the entities their refs point to, `depth`
+    refs deep, with one round of queries per level rather than one
+    request per entity. Returns populated `E`s, refs included.
+
+    `pattern` is '*' for every attribute and ref, or a list of
+    attributes with {ref: pattern} items for the refs to follow.
+    >>> person = db.pull(eid, ['person/name', {'person/likes': ['person/name']}])
+    >>> [p['person/name'] for p in person['person/likes']]
+    >>> people = db.pull(eids, '*', depth=2)
+    """
+    one  = not isinstance(eids, (list, tuple, set))
+    ents = [eids] if one else list(eids)
+    ents = [e if isinstance(e, E) else E(e, db=self) for e in ents]
+    pull = Pull(self, batch)
+    data = pull.run([int(e) for e in ents], pattern, depth)
+    objs = dict((int(e), e) for e in ents)
+    for eid in data:
+      if eid not in objs: objs[eid] = E(eid, db=self)
+    self.fill(pull, data, objs)
+    return ents[0] if one else ents
+
+  def fill(self, pull, data, objs):
+    """ set the attributes of the `E`s in `objs` from pulled data, refs
+    to entities in `objs` as those `E`s
+    """
+    ref = lambda v: objs[v] if v in objs else {'db/id': v}
+    for eid, attrs in data.iteritems():
+      d = {'db/id': eid}
+      for a, v in attrs.iteritems():
+        if pull.is_ref(a):
+          v = [ref(x) for x in v] if isinstance(v, list) else ref(v)
+        d[a] = v
+      objs[eid]._dict = d
+
+  def entities(self, eids, concurrency=None, query_min=64, batch=1000):
+    """ Fetch many entities at once, as `E`s in the order of `eids`.
+
+    Each distinct id is fetched once. Up to `query_min` ids are fetched
+    with concurrent `e()` calls, at most `concurrency` in flight (the
+    worker count by default, more run on threads of their own). Larger
+    sets are read with one query per `batch` ids instead, and with the
+    entity cache enabled they are looked up there first and stored there
+    once fetched.
+    >>> people = db.entities(eids, concurrency=16)
+    """
+    got = dict((int(e), e) for e in
+               self.iter_entities(eids, concurrency, query_min, batch))
+    ents = []
+    for e in eids:
+      x = got[int(e)]
+      if isinstance(e, E) and e is not x: e._dict = x._dict
+      ents.append(e if isinstance(e, E) else x)
+    return ents
+
+  def iter_entities(self, eids, concurrency=None, query_min=64, batch=1000):
+    """ Like `entities`, but yields each distinct entity as soon as it
+    is fetched, in no particular order.
+    >>> for person in db.iter_entities(eids):
+    ...   print person['person/name']
+    """
+    ents = OrderedDict()
+    for e in eids:
+      ents.setdefault(int(e), e if isinstance(e, E) else E(e, db=self))
+    ids = list(ents)
+    if self.entity_cache is not None and len(ids) >= query_min:
+      missing = []
+      for eid in ids:
+        ent = self.entity_cache.get(self.uri_db, eid)
+        if ent is None:
+          missing.append(eid)
+          continue
+        ents[eid]._dict = ent
+        yield ents[eid]
+      ids = missing
+    if len(ids) >= query_min:
+      pull = Pull(self, batch)
+      jobs = [ids[i:i + batch] for i in xrange(0, len(ids), batch)]
+      c    = self.entity_cache
+      def fetch(job):
+        t    = None if c is None else self.basis_t(max_age=c.poll_ms)
+        data = pull.run(job, '*', 0)
+        self.fill(pull, data, ents)
+        if c is not None:
+          " components are not nested here, those entities are left out "
+          for eid in job:
+            if not any(pull.is_component(a) for a in data[eid]):
+              c.put(self.uri_db, eid, t, pull.entity(eid, data[eid]))
+        return job
+    else:
+      jobs = ids
+      def fetch(eid):
+        ents[eid]._dict = self.e(eid)
+        return [eid]
+    if self.tracer is not None: fetch = self.tracer.wrap(fetch)
+    ex = self.executor_for(concurrency)
+    try:
+      for _, f in bounded(ex, fetch, jobs, concurrency):
+        for eid in f.result():
+          yield ents[eid]
+    finally:
+      if ex is not self.executor: ex.shutdown(wait=False)
 
   def retract(self, e, a, v):
     """ redact the value of an attribute
     """
-    ta = datetime.datetime.now()
     ret = u"[:db/retract %i :%s %s]" % (e, a, dump_edn_val(v))
-    rs = self.tx(ret)
-    tb = datetime.datetime.now() - ta
-    print cl('<<< retracted %s,%s,%s in %sms' % (e,a,v, tb.microseconds/1000.0), 'cyan')
-    return rs
+    return self.tx(ret)
 
 
   def datoms(self, index='aevt', e='', a='', v='', 
                    limit=0, offset=0, chunk=100, 
-                   start='', end='', since='', as_of='', history='', **kwargs):
+                   start='', end='', since='', as_of='', history='', 
+                   prefetch=0, target_ms=None, cursor=None, stream=False, 
+                   blocks=False, idents=False, **kwargs):
     """ Returns a lazy generator that will only fetch groups of datoms
         at the chunk size specified.
 
+    Pipelined scans keep up to `prefetch` chunks fetched in the
+    background, and with `target_ms` the chunk size adapts to the
+    measured latency (see `ChunkSizer` for `min_chunk`, `max_chunk`
+    and `max_bytes`).
+    >>> db.datoms('eavt', prefetch=4, target_ms=250)
+
+    `limit` is the number of datoms returned after skipping `offset`,
+    whichever way the scan pages.
+
+    Deep avet scans of one attribute should page by cursor rather than
+    offset. Pass `cursor=True` to start a scan, or a saved
+    `DatomCursor.token` to resume one.
+    >>> cur = db.datoms('avet', a='person/name', cursor=True)
+
+    With `stream` each chunk is decoded incrementally, and datoms are
+    yielded as they are read off the wire.
+
+    With `blocks` each chunk is yielded as a columnar `DatomBlock`.
+    >>> db.datoms('aevt', a='person/age', blocks=True)
+
+    With `idents` and the attribute registry enabled, :a is decoded to
+    the attribute ident rather than its id (offset and stream scans).
+
     http://docs.datomic.com/clojure/index.html#datomic.api/datoms
     """
+    sizer = ChunkSizer(chunk, target_ms, **dict((k, kwargs[k]) for k in 
+              ('min_chunk', 'max_chunk', 'max_bytes') if k in kwargs))
+    if cursor not in (None, False, True):
+      return DatomCursor.load(self, cursor, sizer, prefetch, encode=dump_edn_val)
     assert index in ['aevt','eavt','avet','vaet'], "non-existant index"
     data = {'index':   index, 
             'a':       ':{0}'.format(a) if a else '',
@@ -158,59 +415,261 @@ class DB(object):
             'as-of':   int(as_of) if as_of else '',
             'since':   int(since) if since else '',
             }
-    data['limit'] = offset + chunk
-    rs = True
-    while rs and (data['offset'] < (limit or 1000000000)):
-      ta = datetime.datetime.now()
-      rs = self.rest('GET', self.uri_db + '-/datoms', data=data, parse=True)
-      if not len(rs):
-        rs = False
-      tb = datetime.datetime.now() - ta
-      print cl('<<< fetched %i datoms at offset %i in %sms' % (
-        len(rs), data['offset'], tb.microseconds/1000.0), 'cyan')
-      for r in rs: yield r
-      data['offset'] += chunk
-
-  def rest(self, method, uri, data=None, status_codes=None, parse=True, **kwargs):
+    if cursor:
+      return DatomCursor(self, data, sizer, limit or None, prefetch, encode=dump_edn_val)
+    stop = (offset or 0) + limit if limit else 1000000000
+    if stream:
+      rows = self.datom_stream(data, stop, sizer)
+      return imap(self.ident_datom, rows) if idents else rows
+    pages = self.datom_pages(data, stop, sizer)
+    if blocks:
+      vtype = (self.types.attr(a) or {}).get(VALUETYPE) if a and self.types else None
+      pages = (DatomBlock(rs, vtype) for rs in pages)
+    if prefetch:
+      pages = iter_ahead(self.executor, pages, prefetch)
+    if blocks:
+      return pages
+    rows = (r for rs in pages for r in rs)
+    return imap(self.ident_datom, rows) if idents else rows
+
+  def ident_datom(self, r):
+    " replace the attribute id of a datom with its ident "
+    if self.attributes is not None:
+      r['a'] = self.attributes.ident(r['a'])
+    return r
+
+  def datom_pages(self, data, stop, sizer):
+    """ Fetch chunks of datoms from data['offset'] until `stop` or an
+    empty chunk, sized by `sizer`.
+    """
+    while data['offset'] < stop:
+      data['limit'] = min(sizer.chunk, stop - data['offset'])
+      rs, ms, nbytes = self.datom_chunk(data)
+      if not len(rs): return
+      yield rs
+      data['offset'] += len(rs)
+      sizer.update(len(rs), ms, nbytes)
+
+  def datom_stream(self, data, stop, sizer):
+    """ Like `datom_pages`, but yields single datoms while each chunk
+    is still being read.
+    """
+    while data['offset'] < stop:
+      data['limit'] = min(sizer.chunk, stop - data['offset'])
+      n = 0
+      for r in self.rest('GET', self.uri_db + '-/datoms', data=data, 
+                         stream=True, decode=loads_datom, op='datoms'):
+        n += 1
+        yield r
+      if not n: return
+      data['offset'] += n
+
+  def datom_chunk(self, data):
+    """ Fetch a single chunk of datoms, returns the datoms, the request
+    time in ms and the response size.
+    """
+    ta = time.time()
+    r  = self.rest('GET', self.uri_db + '-/datoms', data=data, parse=False, op='datoms')
+    rs = self.decode('datoms', loads_datoms, r.data)
+    ms = (time.time() - ta) * 1000.0
+    return rs, ms, len(r.data)
+
+  def rest(self, method, uri, data=None, status_codes=None, parse=True, 
+                 stream=False, decode=loads, op=None, **kwargs):
     """ Rest helpers
+
+    With `stream` the response is read incrementally, and a parsed
+    response is a generator over the elements of the edn vector, each
+    one parsed with `decode`.
+
+    Transaction bodies (`op='tx'`) of `compress_tx` bytes or more are
+    sent gzipped; queries and reads are small and go as they are. Every
+    call's raw and wire sizes are counted in `db.traffic`. With `stats`
+    or a `tracer` each phase is timed under `op`.
     """
-    r = self.pool.request_encode_body(method, uri, fields=data, encode_multipart=False)
+    op  = op or method.lower()
+    ins = self.stats is not None or self.tracer is not None
+    if ins: ta = time.time()
+    body, headers = None, dict(self.pool.headers)
+    if data:
+      body = urlencode(data)
+      headers['Content-Type'] = 'application/x-www-form-urlencoded'
+    raw = len(body or '')
+    if op == 'tx' and self.compress_tx and raw >= self.compress_tx:
+      body = gzip_bytes(body)
+      headers['Content-Encoding'] = 'gzip'
+    if ins:
+      tb = time.time()
+      self.phase(op, 'encode', ta, tb, bytes=raw)
+    try:
+      r = self.pool.urlopen(method, uri, body=body, headers=headers,
+                            preload_content=not stream)
+    except Exception, e:
+      if ins: self.failed(op, e)
+      raise
+    if ins:
+      " a streamed body is only read, and counted, by `stream` "
+      args = {} if stream else dict(received=r.tell())
+      self.phase(op, 'http', tb, time.time(), uri=uri, status=r.status,
+                 sent=len(body or ''), **args)
+    sent = (uri, raw, len(body or ''))
+    if not stream:
+      self.traffic.add(*sent + (len(r.data), r.tell()))
     if not r.status in (status_codes if status_codes else (200,201)):
-      print cl('\n---------\nURI / REQUEST TYPE : %s %s' % (uri, method), 'red')
-      print cl(data, 'red')
-      print r.headers
-      raise Exception, "Invalid status code: %s" % r.status
+      logging.error('%s %s failed with status %s\n%s\n%s' % (
+        method, uri, r.status, data, r.headers))
+      e = StatusError(r.status)
+      if ins: self.failed(op, e)
+      if stream:
+        " unread body, drop the connection rather than reuse it "
+        r.close()
+        r.release_conn()
+      raise e
     if not parse: 
       " return raw urllib3 response"
       return r
+    if stream:
+      " parse elements as they arrive"
+      return self.stream(r, decode, sent=sent, op=op)
     if not self.debug_loads:
       " return parsed edn"
-      return loads(r.data)
+      return self.decode(op, decode, r.data)
     "time edn parse time and return parsed edn"
-    return self.debug(loads, args=(r_data, ), kwargs={},
+    return self.debug(decode, args=(r.data, ), kwargs={},
           fmt='<<< parsed edn datastruct in {ms}ms', color='green')
 
+  def decode(self, op, decode, data):
+    " decode a response body, timed when instrumented "
+    if self.stats is None and self.tracer is None: return decode(data)
+    ta = time.time()
+    rs = decode(data)
+    self.phase(op, 'decode', ta, time.time(), bytes=len(data),
+               count=len(rs) if isinstance(rs, list) else 1)
+    return rs
+
+  def phase(self, op, phase, start, end, **args):
+    " report a timed phase of `op` to the stats and the tracer "
+    if self.stats is not None:
+      self.stats.record(op, phase, (end - start) * 1000.0)
+    if self.tracer is not None:
+      self.tracer.complete('%s.%s' % (op, phase), start, end, **args)
+
+  def failed(self, op, e):
+    " report a failed `op` to the stats and the tracer "
+    if self.stats is not None:
+      self.stats.error(op, e)
+    if self.tracer is not None:
+      t = time.time()
+      self.tracer.complete('%s.error' % op, t, t, error=repr(e))
+
+  def stream(self, r, decode=loads, amt=65536, sent=None, op='stream'):
+    """ Yield the elements of the edn vector in a streamed response.
+    Compressed responses are inflated chunk by chunk as they are read.
+
+    The decode phase of a streamed response runs until the last element
+    is consumed, so it includes the time spent by the consumer.
+    """
+    finished, raw, n = False, [0], 0
+    def chunks():
+      for chunk in r.stream(amt):
+        raw[0] += len(chunk)
+        yield chunk
+    ta = time.time()
+    try:
+      for x in iter_vector(chunks(), decode):
+        n += 1
+        yield x
+      finished = True
+    finally:
+      if self.stats is not None or self.tracer is not None:
+        self.phase(op, 'decode', ta, time.time(), bytes=raw[0], count=n,
+                   received=r.tell())
+      if sent: self.traffic.add(*sent + (raw[0], r.tell()))
+      " a partly read connection can't go back to the pool"
+      if finished: r.release_conn()
+      else:        r.close()
+
+  def q_many(self, queries, max_workers=None, fail_fast=True):
+    """ Run independent queries concurrently, `Query` objects or edn
+    strings, at most `max_workers` at a time (the worker count by
+    default, more run on threads of their own). Returns a `QueryResult`
+    per query, in input order.
+
+    With `fail_fast` the first failure is raised and no more queries
+    are started, otherwise each failure is returned as its `error`.
+    >>> rs = db.q_many([qa, qb, qc], max_workers=8)
+    >>> [r.rows for r in rs], max(r.ms for r in rs)
+    """
+    queries = list(queries)
+    def run(q):
+      ta = time.time()
+      try:
+        rows = q.all() if isinstance(q, Query) else self.q(q)
+      except Exception, e:
+        if fail_fast: raise
+        return QueryResult(None, e, (time.time() - ta) * 1000.0)
+      return QueryResult(rows, None, (time.time() - ta) * 1000.0)
+    if self.tracer is not None: run = self.tracer.wrap(run)
+    ta, rs = time.time(), [None] * len(queries)
+    ex   = self.executor_for(max_workers)
+    done = bounded(ex, run, queries, max_workers)
+    try:
+      for i, f in done:
+        rs[i] = f.result()
+    finally:
+      done.close()
+      if ex is not self.executor: ex.shutdown(wait=False)
+    if self.stats is not None or self.tracer is not None:
+      self.phase('q_many', 'run', ta, time.time(), queries=len(queries))
+    return rs
+
   def debug(self, defn, args, kwargs, fmt=None, color='green'):
     """ debug timing, colored terminal output
     """
-    ta = datetime.datetime.now()
+    ta = time.time()
     rs = defn(*args, **kwargs)  
-    tb = datetime.datetime.now() - ta
+    ms = (time.time() - ta) * 1000.0
     fmt = fmt or "processed {defn} in {ms}ms"
-    logmsg = fmt.format(ms=tb.microseconds/1000.0, defn=defn)
+    logmsg = fmt.format(ms=ms, defn=defn)
     "terminal output"
     print cl(logmsg, color)
     "logging output"
     logging.debug(logmsg)
     return rs
 
-  def q(self, q, inputs=None, limit='', offset='', history=False):
+  def q(self, q, inputs=None, limit='', offset='', history=False, stream=False,
+              columnar=False, categorical=False, as_of=None, cache=True):
     """ query
+
+    With `as_of` the query runs against the database as of that t.
+
+    With `stream` a generator of rows is returned, rows are yielded as
+    they are decoded from the response.
+
+    With `columnar` the result is one numpy array per :find variable,
+    filled while the response is decoded. Types come from the schema
+    where known, `categorical` encodes strings and keywords as codes.
+    >>> db.q('[:find ?e ?a :where [?e :person/age ?a]]', columnar=True)
+    OrderedDict([('e', array([...])), ('a', array([...]))])
+
+    When the db has a `QueryCache`, plain results are served from it
+    while basis-t has not moved; pass `cache=False` to always fetch.
     """
+    args = (q, inputs, limit, offset, history, stream, columnar, categorical,
+            as_of, cache)
+    if self.tracer is None: return self.run_q(*args)
+    with self.tracer.span('q', query=query_hash(q), inputs=len(inputs or ())) as span:
+      rs = self.run_q(*args)
+      if isinstance(rs, list): span.args['rows'] = len(rs)
+      return rs
+
+  def run_q(self, q, inputs, limit, offset, history, stream, columnar, categorical,
+                  as_of, cache):
     if not q.strip().startswith("["): q = "[ {0} ]".format(q)
-    args     = u'[ {:db/alias "%(store)s/%(db)s" %(hist)s} %(inputs)s ]' % dict(
+    args     = u'[ {:db/alias "%(store)s/%(db)s" %(asof)s %(hist)s} %(inputs)s ]' % dict(
       store  = self.store,
       db     = self.db,
+      asof   = ':as-of %i' % int(as_of) if as_of else '',
       hist   = ':history true' if history==True else '',
       inputs = " ".join(inputs or []))
     data = {"args":   args, 
@@ -218,7 +677,25 @@ class DB(object):
             "offset": offset or '',
             "limit":  limit  or '',
             }
-    return self.rest('GET', self.uri_q, data=data, parse=True)
+    if columnar:
+      rows = self.rest('GET', self.uri_q, data=data, parse=True, stream=True,
+                       decode=loads_row, op='q')
+      return to_columns(q, rows, self.types, categorical)
+    if stream:
+      return self.rest('GET', self.uri_q, data=data, parse=True, stream=True,
+                       decode=loads_row, op='q')
+    if self.cache is None or not cache:
+      return self.rest('GET', self.uri_q, data=data, parse=True, decode=loads_rows,
+                       op='q')
+    " as-of results never go stale"
+    key = self.cache.key(self.uri_db, q, inputs, limit, offset, history, as_of)
+    t   = None if as_of else self.basis_t(max_age=self.cache.poll_ms)
+    rs  = self.cache.get(key, t)
+    if rs is None:
+      r  = self.rest('GET', self.uri_q, data=data, parse=False, op='q')
+      rs = self.decode('q', loads_rows, r.data)
+      self.cache.put(key, t, rs, len(r.data))
+    return rs
 
   def find(self, *args, **kwargs):
     " new query builder on current db"
@@ -246,6 +723,7 @@ class Query(object):
     self._limit   = None
     self._offset  = None
     self._history = False
+    self._as_of   = None
     self.find(find)
   
   def __repr__(self):
@@ -296,7 +774,10 @@ class Query(object):
     self._offset = offset
     return self
   def history(self, history):
-    self._offset = history
+    self._history = history
+    return self
+  def as_of(self, t):
+    self._as_of = t
     return self
 
   def hashone(self):
@@ -305,7 +786,8 @@ class Query(object):
     if not rs: 
       return {}
     else:
-      finds = " ".join(self._find).split(' ')
+      q, finds, names = compile_query(*self._shape())
+      finds = " ".join(finds).split(' ')
       return dict(zip((x.replace('?','') for x in finds), rs))
   
   def one(self):
@@ -317,46 +799,201 @@ class Query(object):
     else:
       return rs[0]
 
-  def all(self):
-    " execute query, get all list of lists"
+  def all(self, local=True):
+    """ execute query, get all list of lists
+    With a `local` engine on the db it is tried first.
+    """
+    if local and self.db.local is not None:
+      rs = self.db.local.run(self)
+      if rs is not None: return rs
+    query,inputs = self._toedn()
+    return self.db.q(query,
+      inputs  = inputs,
+      limit   = self._limit,
+      offset  = self._offset,
+      history = self._history,
+      as_of   = self._as_of)
+
+  def all_async(self, local=True):
+    """ `all` on a worker thread of the db, returns a `Future`
+    >>> futures = [qa.all_async(), qb.all_async()]
+    >>> [f.result() for f in futures]
+    """
+    defn = self.all if self.db.tracer is None else self.db.tracer.wrap(self.all)
+    return self.db.executor.submit(defn, local)
+
+  def to_columns(self, categorical=False):
+    " execute query, get one numpy array per :find variable"
+    query,inputs = self._toedn()
+    return self.db.q(query,
+      inputs      = inputs,
+      limit       = self._limit,
+      offset      = self._offset,
+      history     = self._history,
+      as_of       = self._as_of,
+      columnar    = True,
+      categorical = categorical)
+
+  def stream(self):
+    " execute query, yield each row as it is decoded"
     query,inputs = self._toedn()
     return self.db.q(query,
       inputs  = inputs,
       limit   = self._limit,
       offset  = self._offset,
-      history = self._history)
+      history = self._history,
+      as_of   = self._as_of,
+      stream  = True)
   
+  def iter(self, page_size=1000, prefetch=1):
+    """ execute query a page at a time, yield each row
+
+    Up to `prefetch` pages are fetched ahead while the current one is
+    consumed, iteration stops on a short page or at the query's limit.
+    Without an as-of t every page reads the db as of the first one.
+    >>> for row in qa.iter(page_size=10000, prefetch=2):
+    ...   print row
+    """
+    pages = self.pages(page_size)
+    if prefetch:
+      pages = iter_ahead(self.db.executor, pages, prefetch)
+    return (row for rs in pages for row in rs)
+
+  def pages(self, page_size=1000):
+    " execute query, yield lists of at most `page_size` rows"
+    query,inputs = self._toedn()
+    as_of  = self._as_of or self.db.basis_t()
+    offset = self._offset or 0
+    stop   = offset + self._limit if self._limit else None
+    while stop is None or offset < stop:
+      size = page_size if stop is None else min(page_size, stop - offset)
+      rs = self.db.q(query,
+        inputs  = inputs,
+        limit   = size,
+        offset  = offset,
+        history = self._history,
+        as_of   = as_of,
+        cache   = False)
+      if rs: yield rs
+      if len(rs) < size: return
+      offset += size
+
   def _toedn(self):
     """ prepare the query for the rest api
     """
-    finds  = u""
-    inputs = u""
-    wheres = u""
-    args   = []
-    ": in and args"
-    for a,b in self._input:
-      inputs += " {0}".format(a)
-      args.append(dump_edn_val(b))
-    if inputs:
-      inputs = u":in ${0}".format(inputs)
-    " :where "
-    for where in self._where:
-      if isinstance(where, (str,unicode)): 
-        wheres += u"[{0}]".format(where)
-      elif isinstance(where, (list)):
-        wheres += u" ".join([u"[{0}]".format(w) for w in where])
-    " find: "
-    if self._find == []: #find all
-      fs = set()
-      for p in wheres.replace('[',' ').replace(']',' ').split(' '):
-        if p.startswith('?'):
-          fs.add(p)
-      self._find = list(fs)
-    finds = " ".join(self._find)
-    " all togethr now..."
-    q = u"""[ :find {0} {1} :where {2} ]""".\
-        format( finds, inputs, wheres)
-    return q,args
+    db = self.db
+    if db is None or (db.stats is None and db.tracer is None):
+      q, finds, names = compile_query(*self._shape())
+      return q, [dump_edn_val(b) for a,b in self._input]
+    ta = time.time()
+    q, finds, names = compile_query(*self._shape())
+    args = [dump_edn_val(b) for a,b in self._input]
+    db.phase('q', 'compile', ta, time.time(), query=query_hash(q))
+    return q, args
+
+  def _shape(self):
+    " what the query text depends on, hashable "
+    return (tuple(self._find),
+            tuple(w if isinstance(w, basestring) else tuple(w) for w in self._where),
+            tuple(a for a,b in self._input))
+
+  def prepare(self):
+    """ compile the query once, run it many times with new parameters
+
+    >>> pq = db.find('?e').where('?e :person/name ?n').param('?n', 'Bob').prepare()
+    >>> pq.execute('Alice')
+    >>> pq.execute(n='Carol')
+    """
+    shape = self._shape()
+    with _prepared_lock:
+      compiled = _prepared.pop(shape, None)
+      if compiled is None:
+        compiled = compile_query(*shape)
+        if len(_prepared) >= PREPARED_MAX:
+          _prepared.popitem(last=False)
+      _prepared[shape] = compiled
+    return PreparedQuery(self.db, compiled,
+      defaults = [b for a,b in self._input],
+      limit    = self._limit,
+      offset   = self._offset,
+      history  = self._history,
+      as_of    = self._as_of)
+
+
+
+""" Compiled query text by query shape, shared by all prepared queries
+"""
+PREPARED_MAX   = 1000
+_prepared      = OrderedDict()
+_prepared_lock = threading.Lock()
+
+_var = re.compile(r'\?[^\s\[\]\(\)]+')
+
+def compile_query(find, where, bindings):
+  """ Query edn for a find list, where clauses and :in bindings.
+  Returns the query, its :find variables and the name of each input.
+  """
+  wheres = u""
+  for w in where:
+    if isinstance(w, basestring):
+      wheres += u"[{0}]".format(w)
+    else:
+      wheres += u" ".join([u"[{0}]".format(x) for x in w])
+  finds = list(find)
+  if not finds:
+    " find all"
+    finds = list(set(_var.findall(wheres)))
+  inputs = u":in ${0}".format(u"".join(u" {0}".format(b) for b in bindings)) \
+           if bindings else u""
+  names = tuple((_var.findall(b) or [b])[0].lstrip('?') for b in bindings)
+  q = u"""[ :find {0} {1} :where {2} ]""".format(u" ".join(finds), inputs, wheres)
+  return q, tuple(finds), names
+
+
+class PreparedQuery(object):
+  """ A compiled, immutable query. `execute` only encodes the inputs.
+
+  Inputs are taken by position, or by the name of their first variable;
+  those not given keep the values bound when the query was prepared.
+  >>> pq = db.find('?e').where('?e :person/age ?a').param('?a', 25).prepare()
+  >>> pq.execute(30) == pq.execute(a=30)
+  True
+  """
+  __slots__ = ('db', 'q', 'finds', 'names', 'defaults', 'limit', 'offset', 'history', 'as_of')
+
+  def __init__(self, db, compiled, defaults=(), limit=None, offset=None,
+                     history=False, as_of=None):
+    q, finds, names = compiled
+    for k, v in (('db', db), ('q', q), ('finds', finds), ('names', names),
+                 ('defaults', tuple(defaults)), ('limit', limit), ('offset', offset),
+                 ('history', history), ('as_of', as_of)):
+      object.__setattr__(self, k, v)
+
+  def __setattr__(self, k, v):
+    raise AttributeError("prepared queries are immutable")
+
+  def __repr__(self):
+    return "<datomic prepared query %s>" % self.q
+
+  def inputs(self, args, params):
+    " edn of each input, in :in order "
+    if len(args) > len(self.names):
+      raise Exception, "%i inputs given, query takes %i" % (len(args), len(self.names))
+    values = list(args) + list(self.defaults[len(args):])
+    for k, v in params.iteritems():
+      if k not in self.names:
+        raise Exception, "unknown query input: %s" % k
+      values[self.names.index(k)] = v
+    return [dump_edn_val(v) for v in values]
+
+  def execute(self, *args, **params):
+    " run the query, get all list of lists"
+    return self.db.q(self.q,
+      inputs  = self.inputs(args, params),
+      limit   = self.limit,
+      offset  = self.offset,
+      history = self.history,
+      as_of   = self.as_of)
 
 
 
@@ -436,24 +1073,33 @@ class E(dict):
     self._dict = self._db.e(self.eid)     # fetch
     return self._dict
 
-  def vpar(self, val):
-    # TODO - check schema for type,cardinality 
-    if not isinstance(val, dict): return val
+  def vpar(self, val, attr=None):
+    """ wrap refs in `E`, by attribute type when the registry knows it
+    """
+    a = self._db.attr(attr) if attr and self._db.attributes is not None else None
+    if a is None:
+      if not isinstance(val, dict) or isinstance(val, E): return val
+      return E(val.get('db/id'), db=self._db, tx=self._tx)
+    if a.valueType != ':db.type/ref' or val is None: return val
+    if a.cardinality == ':db.cardinality/many':
+      return [v if isinstance(v, E) else E(v.get('db/id'), db=self._db, tx=self._tx)
+              for v in val]
+    if isinstance(val, E): return val
     return E(val.get('db/id'), db=self._db, tx=self._tx)
 
   def __getitem__(self, attr, default=None):
     val = self.__dict__.get(attr, default)
-    return self.vpar(val)
+    return self.vpar(val, attr)
 
   def __getattr__(self, attr, default=None):
     val = self.__dict__.get(attr, default)
-    if val: return self.vpar(v)
+    if val: return self.vpar(val, attr)
 
     rs, ns = {}, '{0}/'.format(attr)
     for k,v in self.__dict__.iteritems():
       if k.startswith(ns):
         attr = "/".join(k.split('/')[1:])
-        vp = self.vpar(v)
+        vp = self.vpar(v, k)
         if not attr in rs:
           rs[attr] = vp
         elif isinstance(rs[attr], list):
@@ -473,6 +1119,13 @@ class E(dict):
   def eid(self):
     return self._eid
 
+  def prefetch(self, pattern='*', depth=1):
+    """ load this entity and the refs `pattern` names, see `DB.pull`
+    >>> person.prefetch(['person/name', {'person/likes': '*'}])
+    """
+    self._db.pull(self, pattern, depth)
+    return self
+
   def add(self, *args, **kwargs):
     self._tx.add(self, *args, **kwargs)
 
@@ -499,9 +1152,10 @@ class TX(object):
   """
   def __init__(self, db):
     self.db = db
-    self.tmpents, self.adds, self.ctmpid, self.txid = [], [], -1, -1
+    self.tmpents, self.adds, self.ctmpid, self.txid = {}, [], -1, -1
     self.resp     = None
-    self.realents = []
+    self.realents = {}
+    self.tracked  = set()
 
   def __repr__(self):
     return "<datomic tx, %i pending>" % len(self)
@@ -546,7 +1200,7 @@ class TX(object):
         entity = E(args[0], tx=self)
       elif isinstance(args[0], E):
         " dont resuse entity from another tx"
-        if args[0]._tx is self:
+        if args[0]._tx is self or self.adopt(args[0]):
           entity  = args[0]
         else:
           if int(args[0]) > 0:
@@ -598,7 +1252,7 @@ class TX(object):
     """
     assert self.resp is None, "Transaction already committed"
     try:
-      self.resp = self.db.tx(list(self.edn_iter), **kwargs)
+      self.resp = self.db.tx(self.edn(), **kwargs)
     except Exception:
       self.resp = False
       raise
@@ -606,6 +1260,7 @@ class TX(object):
       self.resolve()
       self.adds = None
       self.tmpents = None
+      self.tracked = None
     return self.resp # raw dict response
 
   def resolve(self):
@@ -613,22 +1268,43 @@ class TX(object):
     Automatically takes place after transaction is executed.
     """
     assert isinstance(self.resp, dict), "Transaction in uncommitted or failed state"
-    rids = [(v) for k,v in self.resp['tempids'].items()]
+    rids = dict((tempid_index(k), v) for k,v in self.resp['tempids'].iteritems())
     self.txid = self.resp['tx-data'][0]['tx']
-    rids.reverse()
-    for t in self.tmpents:
-      pos = self.tmpents.index(t)
-      t._eid, t._txid = rids[pos], self.txid
-    for t in self.realents:
-      t._txid = self.txid
+    for tmpid, ents in self.tmpents.iteritems():
+      if tmpid not in rids:
+        raise Exception, "tempid %i missing from the tx response" % tmpid
+      for t in ents:
+        t._eid, t._txid = rids[tmpid], self.txid
+    for ents in self.realents.itervalues():
+      for t in ents:
+        t._txid = self.txid
   
+  def adopt(self, e):
+    """ Whether an entity of another tx may be added to as is.
+    """
+    return False
+
   def addeav(self, e, a, v):
     if v is None: return
     self.adds.append((e, a, v))
-    if int(e) < 0 and e not in self.tmpents:
-      self.tmpents.append(e)
-    elif int(e) > 0 and e not in self.realents:
-      self.realents.append(e)
+    " track every E object by entity id, to resolve them all later"
+    if id(e) in self.tracked: return
+    self.tracked.add(id(e))
+    eid  = int(e)
+    ents = self.tmpents if eid < 0 else self.realents
+    ents.setdefault(eid, []).append(e)
+
+  def edn(self):
+    """ tx-data for all pending datoms, one map per entity
+    """
+    if self.db.encoder is None:
+      self.db.encoder = TxEncoder(self.db.types, fallback=dump_edn_val)
+    if self.db.stats is None and self.db.tracer is None:
+      return self.db.encoder.encode(self.adds)
+    ta  = time.time()
+    edn = self.db.encoder.encode(self.adds)
+    self.db.phase('tx', 'build', ta, time.time(), datoms=len(self.adds), bytes=len(edn))
+    return edn
 
   @property
   def edn_iter(self):
@@ -650,6 +1326,26 @@ def dump_edn_val(v):
   else:                             
     return dumps(v)
 
+def gzip_bytes(s):
+  " gzip framed deflate of a request body "
+  z = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+  return z.compress(s) + z.flush()
+
+def query_hash(q):
+  " short stable id of a query's text "
+  return '%08x' % (zlib.crc32(normalize(q).encode('utf-8')) & 0xffffffff)
+
+def tempid_index(k):
+  """ The tempid index a key of a tx response's tempids map refers to.
+
+  The peer reports tempids in their internal form, the partition in
+  the high bits above 2^42 and the index in the low bits:
+  >>> tempid_index(-9223350046622220289)
+  -1
+  """
+  if k > -2**62: return k
+  return (k + 2**63) % 2**42 - 2**42
+
 def pairwise(iterable):
   "s -> (s0,s1), (s2,s3), (s4, s5), ..."
   a = iter(iterable)
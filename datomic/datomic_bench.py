@@ -0,0 +1,62 @@
+# -*- coding: utf8 -*-
+""" Client side benchmarks, no running peer required.
+
+> python datomic/datomic_bench.py
+"""
+
+from datomic import *
+from datomic_test import S, HOST, PORT, STORE, DBN
+from edn import loads, loads_datoms, loads_rows
+import timeit
+
+
+db = DB(HOST, PORT, STORE, DBN, S)
+
+
+def build_tx(n):
+  " about n datoms: people with three attributes and a ref to the previous one "
+  tx, prev = db.tx(), None
+  for i in xrange(n / 4):
+    p = tx.add("person/", {
+      'name':   "Person %i" % i,
+      'email':  "person%i@example.com" % i,
+      'age':    i % 90,
+      })
+    if prev is not None:
+      tx.add(p, "person/likes", [prev])
+    prev = p
+  return tx
+
+
+def bench(name, defn, number=3):
+  ms = min(timeit.repeat(defn, number=1, repeat=number)) * 1000.0
+  print "%-40s %10.1fms" % (name, ms)
+  return ms
+
+
+def bench_tx_encode(n=100000):
+  tx = build_tx(n)
+  print "encoding %i datoms" % len(tx)
+  a = bench("TX.edn_iter (map per datom)", lambda: u"".join(tx.edn_iter))
+  b = bench("TX.edn (schema compiled, merged)", tx.edn)
+  print "%-40s %10.1fx" % ("speedup", a / b)
+
+
+def bench_decode(n=20000):
+  datoms = "[%s]" % " ".join(
+    '{:e %i, :a 62, :v "Person %i", :tx 13194139534354, :added true}' % (
+      17592186045418 + i, i) for i in xrange(n))
+  rows = "[%s]" % " ".join(
+    '[%i "Person %i" %i 1.5]' % (17592186045418 + i, i, i % 90) for i in xrange(n))
+  print "decoding %i datoms, %i rows" % (n, n)
+  a = bench("loads (datoms)", lambda: loads(datoms))
+  b = bench("loads_datoms", lambda: loads_datoms(datoms))
+  print "%-40s %10.1fx" % ("speedup", a / b)
+  a = bench("loads (rows)", lambda: loads(rows))
+  b = bench("loads_rows", lambda: loads_rows(rows))
+  print "%-40s %10.1fx" % ("speedup", a / b)
+
+
+if __name__ == '__main__':
+  bench_tx_encode()
+  bench_decode()
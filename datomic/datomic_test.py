@@ -3,8 +3,23 @@
 """
 
 from datomic import *
+from asyncdb import AsyncDB
+from scan import ChunkSizer, DatomCursor
+from block import DatomBlock
+from executor import Executor, iter_ahead
+from columns import find_vars, to_columns, Column, Categorical
+from bulk import BulkLoader
+from registry import AttributeRegistry, Attribute
+from watch import Watch, Unavailable
+from replica import Replica, Segment, write_segment, INDEXES
+from local import LocalEngine, DatomIndex
+from edn import VectorReader, iter_vector, loads, loads_datoms, loads_datom, \
+                loads_rows, loads_row, TxEncoder
 from schema import *
 import datetime
+import decimal, json, os, re, shutil, tempfile, threading, time, uuid, zlib
+from urllib import urlencode
+import BaseHTTPServer, SocketServer
 from pprint import pprint as pp
 
 
@@ -229,5 +244,1403 @@ def test_all():
     print r
 
 
+def test_async():
+  adb = AsyncDB(HOST, PORT, STORE, DBN, S, workers=8)
+
+  " concurrent reads "
+  fs = [adb.info() for _ in range(8)]
+  assert all(f.result()['basis-t'] for f in fs)
+
+  " async tx and query "
+  tx = adb.tx()
+  person = tx.add("person/", {'name': 'Async Person', 'age': 30})
+  assert tx.execute().result()
+  assert person.eid > 0
+
+  q = adb.find('?e').where('?e :person/name "Async Person"')
+  assert q.one().result()[0] == person.eid
+
+  " datoms fetched ahead on a worker "
+  assert list(adb.datoms('aevt', a='person/name', limit=10))
+
+
+""" offline tests, no peer needed
+"""
+def test_async_offline():
+  adb = AsyncDB(HOST, PORT, STORE, DBN, S, workers=4)
+  def rest(method, uri, data=None, **kwargs):
+    if uri.endswith('-/'):    return {'basis-t': 1000}
+    if uri == adb.sync.uri_q: return [[1001]]
+    if method == 'POST':
+      " the peer's form of tempid -1 "
+      return {'tempids': {-2**63 + 5 * 2**42 - 1: 1001}, 'tx-data': [{'tx': 1002}]}
+    raise Exception("Invalid status code: 404")
+  adb.sync.rest = rest
+
+  fs = [adb.info() for _ in range(8)]
+  assert [f.result()['basis-t'] for f in fs] == [1000] * 8
+
+  tx = adb.tx()
+  person = tx.add("person/", {'name': 'Async Person'})
+  assert tx.execute().result()['tx-data'][0]['tx'] == 1002
+  assert person.eid == 1001
+
+  q = adb.find('?e').where('?e :person/name "Async Person"')
+  assert q.one().result() == [1001]
+  assert q.all().result() == [[1001]]
+
+  " errors surface from the future "
+  try:
+    adb.e(1001).result()
+  except Exception, e:
+    assert '404' in str(e)
+  else:
+    assert False, "no error"
+
+
+class Body(object):
+  " a response the way `DB.rest` returns it unparsed "
+  def __init__(self, data, status=200):
+    self.data, self.status = data, status
+
+def test_read_ahead():
+  " chunks move toward target_ms, at most doubling or halving, capped by max_bytes "
+  sizer = ChunkSizer(100, target_ms=250)
+  sizer.update(100, 50.0, 8000)
+  assert sizer.chunk == 200
+  sizer.update(200, 1000.0, 16000)
+  assert sizer.chunk == 100
+  sizer = ChunkSizer(100, target_ms=250, max_bytes=4000)
+  sizer.update(100, 50.0, 8000)
+  assert sizer.chunk == 50
+  sizer = ChunkSizer(100)
+  sizer.update(100, 5000.0, 8000)
+  assert sizer.chunk == 100
+
+  sdb, asked = DB(HOST, PORT, STORE, DBN, S), []
+  def rest(method, uri, data=None, **kwargs):
+    asked.append((data['offset'], data['limit']))
+    es = range(data['offset'], min(data['offset'] + data['limit'], 250))
+    return Body('[%s]' % ' '.join(
+      '{:e %i :a 63 :v %i :tx 13194139534313 :added true}' % (e, e) for e in es))
+  sdb.rest = rest
+  assert [d['e'] for d in sdb.datoms('aevt', chunk=40, prefetch=2)] == range(250)
+  assert [o for o, l in asked] == range(0, 250, 40) + [250]
+  assert len(list(sdb.datoms('aevt', chunk=40, limit=90, prefetch=2))) == 90
+
+  " errors on the worker surface in the caller "
+  def fails():
+    yield 1
+    raise ValueError("bad chunk")
+  got = []
+  try:
+    for x in iter_ahead(Executor(1), fails()): got.append(x)
+  except ValueError, e:
+    assert got == [1] and 'bad chunk' in str(e)
+  else:
+    assert False, "no error"
+
+
+class ChunkServer(object):
+  """ Serves -/datoms chunks from a list of datoms the way the peer
+  does: sorted by index, filtered by the bound components, `start` as a
+  lower value bound of the avet index only, then `offset` and `limit`.
+  """
+  executor = None
+
+  def __init__(self, datoms, honour_start=True):
+    self.datoms, self.honour_start = datoms, honour_start
+
+  def datom_chunk(self, data):
+    order = dict(eavt='eav', aevt='aev', avet='ave')[data['index']]
+    rs = sorted(self.datoms, key=lambda d: tuple(d[c] for c in order) + (d['tx'],))
+    if data['a']: rs = [d for d in rs if ':' + d['a'] == data['a']]
+    if data['e']: rs = [d for d in rs if d['e'] == data['e']]
+    if data['index'] == 'avet' and data['start'] and self.honour_start:
+      start = [d['v'] for d in rs if str(d['v']) == data['start']][0]
+      rs = [d for d in rs if d['v'] >= start]
+    rs = rs[data['offset']:data['offset'] + data['limit']]
+    return rs, 1.0, 100
+
+def scan_data(index, a=''):
+  return dict(index=index, e='', a=a and ':' + a, v='', offset=0, start='', limit=0)
+
+def test_cursor():
+  datoms = [dict(e=e, a=a, v=e % 7, tx=1, added=True)
+            for e in range(1, 40) for a in ('person/age', 'person/strs')]
+  for index, a in (('eavt', ''), ('aevt', 'person/age'), ('avet', 'person/age')):
+    src  = ChunkServer(datoms)
+    want = src.datom_chunk(dict(scan_data(index, a), limit=1000))[0]
+    cur  = DatomCursor(src, scan_data(index, a), ChunkSizer(5))
+    assert list(cur) == want, index
+
+    " resume from a token mid scan "
+    cur, got = DatomCursor(src, scan_data(index, a), ChunkSizer(5)), []
+    for d in cur:
+      got.append(d)
+      if len(got) == 12: break
+    got += list(DatomCursor.load(src, cur.token, ChunkSizer(5)))
+    assert got == want, index
+
+  " limit counts datoms after offset, paging by cursor or not "
+  sdb = DB(HOST, PORT, STORE, DBN, S)
+  sdb.datom_chunk = ChunkServer(datoms).datom_chunk
+  want = list(sdb.datoms('avet', a='person/age', chunk=4))
+  for cursor in (None, True):
+    got = sdb.datoms('avet', a='person/age', offset=10, limit=15, chunk=4, cursor=cursor)
+    assert list(got) == want[10:25], cursor
+
+  " a limited scan used up stays used up when resumed "
+  cur = sdb.datoms('avet', a='person/age', limit=3, chunk=2, cursor=True)
+  assert list(cur) == want[:3] and cur.left == 0
+  assert list(sdb.datoms(cursor=cur.token)) == []
+  cur = sdb.datoms('avet', a='person/age', chunk=2, cursor=True)
+  for d in cur: break
+  assert cur.left is None and len(list(sdb.datoms(cursor=cur.token))) == len(want) - 1
+
+  " a peer ignoring start would repeat datoms "
+  cur = DatomCursor(ChunkServer(datoms, honour_start=False),
+                    scan_data('avet', 'person/age'), ChunkSizer(5))
+  try:
+    list(cur)
+  except Exception, e:
+    assert 'did not move past' in str(e)
+  else:
+    assert False, "no progress check"
+
+
+def test_vector_reader():
+  " elements are the same whatever way the text is split "
+  want = loads(DATOMS)
+  for size in (1, 2, 3, 7, 64, len(DATOMS)):
+    chunks = [DATOMS[i:i + size] for i in range(0, len(DATOMS), size)]
+    assert list(iter_vector(chunks, loads_datom)) == want, size
+    assert list(iter_vector(chunks)) == want, size
+  chunks = [ROWS[i:i + 5] for i in range(0, len(ROWS), 5)]
+  assert list(iter_vector(chunks, loads_row)) == loads(ROWS)
+
+  " scalars, tagged values and strings with escapes "
+  text = u'[1 "a \\"]\\" b" :k #inst "2013-11-09T18:55:56.657-00:00" nil]'
+  for size in (1, 4, len(text)):
+    rd, got = VectorReader(), []
+    for i in range(0, len(text), size):
+      got += rd.feed(text[i:i + size])
+    assert got == loads(text), size
+    assert rd.done
+
+  " comments are skipped "
+  rd = VectorReader()
+  assert [x for c in u'[1 ; not ] this\n 2]' for x in rd.feed(c)] == [1, 2]
+
+  " text after the closing bracket is ignored "
+  rd = VectorReader()
+  assert rd.feed(u'[1 2] [3]') == [1, 2]
+  assert rd.feed(u'[4]') == []
+
+
+def test_tx_encoder():
+  enc = TxEncoder(Schema(S), fallback=dump_edn_val)
+  uid = u'#db/id[:db.part/user %i]'
+
+  " one map per entity, interleaved or not, cardinality many values as a vector "
+  edn = enc.encode([(-1, ':person/name',  'Bob'),
+                    (-1, ':person/likes', 17592186045418),
+                    (-1, ':person/age',   42),
+                    (-2, ':item/amt',     1.5),
+                    (-1, ':person/likes', 17592186045419),
+                    (-1, ':person/email', 'bob@example.com')])
+  assert edn == u' '.join([
+    u'{:db/id %s :person/name "Bob" :person/likes [17592186045418 17592186045419] '
+    u':person/age 42 :person/email "bob@example.com"}' % (uid % -1),
+    u'{:db/id %s :item/amt 1.5}' % (uid % -2)])
+  assert enc.encode([(-1, ':person/likes', 5)]) == \
+         u'{:db/id %s :person/likes [5]}' % (uid % -1)
+
+  " repeated values of a cardinality one attribute are :db/add lists "
+  edn = enc.encode([(-1, ':person/name', 'Bob'), (-1, ':person/name', 'Robert'),
+                    (-1, ':person/name', 'Rob')])
+  assert edn == u'{:db/id %s :person/name "Bob"} [:db/add %s :person/name "Robert"] ' \
+                u'[:db/add %s :person/name "Rob"]' % ((uid % -1,) * 3)
+
+  " adds interleaved the way TX is used, entity by entity "
+  tx = TX(DB(HOST, PORT, STORE, DBN, S))
+  person = tx.add('person/', {'name': 'Bob', 'age': 42})
+  item   = tx.add('item/', {'amt': 1.5})
+  person.add('person/email', 'bob@example.com')
+  tx.add(person, 'person/likes', item)
+  first, second = tx.edn().split('} ')
+  assert first.startswith(u'{:db/id %s ' % (uid % -1)) and ':person/email' in first
+  assert first.endswith(u':person/likes [%s]' % (uid % -2))
+  assert second == u'{:db/id %s :item/amt 1.5}' % (uid % -2)
+
+  " values of an unexpected type, and unknown attributes, use the fallback "
+  edn = enc.encode([(-1, ':person/age', u'42'), (-1, ':other/attr', u'x')])
+  assert edn == u'{:db/id %s :person/age "42" :other/attr "x"}' % (uid % -1)
+
+
+""" responses as the peer sends them, utf-8 bytes
+"""
+DATOMS = """[{:e 17592186045418 :a 63 :v "John \\"Jr\\" Doe" :tx 13194139534313 :added true}
+ {:e 17592186045418, :a 64, :v 25, :tx 13194139534313, :added false}
+ {:e 17592186045419 :a 65 :v 1.5 :tx 13194139534313 :added true}
+ {:e 17592186045419 :a 66 :v :item.cat/dog :tx 13194139534313 :added true}
+ {:e 17592186045419 :a 67 :v nil :tx 13194139534313 :added true}
+ {:e 17592186045420 :a 68 :v #inst "2013-11-09T18:55:56.657-00:00" :tx 13194139534313 :added true}
+ {:e 17592186045420 :a 69 :v "Ünïcode, [brackets] {braces}" :tx 13194139534313 :added true}]"""
+
+ROWS = """[[17592186045418 "John Doe" 25 :person/name]
+ [17592186045419 "a\\nb" -3.25 true]
+ [17592186045420 "" -7 nil]]"""
+
+def test_loads_fast():
+  " the fast decoders read the common shapes exactly like clj.loads "
+  assert loads_datoms(DATOMS) == loads(DATOMS)
+  assert loads_rows(ROWS) == loads(ROWS)
+  assert loads_datoms(DATOMS)[-1]['v'] == u'\xdcn\xefcode, [brackets] {braces}'
+  assert loads(DATOMS)[-1]['v'] == u'\xdcn\xefcode, [brackets] {braces}'
+  assert loads_datoms(u'[]') == loads(u'[]')
+  assert loads_row(u'[1 "a" :k]') == loads(u'[1 "a" :k]')
+
+  " other shapes fall back to clj.loads "
+  for text in (u'[{:e 1 :a 2 :v {:nested 1} :tx 3 :added true}]',
+               u'[[1 #{:a :b}]]',
+               u'[[1 [2 3]]]',
+               u'[(1 2)]',
+               u'{:basis-t 1042 :db/alias "mem/test"}',
+               u'[{:e 1 :a 2 :v #uuid "5fb3b7c4-0000-0000-0000-000000000000"}]',
+               '[[1 #{"\xc3\xbcber"}]]'):
+    assert loads_datoms(text) == loads(text), text
+    assert loads_rows(text) == loads(text), text
+
+  " decoding threads clearing a full keyword cache under each other "
+  import edn
+  text = u'[%s]' % u' '.join(u'[%i :k/a%i nil false]' % (i, i) for i in range(200))
+  want, errors, size = loads(text), [], edn.CACHE_MAX
+  def decode():
+    try:
+      for i in range(20): assert loads_rows(text) == want
+    except Exception, e:
+      errors.append(e)
+  edn.CACHE_MAX = 8
+  try:
+    threads = [threading.Thread(target=decode) for i in range(4)]
+    for t in threads: t.start()
+    for t in threads: t.join()
+  finally:
+    edn.CACHE_MAX = size
+  assert errors == []
+
+
+def test_datom_block():
+  datoms = [dict(e=17592186045418 + i, a=64, v=20 + i, tx=13194139534313, added=i != 3)
+            for i in range(10)]
+  block = DatomBlock(datoms, ':db.type/long')
+  assert len(block) == 10 and block.v.typecode in ('q', 'l')
+  assert [d.asdict() for d in block] == datoms
+  assert block[-1]['v'] == 29 and block[3].added is False
+  try:
+    block[10]
+  except IndexError:
+    pass
+  else:
+    assert False, "row past the end"
+
+  " types inferred without a valueType, a list when mixed "
+  assert DatomBlock([dict(datoms[0], v=1.5)]).v.typecode == 'd'
+  assert DatomBlock([dict(datoms[0], v=2 ** 64)]).v == [2 ** 64]
+  assert DatomBlock([dict(datoms[0], v=u'x'), dict(datoms[1], v=2)]).v == [u'x', 2]
+  assert DatomBlock([dict(datoms[0], v=u'x')], ':db.type/long').v == [u'x']
+  assert len(DatomBlock([])) == 0
+
+  try:
+    import numpy
+  except ImportError:
+    return
+  cols = block.to_numpy()
+  assert cols['e'].dtype == numpy.int64 and list(cols['v']) == range(20, 30)
+  assert list(cols['added']) == [i != 3 for i in range(10)]
+  assert cols['v'].dtype == numpy.int64
+  assert DatomBlock([dict(datoms[0], v=u'x')]).to_numpy()['v'].dtype == object
+
+
+def test_columns():
+  assert find_vars('[:find ?e ?n :in $ ?x :where [?e :person/name ?n]]') == ['?e', '?n']
+  assert find_vars('[:find ?a (count ?e) (max 3 ?a) (pull ?e [*]) :with ?x :where '
+                   '[?e :person/age ?a]]') == \
+         ['?a', ['count', '?e'], ['max', 3, '?a'], ['pull', '?e', ['*']]]
+  assert find_vars('[:find [?e ...] :where [?e :person/age 3]]') == ['?e']
+  assert find_vars('[:find ?e . :where [?e :person/age 3]]') == ['?e']
+  assert find_vars('[:where [?e :person/age 3]]') == []
+
+  " a value a typed column can't hold turns it back into python objects "
+  when = loads('#inst "2013-11-09T18:55:56.657-00:00"')
+  for vtype, categorical, vs in ((':db.type/instant', False, [when, when, None]),
+                                 (':db.type/boolean', False, [True, False, u'x']),
+                                 (':db.type/string',  True,  [u'Ann', u'Bob', [u'x']])):
+    col = Column(vtype, categorical)
+    for v in vs: col.append(v)
+    assert col.values == vs and col.code is None, vtype
+
+  try:
+    import numpy
+  except ImportError:
+    return
+  schema = Schema(S)
+  q = '[:find ?e ?n ?a ?w :where [?e :person/name ?n] [?e :person/age ?a] ' \
+      '[?o :order/date ?w]]'
+  rows = [[1, u'Ann', 31, when], [2, u'Bob', 25, when]]
+  cols = to_columns(q, rows, schema)
+  assert cols.keys() == ['e', 'n', 'a', 'w']
+  assert cols['e'].dtype == numpy.int64 and list(cols['a']) == [31, 25]
+  assert cols['n'].dtype == object and list(cols['n']) == [u'Ann', u'Bob']
+  assert str(cols['w'][0]) == '2013-11-09T18:55:56.657000'
+
+  " categorical strings "
+  cols = to_columns(q, rows + [[3, u'Ann', 5, when]], schema, categorical=True)
+  assert isinstance(cols['n'], Categorical)
+  assert list(cols['n'].categories[cols['n'].codes]) == [u'Ann', u'Bob', u'Ann']
+
+  " aggregates get their own names and types "
+  q = '[:find ?n (count ?e) (avg ?a) (max ?a) (pull ?e [*]) :where ' \
+      '[?e :person/name ?n] [?e :person/age ?a]]'
+  cols = to_columns(q, [[u'Ann', 2, 28.5, 31, {'db/id': 1}]], schema)
+  assert cols.keys() == ['n', 'count_e', 'avg_a', 'max_a', 'pull_e']
+  assert [cols[k].dtype for k in ('count_e', 'avg_a', 'max_a', 'pull_e')] == \
+         [numpy.int64, numpy.float64, numpy.int64, object]
+
+  " empty results are typed all the same "
+  cols = to_columns(q, [], schema)
+  assert cols.keys() == ['n', 'count_e', 'avg_a', 'max_a', 'pull_e']
+  assert [len(c) for c in cols.values()] == [0] * 5
+  assert [cols[k].dtype for k in ('count_e', 'avg_a', 'max_a')] == \
+         [numpy.int64, numpy.float64, numpy.int64]
+
+  " untyped numbers, nils, and rows unlike the find spec "
+  cols = to_columns('[:find ?x ?y :in $ [[?x ?y]]]', [[1, None], [2, 2.5]])
+  assert cols['x'].dtype == numpy.int64 and cols['y'].dtype == object
+  assert to_columns('[:find ?x]', [[1, 2]]).keys() == ['0', '1']
+
+
+class Transactor(object):
+  """ Stands in for `DB.tx` in bulk loads: gives every tempid of a
+  transaction the next entity id, keeps the tx-data it was sent, and
+  fails the transactions numbered in `fail`.
+  """
+
+  def __init__(self, fail=()):
+    self.lock, self.sent, self.fail, self.next = threading.Lock(), [], fail, 17592186045418
+
+  def __call__(self, edn, **kwargs):
+    with self.lock:
+      if len(self.sent) in self.fail:
+        self.sent.append(None)
+        raise Exception("transactor unavailable")
+      self.sent.append(edn)
+      tempids = {}
+      for t in sorted(set(int(t) for t in re.findall(r'#db/id\[:db.part/user (-\d+)\]', edn)),
+                      reverse=True):
+        tempids[internal_tempid(t)], self.next = self.next, self.next + 1
+      return {'tempids': tempids, 'tx-data': [{'tx': 13194139534313 + len(self.sent)}]}
+
+def load_people(bl):
+  """ five people, a review of the first by each of the others, and a
+  late change to the first; 19 datoms """
+  people = [bl.add('person/', {'name': u'P%i' % i, 'age': i}) for i in range(5)]
+  for i in range(1, 5):
+    bl.add('review/', {'user': people[0], 'strs': i})
+  bl.add(people[0], 'person/age', 99)
+  return people
+
+def refs(sent, e):
+  " times an entity id is sent in tx-data "
+  return sum(len(re.findall(r'\b%i\b' % e.eid, edn)) for edn in sent if edn)
+
+def test_bulk_loader():
+  tmp = tempfile.mkdtemp()
+  try:
+    " batches of max_datoms or more, sent once they fill up "
+    bdb = DB(HOST, PORT, STORE, DBN, S)
+    bdb.tx = Transactor()
+    bl = BulkLoader(bdb, max_datoms=3, inflight=2)
+    people = load_people(bl)
+    stats = bl.finish()
+    assert (stats['batches'], stats['datoms'], stats['skipped']) == (5, 19, 0)
+    assert len(bdb.tx.sent) == 5 and stats['inflight'] == 0
+    assert len(set(p.eid for p in people)) == 5 and all(p.eid > 0 for p in people)
+
+    " entities of earlier batches are referenced and added to by their ids "
+    assert refs(bdb.tx.sent, people[0]) == 5
+
+    " max_bytes bounds a batch too "
+    bdb.tx = Transactor()
+    with BulkLoader(bdb, max_datoms=1000, max_bytes=40) as bl:
+      load_people(bl)
+    assert len(bdb.tx.sent) == 10
+
+    " a failed load resumes from its state, committed batches skipped "
+    state = os.path.join(tmp, 'load.json')
+    bdb.tx = Transactor(fail=(2,))
+    bl = BulkLoader(bdb, max_datoms=3, inflight=1, state=state)
+    try:
+      load_people(bl)
+      bl.finish()
+    except Exception, e:
+      assert 'unavailable' in str(e)
+    else:
+      assert False, "failed batch"
+    saved = json.load(open(state))['batches']
+    assert sorted(saved) == ['0', '1']
+    first = [saved[b][t] for b in '01' for t in ('-1', '-2')]
+
+    bdb.tx = Transactor()
+    bdb.tx.next = 17592186046000
+    bl = BulkLoader(bdb, max_datoms=3, inflight=1, state=state)
+    again = load_people(bl)
+    stats = bl.finish()
+    assert (stats['batches'], stats['skipped']) == (3, 2)
+    assert [p.eid for p in again[:4]] == first and again[4].eid == 17592186046000
+    assert refs(bdb.tx.sent, again[0]) == 5
+    assert sorted(json.load(open(state))['batches']) == map(str, range(5))
+  finally:
+    shutil.rmtree(tmp)
+
+def internal_tempid(index, part=5):
+  " a tempid as the peer reports it, partition above bit 42 "
+  return -2**63 + part * 2**42 + index
+
+def test_tempids():
+  assert tempid_index(internal_tempid(-1)) == -1
+  assert tempid_index(internal_tempid(-1000, part=0)) == -1000
+  assert tempid_index(internal_tempid(-7, part=123)) == -7
+  assert tempid_index(-3) == -3
+
+  " every E of a tempid, and every existing E added to, is resolved "
+  tx = TX(db)
+  person = tx.add('person/', {'name': 'Offline', 'age': 1})
+  item   = tx.add('item/name', 'Offline Item')
+  tx.add(person, 'person/likes', item)
+  known  = tx.add(E(17592186045400, db=db), 'person/likes', item)
+  tx.resp = {'tempids': {internal_tempid(int(person)): 17592186045418,
+                         internal_tempid(int(item)):   17592186045419},
+             'tx-data': [{'tx': 13194139534313}]}
+  tx.resolve()
+  assert (person.eid, item.eid) == (17592186045418, 17592186045419)
+  assert person._txid == item._txid == known._txid == 13194139534313
+  assert known.eid == 17592186045400
+
+  " each E is tracked once, however many datoms it has "
+  tx = TX(db)
+  person = tx.add('person/', dict(('name%i' % i, u'x') for i in range(500)))
+  known  = [tx.add(17592186045400, 'person/age', i) for i in range(2)]
+  assert tx.add(known[0], 'person/age', 5) is known[0]
+  assert len(tx) == 503
+  assert tx.tmpents == {int(person): [person]} and len(tx.realents[17592186045400]) == 2
+
+  " a tempid missing from the response is an error "
+  tx = TX(db)
+  person = tx.add('person/name', 'Offline')
+  tx.resp = {'tempids': {}, 'tx-data': [{'tx': 13194139534313}]}
+  try:
+    tx.resolve()
+  except Exception, e:
+    assert 'missing' in str(e)
+  else:
+    assert False, "unresolved tempid"
+
+
+def test_attribute_registry():
+  rdb, basis, asked = DB(HOST, PORT, STORE, DBN), [1000], []
+  def info():
+    asked.append(basis[0])
+    return {'basis-t': basis[0]}
+  rdb.info   = info
+  rdb.datoms = lambda index, a='', **kwargs: iter([{'e': 63, 'v': 63}])
+  attrs = [Attribute(62, u':person/name', u':db.type/string', u':db.cardinality/one', None, False)]
+  reg = AttributeRegistry(rdb)
+  reg.fetch = lambda ids=None: iter(attrs)
+  assert reg.ident(62) == u':person/name' and reg.value_type('person/name') == u':db.type/string'
+  assert len(asked) == 1
+
+  " keys that are never attributes are not looked up "
+  assert reg.get('db/id') is None and len(asked) == 1
+
+  " an unknown key refreshes once, then waits for basis-t to move "
+  assert reg.get('person/age') is None and len(asked) == 2
+  assert reg.get('person/age') is None and len(asked) == 2
+  reg.poll_ms = 0
+  assert reg.get('person/age') is None and len(asked) == 3
+  basis[0] = 1001
+  attrs.append(Attribute(63, u':person/age', u':db.type/long', u':db.cardinality/one', None, False))
+  assert reg.get('person/age').id == 63 and len(asked) == 4
+
+
+def test_query_cache():
+  cdb, calls, basis = DB(HOST, PORT, STORE, DBN, S, cache=QueryCache(maxsize=2)), [], [1000]
+  def rest(method, uri, data=None, **kwargs):
+    calls.append(data['q'])
+    return Body('[[1 2 3]]')
+  cdb.rest = rest
+  cdb.info = lambda: {'basis-t': basis[0]}
+  cdb.cache.poll_ms = 0
+  q = '[:find ?e ?a ?v :where [?e ?a ?v]]'
+
+  " a miss fetches, a hit of the same query in other whitespace does not "
+  assert cdb.q(q) == [[1, 2, 3]]
+  assert cdb.q('[:find ?e ?a ?v\n :where [?e ?a ?v]]') == [[1, 2, 3]]
+  assert len(calls) == 1
+  assert cdb.cache.stats()['hits'] == 1 and cdb.cache.stats()['misses'] == 1
+
+  " changing a returned row leaves the cached one alone "
+  cdb.q(q)[0].append(99)
+  assert cdb.q(q) == [[1, 2, 3]]
+  assert len(calls) == 1
+
+  " a new basis-t makes the entry stale, as-of results never are "
+  basis[0] = 1001
+  assert cdb.q(q) == [[1, 2, 3]]
+  assert len(calls) == 2 and cdb.cache.stats()['stale'] == 1
+  cdb.q(q, as_of=900) ; basis[0] = 1002 ; cdb.q(q, as_of=900)
+  assert len(calls) == 3
+
+  " cache=False always fetches, clear drops everything "
+  cdb.q(q, as_of=900, cache=False)
+  assert len(calls) == 4
+  cdb.cache.clear()
+  cdb.q(q, as_of=900)
+  assert len(calls) == 5
+
+  " a cache shared by two databases keeps their results apart "
+  odb = DB(HOST, PORT, STORE, 'other', S, cache=cdb.cache)
+  odb.rest = lambda method, uri, data=None, **kwargs: Body('[[4 5 6]]')
+  assert odb.q(q, as_of=900) == [[4, 5, 6]]
+  assert cdb.q(q, as_of=900) == [[1, 2, 3]] and len(calls) == 5
+
+  " least recently used entries go past maxsize, and past max_bytes "
+  qc = QueryCache(maxsize=2, max_bytes=10)
+  for i in range(3): qc.put(i, 1, [[i]], 3)
+  assert (qc.get(0, 1), qc.get(2, 1)) == (None, [[2]])
+  assert qc.stats()['evictions'] == 1
+  qc.put(3, 1, [[3]], 8)
+  assert len(qc) == 1 and qc.nbytes == 8
+  qc.put(4, 1, [[4]], 11)
+  assert qc.get(4, 1) is None
+
+
+def test_prepared_query():
+  pdb, calls = DB(HOST, PORT, STORE, DBN, S), []
+  def q(query, inputs=None, **kwargs):
+    calls.append((query, inputs, kwargs))
+    return [[1]]
+  pdb.q = q
+  find = lambda n, a: pdb.find('?e').where('?e :person/name ?n', '?e :person/age ?a') \
+                         .param('?n', n, '?a', a).limit(10)
+  pq = find('Bob', 25).prepare()
+  assert pq.names == ('n', 'a') and pq.q == find('Bob', 25)._toedn()[0]
+
+  " by position, by name, the rest bound when prepared "
+  pq.execute('Ann') ; pq.execute(a=30) ; pq.execute('Ann', 31) ; pq.execute()
+  assert [c[1] for c in calls] == [['"Ann"', '25'], ['"Bob"', '30'],
+                                   ['"Ann"', '31'], ['"Bob"', '25']]
+  assert all(c[0] == pq.q and c[2]['limit'] == 10 for c in calls)
+
+  " unknown names and extra positions are refused "
+  for args, params in (((), {'x': 1}), ((1, 2, 3), {})):
+    try:
+      pq.execute(*args, **params)
+    except Exception, e:
+      assert 'input' in str(e)
+    else:
+      assert False, "bad inputs accepted"
+  try:
+    pq.limit = 5
+  except AttributeError:
+    pass
+  else:
+    assert False, "prepared query changed"
+
+  " the same shape reuses the compiled query, with its own defaults "
+  again = find('Carol', 40).prepare()
+  assert again.q is pq.q and again.defaults == ('Carol', 40)
+
+
+def test_query_pages():
+  datoms = [dict(e=e, a='person/age', v=e % 7, tx=1, added=True) for e in range(1, 26)]
+  src, asked, basis = ChunkServer(datoms), [], [1000]
+  qdb = DB(HOST, PORT, STORE, DBN, S)
+  def q(query, inputs=None, limit='', offset='', as_of=None, **kwargs):
+    asked.append((offset, limit, as_of))
+    rs = src.datom_chunk(dict(scan_data('aevt', 'person/age'), offset=offset, limit=limit))[0]
+    return [[d['e'], d['v']] for d in rs]
+  qdb.q    = q
+  qdb.info = lambda: {'basis-t': basis[0]}
+  query = qdb.find('?e ?a').where('?e :person/age ?a')
+  want  = [[e, e % 7] for e in range(1, 26)]
+
+  " pages stop on a short one "
+  assert list(query.iter(page_size=10, prefetch=0)) == want
+  assert asked == [(0, 10, 1000), (10, 10, 1000), (20, 10, 1000)]
+
+  " every page reads the db as of the first one "
+  del asked[:]
+  pages = query.pages(page_size=10)
+  assert len(next(pages)) == 10
+  basis[0] = 1001
+  assert sum(len(rs) for rs in pages) == 15
+  assert [t for o, l, t in asked] == [1000] * 3
+
+  " offset and limit bound the rows, read ahead or not "
+  for prefetch in (0, 2):
+    del asked[:]
+    rows = query.offset(5).limit(12).iter(page_size=5, prefetch=prefetch)
+    assert list(rows) == want[5:17]
+    assert [(o, l) for o, l, t in asked] == [(5, 5), (10, 5), (15, 2)]
+
+
+class FakePeer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+  """ A local HTTP/1.1 server answering GETs with `answer(path)`, a
+  (status, body) or (status, body, headers) tuple, and keeping the
+  paths it was asked for and the headers and body of each request.
+  """
+  daemon_threads = True
+
+  class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+      sent = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+      self.server.paths.append(self.path)
+      self.server.requests.append((self.headers, sent))
+      answer = self.server.answer(self.path)
+      status, body, headers = answer if len(answer) == 3 else answer + ({},)
+      " in one write, so the body arrives with the headers "
+      self.wfile.write('HTTP/1.1 %i %s\r\n%sContent-Length: %i\r\n\r\n%s' % (
+        status, self.responses[status][0],
+        ''.join('%s: %s\r\n' % h for h in headers.items()), len(body), body))
+
+    do_POST = do_GET
+
+    def log_message(self, *args):
+      pass
+
+  def __init__(self, answer):
+    BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0), self.Handler)
+    self.answer, self.paths, self.requests = answer, [], []
+    t = threading.Thread(target=self.serve_forever)
+    t.daemon = True
+    t.start()
+
+  @property
+  def address(self):
+    return '127.0.0.1:%i' % self.server_address[1]
+
+
+INFO = (200, '{:db/alias "mem/x" :basis-t 1042}')
+
+
+def test_peer_pool():
+  up, down = FakePeer(lambda path: INFO), FakePeer(lambda path: (503, 'overloaded'))
+  try:
+    " round-robin over healthy peers "
+    other = FakePeer(lambda path: INFO)
+    pool  = PeerPool([up.address, other.address], retries=0)
+    for i in range(4): assert pool.request_encode_body('GET', '/data/').status == 200
+    assert (len(up.paths), len(other.paths)) == (2, 2)
+    other.shutdown()
+
+    " a 503 is retried on the next peer, the connection to it reused "
+    pool = PeerPool([down.address, up.address], backoff=0, maxsize=1, eject_after=100)
+    for i in range(4):
+      r = pool.request_encode_body('GET', '/data/', preload_content=False)
+      assert (r.status, r.read()) == (200, INFO[1])
+      r.release_conn()
+    assert (len(down.paths), len(up.paths)) == (4, 6)
+    assert [u['connections'] for u in pool.utilization()] == [1, 1]
+
+    " writes are not retried "
+    pool = PeerPool([down.address, up.address], backoff=0)
+    assert pool.request_encode_body('POST', '/data/', fields={}).status == 503
+    assert (len(down.paths), len(up.paths)) == (5, 6)
+
+    " eject_after failures in a row leave a peer out for eject_for seconds "
+    pool = PeerPool([down.address, up.address], retries=0, eject_after=2)
+    statuses = [pool.request_encode_body('GET', '/data/').status for i in range(6)]
+    assert statuses[:4] == [503, 200, 503, 200] and statuses[4:] == [200, 200]
+    assert pool.healthy() == pool.peers[1:] and pool.peers[0].ejected
+    pool.peers[0].ejected -= pool.eject_for
+    assert pool.healthy() == pool.peers
+
+    " a connection error counts as a failure and is retried "
+    pool = PeerPool(['127.0.0.1:1', up.address], backoff=0)
+    assert pool.request_encode_body('GET', '/data/').status == 200
+    assert pool.peers[0].failures == 1
+
+    " check ejects failing peers at once "
+    pool = PeerPool([down.address, up.address])
+    assert pool.check() == pool.peers[1:]
+  finally:
+    up.shutdown()
+    down.shutdown()
+
+
+def test_compression():
+  " gzipped transactions and responses, counted raw and on the wire "
+  tx = '{:db/id #db/id[:db.part/user] :person/name "%s"}' % ('x' * 2000)
+  result = '{:db-after {:basis-t 1043} :tempids {}}'
+  peer = FakePeer(lambda path: (200, gzip_bytes(result), {'Content-Encoding': 'gzip'})
+                  if path == '/data/mem/x/' else INFO)
+  try:
+    cdb = DB(peer.address, None, 'mem', 'x', compress=True, compress_tx=1024)
+    assert cdb.tx(tx) == loads(result)
+    headers, body = peer.requests[-1]
+    assert headers.get('Content-Encoding') == 'gzip'
+    assert 'gzip' in headers.get('Accept-Encoding')
+    assert zlib.decompress(body, 16 + zlib.MAX_WBITS) == urlencode(
+      {'tx-data': '[ %s ]' % tx})
+    last = cdb.traffic.last
+    assert last['sent_raw'] > 2000 and last['sent_wire'] == len(body) < 200
+    assert last['recv_raw'] == len(result) and last['recv_wire'] == len(gzip_bytes(result))
+
+    " reads go as they are, however large "
+    cdb.rest('GET', cdb.uri_db, data={'q': tx}, parse=False)
+    headers, body = peer.requests[-1]
+    assert 'Content-Encoding' not in headers and len(body) > 2000
+    assert cdb.traffic.last['sent_raw'] == cdb.traffic.last['sent_wire'] == len(body)
+    stats = cdb.traffic.stats()
+    assert stats['requests'] == 2
+    assert stats['sent_raw'] == last['sent_raw'] + len(body)
+  finally:
+    peer.shutdown()
+
+
+def test_stats():
+  " latency histograms, errors, hooks and gauges of an instrumented DB "
+  from stats import Histogram, Stats
+  h = Histogram()
+  assert h.percentile(50) is None and h.summary()['mean'] is None
+  for ms in [0.1] * 50 + [3.0] * 40 + [100.0] * 9 + [100000.0]:
+    h.add(ms)
+  assert (h.percentile(50), h.percentile(90), h.percentile(99)) == (0.125, 4.0, 128.0)
+  assert h.percentile(100) == 100000.0
+  s = h.summary()
+  assert (s['count'], s['min'], s['max']) == (100, 0.1, 100000.0)
+  assert abs(s['mean'] - 1010.25) < 1e-6
+
+  st, events = Stats(), []
+  st.hook(events.append)
+  st.hook(lambda ev: 1 / 0)
+  st.gauge('answer', lambda: 42)
+  st.record('q', 'http', 2.0)
+  st.record('q', 'http', 6.0)
+  st.error('q', ValueError('x'))
+  snap = st.snapshot()
+  assert snap['latency']['q']['http']['count'] == 2 and snap['latency']['q']['http']['p50'] == 2.0
+  assert snap['errors'] == {'q': 1} and snap['answer'] == 42
+  assert [ev['phase'] for ev in events] == ['http', 'http', 'error']
+  st.reset()
+  assert st.snapshot()['latency'] == {} and st.snapshot()['errors'] == {}
+
+  result = '{:db-after {:basis-t 1043} :tempids {-9223350046622220289 1001} :tx-data [{:tx 13194139534355}]}'
+  peer = FakePeer(lambda path: (503, 'busy') if path.endswith('-/datoms')
+                  else (200, result) if path == '/data/mem/x/' else INFO)
+  try:
+    sdb = DB(peer.address, None, 'mem', 'x', stats=True, retries=0)
+    assert sdb.info()['basis-t'] == 1042
+    tx = sdb.tx()
+    tx.add('person/name', 'Bob')
+    tx.execute()
+    try:
+      list(sdb.datoms('eavt'))
+    except Exception:
+      pass
+    else:
+      assert False, "no error"
+    snap = sdb.stats.snapshot()
+    assert sorted(snap['latency']['info']) == ['decode', 'encode', 'http']
+    assert sorted(snap['latency']['tx']) == ['build', 'decode', 'encode', 'http']
+    assert snap['errors'] == {'datoms': 1}
+    assert snap['bytes']['requests'] == 3
+    assert snap['pool'][0]['connections'] == 1
+  finally:
+    peer.shutdown()
+
+
+def test_tracer():
+  " nested spans, spans handed to other threads, Chrome trace export "
+  from trace import Tracer
+  tr = Tracer(max_events=6)
+  with tr.span('outer', user=42) as outer:
+    with tr.span('inner') as inner:
+      assert tr.current() == inner.id
+    try:
+      with tr.span('failing'):
+        raise ValueError('boom')
+    except ValueError:
+      pass
+    def child():
+      with tr.span('child') as span:
+        return span.parent
+    ex = Executor(2)
+    assert ex.submit(tr.wrap(child)).result() == outer.id
+    assert ex.submit(tr.current).result() is None
+  assert tr.current() is None
+  events = dict((e['name'], e) for e in tr.events)
+  assert events['inner']['args'] == dict(parent=outer.id, span=inner.id)
+  assert events['failing']['args']['error'] == "ValueError('boom',)"
+  assert events['outer']['args'] == dict(user=42, span=outer.id)
+  assert events['child']['args'] == dict(parent=outer.id, span=events['child']['args']['span'])
+  assert events['child']['tid'] != events['outer']['tid']
+  assert events['outer']['dur'] >= events['inner']['dur']
+
+  for i in range(4): tr.complete('filler', 0, 0)
+  assert len(tr.events) == 6 and tr.dropped == 2
+  path = os.path.join(tempfile.mkdtemp(), 'trace.json')
+  try:
+    tr.export(path)
+    trace = json.load(open(path))
+  finally:
+    shutil.rmtree(os.path.dirname(path))
+  assert trace['otherData'] == {'dropped': 2}
+  assert len([e for e in trace['traceEvents'] if e['ph'] == 'M']) == 2
+  assert len([e for e in trace['traceEvents'] if e['ph'] == 'X']) == 6
+  tr.clear()
+  assert (tr.events, tr.dropped) == ([], 0)
+
+  " async requests run under the span they were submitted from "
+  result = '{:db-after {:basis-t 1043} :tempids {-9223350046622220289 1001} :tx-data [{:tx 13194139534355}]}'
+  peer = FakePeer(lambda path: (200, '[[1001]]') if path == '/api/query'
+                  else (200, result) if path == '/data/mem/x/' else INFO)
+  try:
+    adb = AsyncDB(peer.address, None, 'mem', 'x', tracer=True, workers=2)
+    tr = adb.sync.tracer
+    with tr.span('page') as page:
+      assert adb.find('?e').where('?e :person/name "Bob"').all().result() == [[1001]]
+      assert adb.info().result()['basis-t'] == 1042
+      tx = adb.tx()
+      tx.add('person/name', 'Bob')
+      tx.execute().result()
+    events = dict((e['name'], e) for e in tr.events)
+    assert sorted(events) == ['info.decode', 'info.encode', 'info.http', 'page',
+                              'q', 'q.compile', 'q.decode', 'q.encode', 'q.http',
+                              'tx.build', 'tx.decode', 'tx.encode', 'tx.http']
+    assert events['tx.http']['args']['parent'] == page.id
+    q = events['q']['args']
+    assert q['parent'] == page.id and q['rows'] == 1
+    assert events['q.http']['args']['parent'] == q['span']
+    assert events['info.http']['args']['parent'] == page.id
+    assert events['q']['tid'] != events['page']['tid']
+  finally:
+    peer.shutdown()
+
+  " bytes of a streamed response are counted as it is read "
+  rows = gzip_bytes('[%s]' % ' '.join('[%i "row %i"]' % (i, i) for i in range(500)))
+  peer = FakePeer(lambda path: (200, rows, {'Content-Encoding': 'gzip'})
+                  if path == '/api/query' else INFO)
+  try:
+    tdb = DB(peer.address, None, 'mem', 'x', compress=True, tracer=True)
+    assert len(list(tdb.q('[:find ?e ?n :where [?e :person/name ?n]]', stream=True))) == 500
+    events = dict((e['name'], e['args']) for e in tdb.tracer.events)
+    assert 'received' not in events['q.http']
+    assert events['q.decode']['received'] == len(rows) == tdb.traffic.last['recv_wire']
+    assert events['q.decode']['bytes'] == tdb.traffic.last['recv_raw'] > len(rows)
+  finally:
+    peer.shutdown()
+
+
+class TxLog(object):
+  """ A database as `Replica` reads it: its transactions, each a list
+  of (e, a, v, added), tx ids equal to their basis-t.
+  """
+
+  def __init__(self, *txs):
+    self.txs = list(txs)
+
+  def basis_t(self):
+    return len(self.txs)
+
+  def datoms(self, index, since=None, as_of=None, history=False, **kwargs):
+    rs = [dict(e=e, a=a, v=v, tx=t, added=added)
+          for t, tx in enumerate(self.txs[:as_of], 1) for e, a, v, added in tx
+          if t > (since or 0)]
+    if history: return rs
+    state = {}
+    for d in rs: state[d['e'], d['a'], d['v']] = d
+    return sorted((d for d in state.values() if d['added']),
+                  key=lambda d: (d['e'], d['a'], d['v']))
+
+
+SCHEMA = [(10, 10, u':db/ident', True), (13, 10, u':db.install/attribute', True),
+          (40, 10, u':db/valueType', True), (41, 10, u':db/cardinality', True),
+          (20, 10, u':db.type/ref', True), (21, 10, u':db.type/string', True),
+          (22, 10, u':db.cardinality/one', True), (23, 10, u':db.cardinality/many', True),
+          (63, 10, u':person/name', True), (63, 40, 21, True), (63, 41, 22, True),
+          (64, 10, u':person/likes', True), (64, 40, 20, True), (64, 41, 23, True),
+          (0, 13, 63, True), (0, 13, 64, True)]
+
+
+def test_segment():
+  tmp = tempfile.mkdtemp()
+  try:
+    " merged runs read back in every index's order, values as written "
+    when = loads('#inst "2013-11-09T18:55:56.657-00:00"')
+    values = [u'b', 2, 1.1, True, None, when, uuid.UUID(int=5),
+              decimal.Decimal('1.50'), u'\xdcn\xefcode', 2 ** 62]
+    datoms = [(100 - i, 60 + i, v, 1000 + i, True) for i, v in enumerate(values)]
+    datoms += [(90, 60, u'a', 1100, True), (80, 60, u'c', 1101, True)]
+    write_segment(os.path.join(tmp, 'seg'), iter(datoms), run=3)
+    seg = Segment(os.path.join(tmp, 'seg'))
+    assert len(seg) == len(datoms)
+    assert sorted(os.listdir(seg.path)) == ['aevt', 'avet', 'eavt', 'values']
+    for name, order in INDEXES.items():
+      got = [seg.datom(name, i) for i in range(len(seg))]
+      assert [tuple(d[c] for c in order) for d in got] == \
+             sorted(tuple(d[c] for c in order) for d in datoms), name
+    got = dict((d[0], d[2]) for d in seg.scan('eavt', ()))
+    assert [got[100 - i] for i in range(len(values))] == values
+    assert got[100 - 5].microsecond == 657000
+    assert type(got[100 - 7]) is decimal.Decimal and str(got[100 - 7]) == '1.50'
+
+    " scans by prefix "
+    assert [d[0] for d in seg.scan('aevt', (60,))] == [80, 90, 100]
+    assert [d[2] for d in seg.scan('avet', (60,))] == [u'a', u'b', u'c']
+    assert list(seg.scan('avet', (60, u'b'))) == [(100, 60, u'b', 1000, True)]
+    assert list(seg.scan('eavt', (7,))) == []
+
+    " an empty segment "
+    write_segment(os.path.join(tmp, 'empty'), [])
+    assert len(Segment(os.path.join(tmp, 'empty'))) == 0
+  finally:
+    shutil.rmtree(tmp)
+
+
+def test_replica():
+  tmp = tempfile.mkdtemp()
+  try:
+    log = TxLog(SCHEMA, [(1000, 63, u'Ann', True), (1001, 63, u'Bob', True),
+                         (1000, 64, 1001, True)])
+    rep = Replica(tmp, log, max_deltas=2, run=4)
+    assert not rep.holds('person/name')
+    rep.sync()
+    assert rep.basis_t == 2 and rep.deltas == []
+    assert rep.holds('person/name') and rep.holds(64) and not rep.holds('person/age')
+    assert rep.e(1000) == {'db/id': 1000, 'person/name': u'Ann',
+                           'person/likes': [{'db/id': 1001}]}
+
+    " a sync keeps what changed as a delta, retractions applied on read "
+    log.txs.append([(1000, 63, u'Ann', False), (1000, 63, u'Anne', True),
+                    (1002, 63, u'Cy', True), (1000, 64, 1002, True)])
+    rep.sync()
+    assert (rep.basis_t, len(rep.deltas)) == (3, 1)
+    assert rep.e(1000) == {'db/id': 1000, 'person/name': u'Anne',
+                           'person/likes': [{'db/id': 1001}, {'db/id': 1002}]}
+    assert [d['v'] for d in rep.datoms('avet', a='person/name')] == [u'Anne', u'Bob', u'Cy']
+    assert [d['tx'] for d in rep.datoms('aevt', a='person/name')] == [3, 2, 3]
+    rep.sync()
+    assert len(rep.deltas) == 1
+
+    " a datom retracted and asserted again in later deltas, merged in order "
+    rep.max_deltas = 4
+    log.txs.append([(1001, 63, u'Bob', False)])
+    rep.sync()
+    log.txs.append([(1001, 63, u'Bob', True), (1002, 63, u'Cy', False)])
+    rep.sync()
+    want = log.datoms('eavt')
+    assert (rep.basis_t, len(rep.deltas)) == (5, 3)
+    got = list(rep.datoms('eavt'))
+    assert [(d['e'], d['a'], d['v']) for d in got] == [(d['e'], d['a'], d['v']) for d in want]
+    assert [d['tx'] for d in got if d['e'] == 1001] == [5]
+
+    " compact folds the deltas into a base, files of the old ones removed "
+    rep.compact()
+    assert (rep.basis_t, rep.deltas) == (5, [])
+    assert list(rep.datoms('eavt')) == got
+    assert sorted(os.listdir(tmp)) == sorted(['lock', 'manifest.json', rep.manifest['base']])
+
+    " another reader of the same path sees the same "
+    other = Replica(tmp)
+    assert list(other.datoms('eavt')) == got and other.e(1002) == {'db/id': 1002}
+
+    " a manifest naming segments that never appear fails after a few reads "
+    path = os.path.join(tmp, 'manifest.json')
+    with open(path + '.tmp', 'w') as f:
+      json.dump({'base': 'base-gone', 'deltas': [], 'basis-t': 6}, f)
+    os.rename(path + '.tmp', path)
+    try:
+      other.refresh()
+    except IOError, e:
+      assert 'base-gone' in str(e)
+    else:
+      assert False, "no IOError"
+    assert other.basis_t == 5
+  finally:
+    shutil.rmtree(tmp)
+
+
+def people():
+  " a DatomIndex of three people, attributes by ident and by id "
+  datoms = [dict(e=e, a=a, v=v, tx=1, added=True) for e, a, v in [
+    (1, 'person/name', u'Ann'), (1, 'person/age', 31), (1, 'person/likes', 2),
+    (2, 'person/name', u'Bob'), (2, 'person/age', 25), (2, 'person/likes', 3),
+    (3, 'person/name', u'Cy'),  (3, 64, 40),           (1, 'person/likes', 3)]]
+  datoms.append(dict(e=3, a='person/name', v=u'Old', tx=1, added=False))
+  return DatomIndex(datoms, idents={':person/age': 64}, attrs=['person/email'])
+
+def test_local_engine():
+  index = people()
+  assert index.holds('person/age') and index.holds(':person/age') and index.holds(64)
+  assert index.holds('person/email') and not index.holds('person/friend')
+  assert [d['e'] for d in index.datoms('aevt', a='person/age')] == [1, 2, 3]
+  assert [d['v'] for d in index.datoms('eavt', e=1, a='person/likes')] == [2, 3]
+  assert [d['e'] for d in index.datoms('avet', a='person/name', v=u'Old')] == []
+
+  engine = LocalEngine(index)
+  run = lambda q: sorted(engine.run(q))
+
+  " joins on shared variables, and a variable used twice "
+  assert run(db.find('?n ?a').where('?e :person/name ?n', '?e :person/age ?a')) == \
+         [[u'Ann', 31], [u'Bob', 25], [u'Cy', 40]]
+  assert run(db.find('?n ?m').where('?e :person/likes ?f', '?e :person/name ?n',
+                                    '?f :person/name ?m')) == \
+         [[u'Ann', u'Bob'], [u'Ann', u'Cy'], [u'Bob', u'Cy']]
+  assert run(db.find('?e').where('?e :person/likes 3')) == [[1], [2]]
+  assert run(db.find('?e').where('?e :person/email _')) == []
+
+  " predicates, once their variables are bound "
+  assert run(db.find('?n').where('(> ?a 28)', '?e :person/age ?a',
+                                 '?e :person/name ?n')) == [[u'Ann'], [u'Cy']]
+  assert run(db.find('?n').where('?e :person/age ?a', '(<= ?a 31)',
+                                 '(!= ?a 25)', '?e :person/name ?n')) == [[u'Ann']]
+
+  " scalar, collection, tuple and relation inputs "
+  q = lambda: db.find('?e').where('?e :person/name ?n')
+  assert run(q().param('?n', u'Bob')) == [[2]]
+  assert run(q().param('?n', [u'Ann', u'Cy', u'Dan'])) == [[1], [3]]
+  assert run(db.find('?e').where('?e :person/name ?n', '?e :person/age ?a')
+             .param('?n ?a', (u'Ann', 31))) == [[1]]
+  assert run(db.find('?e').where('?e :person/name ?n', '?e :person/age ?a')
+             .param('?n ?a', [[u'Ann', 31], [u'Bob', 31]])) == [[1]]
+  assert run(q().param('?n', u'Ann').limit(1)) == [[1]]
+
+  " the rest is left to the peer "
+  for unsupported in (db.find('?e').where('?e :person/friend ?f'),
+                      db.find('?e').where('?e ?a 3'),
+                      db.find('(count ?e)').where('?e :person/name ?n'),
+                      db.find('?e ?x').where('?e :person/name ?n'),
+                      db.find('?e').where('?e :person/age ?a', '(> ?b 1)'),
+                      db.find('?e').where('?e :person/age ?a', '(foo ?a)'),
+                      db.find('?e').where('?e :person/age ?a]'),
+                      db.find('?e').where('?e :person/name ?n').history(True)):
+    assert engine.run(unsupported) is None, unsupported._where
+
+  " Query.all tries the local engine first "
+  ldb, asked = DB(HOST, PORT, STORE, DBN, S, local=index), []
+  ldb.q = lambda q, **kwargs: asked.append(q) or [['peer']]
+  assert sorted(ldb.find('?e').where('?e :person/age ?a').all()) == [[1], [2], [3]]
+  assert ldb.find('?e').where('?e :person/friend ?f').all() == [['peer']] and len(asked) == 1
+
+
+def test_watch_unavailable():
+  " a peer without an event stream leaves the connection usable "
+  peer = FakePeer(lambda path: (503, 'no event stream here') if
+                  path.startswith('/events/') else INFO)
+  try:
+    wdb = DB(peer.address, None, 'mem', 'x', maxsize=1, retries=0)
+    try:
+      next(Watch(wdb).stream())
+    except Unavailable, e:
+      assert e.args == (503,)
+    else:
+      assert False, "no Unavailable"
+    assert wdb.info()['basis-t'] == 1042
+    assert wdb.pool.utilization()[0]['connections'] == 1
+  finally:
+    peer.shutdown()
+
+
+def test_watch():
+  " deltas per transaction or batched, resumed, retried on peer errors "
+  log, fail = [], []
+  wdb = DB(HOST, PORT, STORE, DBN, S)
+  def rest(method, uri, data=None, **kwargs):
+    if fail: raise fail.pop()
+    if uri.endswith('-/'): return {'basis-t': len(log)}
+    assert uri.endswith('-/datoms') and data['history'] and data['index'] == 'eavt'
+    rs = sorted((dict(e=e, a=a, v=v, tx=3 * 2 ** 42 + t, added=added)
+                 for t, tx in enumerate(log[:data['as-of']], 1) if t > data['since']
+                 for e, a, v, added in tx), key=lambda d: (d['e'], d['a'], d['v']))
+    return Body(u'[%s]' % u' '.join(
+      u'{:e %(e)i :a %(a)i :v %(v)i :tx %(tx)i :added %(added)s}' % dict(
+        d, added='true' if d['added'] else 'false')
+      for d in rs[data['offset']:data['offset'] + data['limit']]))
+  wdb.rest = rest
+  log += [[(1, 63, 10, True), (2, 63, 20, True)], [(1, 63, 10, False), (1, 63, 11, True)],
+          [(3, 63, 30, True)]]
+  values = lambda delta: [(d['e'], d['v'], d['added']) for d in delta.datoms]
+
+  " transactions committed meanwhile are split per transaction "
+  w = wdb.watch(since_t=0, events=False, poll_ms=0, chunk=2)
+  deltas = [delta for delta, _ in zip(w, range(3))]
+  assert [(d.since, d.t) for d in deltas] == [(0, 1), (1, 2), (2, 3)]
+  assert values(deltas[1]) == [(1, 10, False), (1, 11, True)]
+  assert w.t == 3
+
+  " or delivered as one delta "
+  delta = next(iter(wdb.watch(since_t=1, events=False, poll_ms=0, batch=True)))
+  assert (delta.since, delta.t) == (1, 3)
+  assert values(delta) == [(1, 10, False), (1, 11, True), (3, 30, True)]
+
+  " a new watch resumes after what the last one delivered, past peer errors "
+  log.append([(2, 63, 21, True)])
+  fail += [StatusError(503), IOError('connection reset')]
+  w = wdb.watch(since_t=w.t, events=False, poll_ms=0, backoff=0)
+  delta = next(iter(w))
+  assert (delta.since, delta.t, values(delta)) == (3, 4, [(2, 21, True)]) and not fail
+
+  " a bad request is not retried "
+  fail.append(StatusError(400))
+  try:
+    w.fetch()
+  except StatusError, e:
+    assert e.status == 400
+  else:
+    assert False, "no StatusError"
+
+
+def test_watch_events():
+  " basis-t read from server sent events, polling when there are none "
+  events = ('data: {:db/alias "mem/x" :basis-t 5}\n\n'
+            ': a comment\n\n'
+            'event: tx\ndata: {:db/alias "mem/x"\ndata:  :basis-t 6}\n\n'
+            'data: {:db/alias "mem/x"}\n\n')
+  peer = FakePeer(lambda path: (200, events) if path == '/events/mem/x' else INFO)
+  none = FakePeer(lambda path: (404, 'no events') if path.startswith('/events/') else INFO)
+  try:
+    w = Watch(DB(peer.address, None, 'mem', 'x'), poll_ms=0)
+    assert list(w.stream()) == [5, 6, None]
+    ticks = w.ticks()
+    assert [next(ticks) for i in range(5)] == [None, 5, 6, None, None]
+
+    w = Watch(DB(none.address, None, 'mem', 'x', retries=0), poll_ms=0)
+    ticks = w.ticks()
+    assert [next(ticks) for i in range(3)] == [None, None, None] and not w.events
+    assert len(none.paths) == 1
+  finally:
+    peer.shutdown()
+    none.shutdown()
+
+
+def test_pull():
+  " graphs fetched a level at a time, by a fake q evaluating the pull queries "
+  from pull import Q_ALL
+  types = {'person/name': ('string', 'one'), 'person/age': ('long', 'one'),
+           'person/nick': ('string', 'many'), 'person/best': ('ref', 'one'),
+           'person/likes': ('ref', 'many')}
+  graph = {1: [('person/name', u'Ann'), ('person/nick', u'A'), ('person/best', 2),
+               ('person/likes', 2), ('person/likes', 3)],
+           2: [('person/name', u'Bob'), ('person/age', 30), ('person/likes', 3)],
+           3: [('person/name', u'Cy'), ('person/likes', 1)],
+           4: [('person/name', u'Dan')]}
+  pdb, asked = DB(HOST, PORT, STORE, DBN, S), []
+  def q(query, inputs=(), **kwargs):
+    eids  = [int(x) for x in inputs[0].strip('[]').split()]
+    attrs = [x.lstrip(':') for x in inputs[1].strip('[]').split()] if len(inputs) > 1 else None
+    assert (query == Q_ALL) == (attrs is None)
+    asked.append((sorted(eids), attrs))
+    return [[e, u':' + a, v, u':db.type/' + types[a][0], u':db.cardinality/' + types[a][1],
+             False] for e in eids for a, v in graph[e] if attrs is None or a in attrs]
+  pdb.q = q
+  pdb.e = lambda eid: 1 / 0
+
+  " every attribute, refs followed one level and shared between entities "
+  ann = pdb.pull(1)
+  assert asked == [([1], None), ([2, 3], None)]
+  likes = ann['person/likes']
+  assert [p['person/name'] for p in likes] == [u'Bob', u'Cy']
+  assert ann['person/best'] is likes[0] and likes[0]['person/likes'] == [likes[1]]
+  assert likes[1]['person/likes'] == [ann]
+  assert ann['person/nick'] == [u'A'] and likes[0]['person/age'] == 30
+
+  " named attributes, one query per batch "
+  del asked[:]
+  people = pdb.pull([1, 2, 3, 4], ['person/name'], batch=2)
+  assert sorted(asked) == [([1, 2], ['person/name']), ([3, 4], ['person/name'])]
+  assert [p._dict for p in people] == [{'db/id': e, 'person/name': n} for e, n in
+                                       [(1, u'Ann'), (2, u'Bob'), (3, u'Cy'), (4, u'Dan')]]
+
+  " a ref followed with its own pattern, unloaded refs left as ids "
+  del asked[:]
+  ann = pdb.pull(1, ['person/name', {'person/likes': ['person/age']}], depth=2)
+  assert asked == [([1], ['person/likes', 'person/name']), ([2, 3], ['person/age'])]
+  assert [p._dict for p in ann['person/likes']] == [{'db/id': 2, 'person/age': 30},
+                                                   {'db/id': 3}]
+  assert pdb.pull(1, depth=0)._dict['person/likes'] == [{'db/id': 2}, {'db/id': 3}]
+
+  bob = E(2, db=pdb)
+  assert bob.prefetch(['person/name']) is bob
+  assert bob._dict == {'db/id': 2, 'person/name': u'Bob'}
+
+
+class Gauge(object):
+  """ The most calls in flight at once. Each call is held until `hold`
+  of them are, or for a second, so the peak does not depend on how
+  fast threads start.
+  """
+  def __init__(self, hold):
+    self.cond, self.active, self.peak, self.hold = threading.Condition(), 0, 0, hold
+
+  def reset(self, hold):
+    self.peak, self.hold = 0, hold
+
+  def __call__(self, rs):
+    with self.cond:
+      self.active += 1
+      self.peak = max(self.peak, self.active)
+      self.cond.notify_all()
+      end = time.time() + 1
+      while self.peak < self.hold and time.time() < end:
+        self.cond.wait(end - time.time())
+    time.sleep(0.01)
+    with self.cond:
+      self.active -= 1
+    return rs
+
+
+def test_entities_concurrency():
+  edb, gauge = DB(HOST, PORT, STORE, DBN, S, workers=2), Gauge(12)
+  edb.rest = lambda method, uri, data=None, **kwargs: \
+             gauge({'db/id': data['e'], 'person/age': data['e'] % 7})
+  ents = edb.entities(range(1, 25) + [1, 2], concurrency=12)
+  assert [e.eid for e in ents] == range(1, 25) + [1, 2]
+  assert ents[-1]['person/age'] == 2 and ents[0] is ents[-2]
+  assert gauge.peak == 12 and edb.executor.workers == 2
+  gauge.reset(2)
+  assert len(list(edb.iter_entities(range(1, 9)))) == 8 and gauge.peak == 2
+
+
+def test_entity_cache():
+  ec = EntityCache(maxsize=3)
+  item  = {'db/id': 1, 'item/name': u'Box', 'item/parts': [{'db/id': 2, 'part/n': 1}]}
+
+  " every caller gets its own copy "
+  ec.put('a', 1, 100, item)
+  item['item/name'] = u'changed'
+  got = ec.get('a', 1)
+  assert got['item/name'] == u'Box'
+  got['item/parts'][0]['part/n'] = 99
+  assert ec.get('a', 1)['item/parts'][0]['part/n'] == 1
+
+  " read before basis-t min_t is stale "
+  assert ec.get('a', 1, min_t=100) is not None
+  assert ec.get('a', 1, min_t=101) is None and len(ec) == 0
+  assert ec.stats()['stale'] == 1
+
+  " changing a component drops the entity it is nested in "
+  ec.put('a', 1, 100, item)
+  ec.put('a', 3, 100, {'db/id': 3, 'item/name': u'Bag'})
+  ec.invalidate('a', [2], basis_t=105)
+  assert ec.get('a', 1) is None and ec.get('a', 3) is not None
+  assert ec.stats()['invalidations'] == 1
+
+  " reads older than our own write are not stored, of it or a component "
+  ec.put('a', 2, 104, {'db/id': 2, 'part/n': 1})
+  ec.put('a', 1, 104, item)
+  assert ec.get('a', 2) is None and ec.get('a', 1) is None
+  ec.put('a', 1, 105, item)
+  assert ec.get('a', 1) is not None
+
+  " least recently used entries go past maxsize, and after ttl "
+  for eid in (4, 5): ec.put('a', eid, 105, {'db/id': eid})
+  assert ec.get('a', 3) is None and len(ec) == 3
+  assert ec.stats()['evictions'] == 1
+  ec.ttl = 0
+  assert ec.get('a', 1) is None
+
+  " entities of another database are apart, eids alike "
+  ec.ttl = None
+  ec.put('a', 1, 105, item)
+  ec.put('b', 1, 105, {'db/id': 1, 'item/name': u'Crate'})
+  assert ec.get('a', 1) == item and ec.get('b', 1)['item/name'] == u'Crate'
+  ec.invalidate('b', [2], basis_t=106)
+  ec.put('b', 2, 105, {'db/id': 2, 'part/n': 2})
+  assert ec.get('a', 1) is not None and ec.get('b', 2) is None
+  ec.clear()
+  assert len(ec) == 0 and not ec.parents and not ec.written
+
+
+def test_cached_entities():
+  cdb, asked = DB(HOST, PORT, STORE, DBN, S, entity_cache=EntityCache()), []
+  cdb.info = lambda: {'basis-t': 100}
+  cdb.entity_cache.poll_ms = 60000
+  def rest(method, uri, data=None, **kwargs):
+    asked.append(data['e'])
+    return {'db/id': data['e'], 'person/name': u'P%i' % data['e']}
+  def q(query, inputs=None, **kwargs):
+    ids = [int(x) for x in inputs[0].strip('[]').split()]
+    asked.extend(ids)
+    rows = [[e, u':person/name', u'P%i' % e, u':db.type/string', u':db.cardinality/one', False]
+            for e in ids]
+    rows += [[e, u':person/likes', e + 1, u':db.type/ref', u':db.cardinality/many', False]
+             for e in ids]
+    rows += [[e, u':person/address', 9000 + e, u':db.type/ref', u':db.cardinality/one', True]
+             for e in ids if e % 10 == 0]
+    return rows
+  cdb.rest, cdb.q = rest, q
+
+  " the batched path fills the cache, but for entities with components "
+  ents = cdb.entities(range(1, 21), query_min=4, batch=8)
+  assert [e.eid for e in ents] == range(1, 21) and sorted(asked) == range(1, 21)
+  assert ents[0]['person/name'] == u'P1'
+  assert cdb.entity_cache.get(cdb.uri_db, 3) == {'db/id': 3, 'person/name': u'P3',
+                                                 'person/likes': [{'db/id': 4}]}
+  assert len(cdb.entity_cache) == 18 and cdb.entity_cache.get(cdb.uri_db, 10) is None
+
+  " hits are served from the cache, on both paths "
+  del asked[:]
+  ents = cdb.entities(range(1, 21), query_min=4)
+  assert sorted(asked) == [10, 20]
+  assert ents[2]['person/name'] == u'P3'
+  del asked[:]
+  assert cdb.e(3)['person/name'] == u'P3' and asked == []
+  assert cdb.e(3, cache=False)['person/name'] == u'P3' and asked == [3]
+
+  " a DB of another database sharing the cache does not see them "
+  odb = DB(HOST, PORT, STORE, DBN + '-other', S, entity_cache=cdb.entity_cache)
+  odb.info, odb.rest = cdb.info, rest
+  del asked[:]
+  assert odb.e(3)['person/name'] == u'P3' and asked == [3]
+  assert len(cdb.entity_cache) == 21 and cdb.e(3)['person/likes'] == [{'db/id': 4}]
+
+
+def test_q_many():
+  qdb, gauge = DB(HOST, PORT, STORE, DBN, S, workers=2), Gauge(2)
+  def q(query, **kwargs):
+    if query == 'fail': raise Exception("bad query")
+    return gauge([[query]])
+  qdb.q = q
+
+  " results in input order, concurrency up to the worker count "
+  rs = qdb.q_many([u'q%i' % i for i in range(6)])
+  assert [r.rows for r in rs] == [[[u'q%i' % i]] for i in range(6)]
+  assert gauge.peak == 2 and all(r.error is None and r.ms > 0 for r in rs)
+
+  " or up to max_workers, on threads of their own when more "
+  gauge.reset(12)
+  qdb.q_many([u'q%i' % i for i in range(24)], max_workers=12)
+  assert gauge.peak == 12 and qdb.executor.workers == 2
+  gauge.reset(1)
+  qdb.q_many([u'q%i' % i for i in range(6)], max_workers=1)
+  assert gauge.peak == 1
+
+  " failures raised, or returned with fail_fast=False "
+  try:
+    qdb.q_many(['q', 'fail', 'q'])
+  except Exception, e:
+    assert 'bad query' in str(e)
+  else:
+    assert False, "failure not raised"
+  rs = qdb.q_many(['q', 'fail'], fail_fast=False)
+  assert rs[0].error is None and 'bad query' in str(rs[1].error) and rs[1].rows is None
+
+
 if __name__ == '__main__':
   test_all()
+  test_async()
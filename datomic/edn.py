@@ -0,0 +1,399 @@
+# -*- coding: utf-8 -*-
+""" edn helpers that sit next to the generic `clj` reader.
+"""
+import json
+import re
+from json.encoder import encode_basestring_ascii
+
+import clj
+from clj import dumps
+
+
+_special  = re.compile(r'[\s,"\\;\[\](){}#]')
+_instring = re.compile(r'["\\]')
+_open     = re.compile(r'[\[(]')
+
+
+def loads(text):
+  """ `clj.loads`, reading strings as utf-8 like the peer sends them.
+  clj decodes string literals as latin-1 escapes, so anything beyond
+  ascii is handed to it already escaped.
+  >>> loads('["\xc3\x9c"]')
+  [u'\xdc']
+  """
+  if isinstance(text, str):
+    try:
+      text.decode('ascii')
+      return clj.loads(text)
+    except UnicodeDecodeError:
+      text = text.decode('utf-8')
+  return clj.loads(text.encode('ascii', 'backslashreplace'))
+
+def kw(x):
+  " keyword text, with the leading colon "
+  x = unicode(x)
+  return x if x.startswith(':') else u':' + x
+
+def key(x):
+  " attribute ident as entity dicts key it, without the colon "
+  return unicode(x).lstrip(':')
+
+
+class VectorReader(object):
+  """ Incrementally splits a top level edn vector into its elements.
+
+  Text can be fed in arbitrary pieces; every element is parsed with
+  `parse` as soon as its closing character arrives, so only the element
+  being read is ever held in memory.
+
+  >>> rd = VectorReader()
+  >>> rd.feed('[{:e 1 :a 2} {:e')
+  [{'e': 1, 'a': 2}]
+  >>> rd.feed(' 3 :a 4}]')
+  [{'e': 3, 'a': 4}]
+  """
+
+  def __init__(self, parse=loads):
+    self.parse    = parse
+    self.buf      = ''
+    self.pos      = 0        # next index of buf to scan
+    self.start    = None     # index in buf where the current element began
+    self.atom     = False    # current element is a scalar, ended by whitespace
+    self.depth    = 0
+    self.string   = False
+    self.comment  = False
+    self.done     = False
+
+  def __repr__(self):
+    return "<datomic edn vector reader, depth %i>" % self.depth
+
+  def feed(self, text):
+    " consume more text, returns the elements completed by it "
+    if self.done or not text: return []
+    self.buf += text
+    out, buf, i, n = [], self.buf, self.pos, len(self.buf)
+    while i < n:
+      if self.comment:
+        j = buf.find('\n', i)
+        if j < 0: i = n; break
+        self.comment, i = False, j + 1
+        continue
+      if self.string:
+        m = _instring.search(buf, i)
+        if m is None: i = n; break
+        j = m.start()
+        if buf[j] == '\\':
+          if j + 1 >= n: i = j; break
+          i = j + 2
+          continue
+        self.string, i = False, j + 1
+        if self.depth == 1:
+          self.emit(out, i)
+        continue
+      if self.depth == 0:
+        m = _open.search(buf, i)
+        if m is None: i = n; break
+        self.depth, i = 1, m.end()
+        continue
+      m = _special.search(buf, i)
+      j = m.start() if m else n
+      if j > i and self.depth == 1 and self.start is None:
+        self.start, self.atom = i, True
+      if m is None: i = n; break
+      c, i = buf[j], j + 1
+      if c in ' \t\r\n,':
+        if self.depth == 1 and self.atom:
+          if buf[self.start] == '#' and buf[self.start:self.start+2] != '#_':
+            self.atom = False   # a tag, its value follows
+          else:
+            self.emit(out, j)
+      elif c == '"':
+        if self.depth == 1 and self.start is None: self.start = j
+        self.atom, self.string = False, True
+      elif c in '[({':
+        if self.depth == 1 and self.start is None: self.start = j
+        self.atom, self.depth = False, self.depth + 1
+      elif c in '])}':
+        if self.depth == 1:
+          if self.atom: self.emit(out, j)
+          self.done = True
+          break
+        self.depth -= 1
+        if self.depth == 1: self.emit(out, i)
+      elif c == '#':
+        if self.depth == 1 and self.start is None: self.start, self.atom = j, True
+      elif c == '\\':
+        if j + 1 >= n: i = j; break
+        if self.depth == 1 and self.start is None: self.start, self.atom = j, True
+        i = j + 2
+      elif c == ';':
+        self.comment = True
+    " keep only the unfinished element "
+    keep = self.start if self.start is not None else i
+    self.buf, self.pos = buf[keep:], i - keep
+    if self.start is not None: self.start = 0
+    return out
+
+  def emit(self, out, end):
+    if self.start is None: return
+    out.append(self.parse(self.buf[self.start:end]))
+    self.start, self.atom = None, False
+
+
+def iter_vector(chunks, parse=loads):
+  """ Yield the parsed elements of an edn vector as they are read from
+  an iterable of text chunks.
+  """
+  rd = VectorReader(parse)
+  for chunk in chunks:
+    for x in rd.feed(chunk):
+      yield x
+    if rd.done: return
+
+
+class Fallback(Exception):
+  " the text is not of the shape a fast decoder handles "
+
+
+""" Fast decoding of the two common response shapes, datom pages and
+query results. The text is tokenized with one regex, scalars are
+converted inline and keywords, true, false and nil are read once by the
+generic parser and then served from a cache. Tagged instants and uuids
+go to the generic parser as they are met. Anything else falls back to
+`clj.loads` for the whole response.
+"""
+_tok    = re.compile(r'([\[\]{}])|"((?:[^"\\]|\\.)*)"|(#(?:inst|uuid)\s*"[^"]*")|([^\s,\[\]{}()"#;\\]+)|([^\s,])')
+_int    = re.compile(r'-?\d+$')
+_float  = re.compile(r'-?\d+(?:\.\d*)?(?:[eE][-+]?\d+)?$')
+_vopen, _vclose, _mopen, _mclose = object(), object(), object(), object()
+_brackets = {'[': _vopen, ']': _vclose, '{': _mopen, '}': _mclose}
+
+""" Keywords read so far, dropped once there are CACHE_MAX of them
+"""
+CACHE_MAX = 10000
+_cache    = {}
+_missing  = object()
+
+
+def _atom(text):
+  " one lookup, the cache may be cleared by another thread meanwhile "
+  v = _cache.get(text, _missing)
+  if v is not _missing:  return v
+  if _int.match(text):   return int(text)
+  if _float.match(text): return float(text)
+  if text[0] == ':' or text in ('true', 'false', 'nil'):
+    if len(_cache) >= CACHE_MAX: _cache.clear()
+    v = _cache[text] = loads(text)
+    return v
+  raise Fallback(text)
+
+def _scan(text):
+  " tokens of text, brackets as sentinels and scalars converted "
+  out = []
+  append = out.append
+  for br, st, tag, atom, other in _tok.findall(text):
+    if br:
+      append(_brackets[br])
+    elif atom:
+      v = _cache.get(atom, _missing)
+      append(v if v is not _missing else _atom(atom))
+    elif tag:
+      append(loads(tag))
+    elif other:
+      raise Fallback(other)
+    elif '\\' in st:
+      append(json.loads('"%s"' % st, strict=False))
+    elif isinstance(st, unicode):
+      append(st)
+    else:
+      append(st.decode('utf-8'))
+  return out
+
+def _scalar(v):
+  if v is _vopen or v is _vclose or v is _mopen or v is _mclose: raise Fallback(v)
+  return v
+
+def _maps(toks, i=0):
+  " a vector of flat maps starting at toks[i] "
+  if toks[i] is not _vopen: raise Fallback(toks[i])
+  out, i = [], i + 1
+  while toks[i] is _mopen:
+    d, i = {}, i + 1
+    while toks[i] is not _mclose:
+      d[_scalar(toks[i])] = _scalar(toks[i+1])
+      i += 2
+    out.append(d)
+    i += 1
+  if toks[i] is not _vclose: raise Fallback(toks[i])
+  return out, i + 1
+
+def _rows(toks, i=0):
+  " a vector of vectors of scalars starting at toks[i] "
+  if toks[i] is not _vopen: raise Fallback(toks[i])
+  out, i = [], i + 1
+  while toks[i] is _vopen:
+    j = toks.index(_vclose, i)
+    out.append([_scalar(v) for v in toks[i+1:j]])
+    i = j + 1
+  if toks[i] is not _vclose: raise Fallback(toks[i])
+  return out, i + 1
+
+def _fast(shape, text, one=False):
+  try:
+    toks = _scan(text)
+    if one: toks = [_vopen] + toks + [_vclose]
+    rs, i = shape(toks)
+    if i != len(toks) or (one and len(rs) != 1): raise Fallback(i)
+    return rs[0] if one else rs
+  except (Fallback, IndexError, ValueError):
+    return loads(text)
+
+def loads_datoms(text):
+  " decode a vector of datom maps, as returned by -/datoms "
+  return _fast(_maps, text)
+
+def loads_rows(text):
+  " decode a vector of result tuples, as returned by /api/query "
+  return _fast(_rows, text)
+
+def loads_datom(text):
+  " decode a single datom map, for `VectorReader` "
+  return _fast(_maps, text, one=True)
+
+def loads_row(text):
+  " decode a single result tuple, for `VectorReader` "
+  return _fast(_rows, text, one=True)
+
+
+""" Serializers for the value types whose python representation is
+unambiguous, keyed by :db/valueType. Anything else goes to the fallback.
+"""
+ENCODERS = {
+  ':db.type/string':  ((str, unicode),  encode_basestring_ascii),
+  ':db.type/long':    ((int, long),     str),
+  ':db.type/ref':     ((int, long),     str),
+  ':db.type/bigint':  ((int, long),     lambda v: '%dN' % v),
+  ':db.type/boolean': ((bool,),         lambda v: 'true' if v else 'false'),
+  ':db.type/double':  ((float,),        repr),
+  ':db.type/float':   ((float,),        repr),
+  ':db.type/keyword': ((str, unicode),  lambda v: v if v.startswith(':') else ':' + v),
+}
+
+MANY = ':db.cardinality/many'
+
+
+class TxEncoder(object):
+  """ Serializes (e, a, v) datoms into tx-data, using the `Schema` to
+  pick one precompiled serializer per attribute.
+
+  All datoms of one entity are merged into a single map, values of a
+  cardinality many attribute become a vector. Repeated values of
+  any other attribute are sent as :db/add lists.
+
+  >>> enc = TxEncoder(db.schema)
+  >>> enc.encode([(-1, ':person/name', 'Bob'), (-1, ':person/age', 42)])
+  u'{:db/id #db/id[:db.part/user -1] :person/name "Bob" :person/age 42}'
+  """
+
+  def __init__(self, schema=None, fallback=dumps):
+    self.schema   = schema
+    self.fallback = fallback
+    self.attrs    = {}
+
+  def __repr__(self):
+    return "<datomic tx encoder, %i attributes compiled>" % len(self.attrs)
+
+  def attr(self, a):
+    """ (python types, serializer, cardinality many) for attribute `a`,
+    compiled once. Values of other types go to the fallback.
+    """
+    if a not in self.attrs:
+      d = (self.schema.attr(a) if self.schema else None) or {}
+      types, enc = ENCODERS.get(d.get(':db/valueType'), ((), None))
+      self.attrs[a] = (types, enc, d.get(':db/cardinality') == MANY)
+    return self.attrs[a]
+
+  def encode(self, adds):
+    " edn for the datoms in `adds`, without the enclosing vector "
+    attrs, fallback = self.attrs, self.fallback
+    ents, order, extra = {}, [], []
+    last = None
+    for e, a, v in adds:
+      if e is not last:
+        last, eid = e, e if type(e) in (int, long) else int(e)
+        " every datom of an entity goes to its map, in first seen order "
+        if eid in ents:
+          toks, seen = ents[eid]
+        else:
+          toks, seen = ents[eid] = (['{:db/id #db/id[:db.part/user %i]' % eid], {})
+          order.append(toks)
+      types, enc, card_many = attrs[a] if a in attrs else self.attr(a)
+      v = enc(v) if type(v) in types else fallback(v)
+      if a not in seen:
+        if card_many:
+          seen[a] = [len(toks), a + ' [' + v]
+          toks.append(None)
+        else:
+          seen[a] = None
+          toks.append(a + ' ' + v)
+      elif card_many:
+        seen[a].append(v)
+      else:
+        extra.append('[:db/add #db/id[:db.part/user %i] %s %s]' % (eid, a, v))
+    for toks, seen in ents.itervalues():
+      for vs in seen.itervalues():
+        if vs is not None: toks[vs[0]] = ' '.join(vs[1:]) + ']'
+      toks[-1] += '}'
+    return ' '.join([' '.join(toks) for toks in order] + extra)
+
+
+""" Reading query text into forms
+"""
+
+class Var(str):
+  " a ?logic variable "
+
+BLANK = object()
+
+_ftok = re.compile(r'"(?:[^"\\]|\\.)*"|[\[\]\(\)]|[^\s,\[\]\(\)"]+')
+_fnum = re.compile(r'^[-+]?\d+N?$')
+_fflt = re.compile(r'^[-+]?\d+\.\d*(?:[eE][-+]?\d+)?M?$')
+
+
+def read_forms(s):
+  """ The forms of an edn fragment; vectors and lists as python lists
+  tagged by their first token, keywords as (':', name) pairs. Raises
+  ValueError on unbalanced brackets.
+  >>> read_forms('[:find ?e :where [?e :person/age 3]]')
+  [[(':', 'find'), '?e', (':', 'where'), ['?e', (':', 'person/age'), 3]]]
+  """
+  stack = [[]]
+  for t in _ftok.findall(s):
+    if t in '[(':
+      stack.append(Form(t))
+    elif t in '])':
+      if len(stack) < 2: raise ValueError("unbalanced %s" % t)
+      form = stack.pop()
+      stack[-1].append(form)
+    else:
+      stack[-1].append(form_atom(t))
+  if len(stack) != 1: raise ValueError("unbalanced form")
+  return stack[0]
+
+class Form(list):
+  " a vector, or a list when opened with ( "
+  def __init__(self, kind):
+    list.__init__(self)
+    self.kind = kind
+
+def form_atom(t):
+  if t.startswith('"'): return json.loads(t)
+  if t.startswith('?'): return Var(t)
+  if t == '_':          return BLANK
+  if t == 'true':       return True
+  if t == 'false':      return False
+  if t == 'nil':        return None
+  if _fnum.match(t):    return int(t.rstrip('N'))
+  if _fflt.match(t):    return float(t.rstrip('M'))
+  if t.startswith(':'): return (':', t[1:])
+  return t
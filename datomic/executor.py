@@ -0,0 +1,190 @@
+# -*- coding: utf-8 -*-
+""" Thread backed futures for running blocking REST calls concurrently.
+
+urllib3 pools are thread safe, so a handful of worker threads sharing
+one pool is enough to keep many requests in flight against the peer.
+"""
+import sys
+import threading
+import Queue
+
+
+class Future(object):
+  """ The eventual result of a call submitted to an `Executor`.
+
+  >>> f = executor.submit(db.info)
+  >>> f.result()
+  {:db/alias "store/db", :basis-t ...}
+  """
+
+  def __init__(self):
+    self._done      = threading.Event()
+    self._lock      = threading.Lock()
+    self._result    = None
+    self._exc_info  = None
+    self._callbacks = []
+
+  def __repr__(self):
+    return "<datomic future, %s>" % ('done' if self.done() else 'pending')
+
+  def done(self):
+    return self._done.is_set()
+
+  def result(self, timeout=None):
+    " block until the call finishes, re-raising its exception "
+    if not self._done.wait(timeout):
+      raise Exception, "Future timed out after %ss" % timeout
+    if self._exc_info:
+      raise self._exc_info[0], self._exc_info[1], self._exc_info[2]
+    return self._result
+
+  def exception(self, timeout=None):
+    if not self._done.wait(timeout):
+      raise Exception, "Future timed out after %ss" % timeout
+    return self._exc_info[1] if self._exc_info else None
+
+  def add_done_callback(self, fn):
+    " call fn(future) once finished, immediately if already done "
+    with self._lock:
+      if not self.done():
+        self._callbacks.append(fn)
+        return
+    fn(self)
+
+  def set_result(self, result):
+    self._result = result
+    self._finish()
+
+  def set_exc_info(self, exc_info):
+    self._exc_info = exc_info
+    self._finish()
+
+  def _finish(self):
+    with self._lock:
+      self._done.set()
+      callbacks, self._callbacks = self._callbacks, []
+    for fn in callbacks:
+      fn(self)
+
+
+class Executor(object):
+  """ A lazily grown pool of daemon worker threads.
+
+  >>> ex = Executor(workers=64)
+  >>> futures = [ex.submit(db.e, eid) for eid in eids]
+  >>> [f.result() for f in futures]
+  """
+
+  def __init__(self, workers=32):
+    assert workers > 0, "at least one worker is required"
+    self.workers  = workers
+    self._queue   = Queue.Queue()
+    self._lock    = threading.Lock()
+    self._threads = []
+    self._idle    = 0
+
+  def __repr__(self):
+    return "<datomic executor, %i/%i threads>" % (len(self._threads), self.workers)
+
+  def submit(self, defn, *args, **kwargs):
+    " schedule defn(*args, **kwargs), returns a `Future` "
+    future = Future()
+    self._queue.put((future, defn, args, kwargs))
+    with self._lock:
+      if self._queue.qsize() > self._idle and len(self._threads) < self.workers:
+        t = threading.Thread(target=self._work)
+        t.daemon = True
+        self._threads.append(t)
+        t.start()
+    return future
+
+  def map(self, defn, iterable):
+    " submit defn for every item, returns a list of futures in order "
+    return [self.submit(defn, x) for x in iterable]
+
+  def shutdown(self, wait=True):
+    " stop all workers once the queued calls are done "
+    with self._lock:
+      threads, self._threads = self._threads, []
+    for t in threads:
+      self._queue.put(None)
+    if wait:
+      for t in threads: t.join()
+
+  def _work(self):
+    while True:
+      with self._lock:
+        self._idle += 1
+      item = self._queue.get()
+      with self._lock:
+        self._idle -= 1
+      if item is None: return
+      future, defn, args, kwargs = item
+      try:
+        future.set_result(defn(*args, **kwargs))
+      except Exception:
+        future.set_exc_info(sys.exc_info())
+
+
+def wait(futures, timeout=None):
+  " block until all futures are done, returns their results in order "
+  return [f.result(timeout) for f in futures]
+
+def as_completed(futures):
+  " yield futures in the order they finish "
+  done, futures = Queue.Queue(), list(futures)
+  for f in futures:
+    f.add_done_callback(done.put)
+  for _ in futures:
+    yield done.get()
+
+def bounded(executor, defn, items, limit=None):
+  """ Call defn for every item with at most `limit` calls in flight,
+  yields (index, future) in the order they finish. Closing the
+  generator early stops submitting.
+  """
+  items, done = list(items), Queue.Queue()
+  def start(i):
+    executor.submit(defn, items[i]).add_done_callback(lambda f: done.put((i, f)))
+  n = min(limit or len(items), len(items))
+  for i in xrange(n): start(i)
+  for _ in xrange(len(items)):
+    i, f = done.get()
+    if n < len(items):
+      start(n)
+      n += 1
+    yield i, f
+
+def iter_ahead(executor, iterable, depth=1):
+  """ Consume `iterable` on a worker thread, buffering at most `depth`
+  items ahead of the caller. Closing the generator early releases the
+  worker.
+  """
+  buf, stop = Queue.Queue(maxsize=max(int(depth), 1)), object()
+  closed = threading.Event()
+  def put(item):
+    while not closed.is_set():
+      try:
+        buf.put(item, timeout=0.1)
+        return True
+      except Queue.Full:
+        pass
+    return False
+  def produce():
+    try:
+      for x in iterable:
+        if not put((x, None)): return
+    except Exception:
+      put((stop, sys.exc_info()))
+    else:
+      put((stop, None))
+  executor.submit(produce)
+  try:
+    while True:
+      x, exc_info = buf.get()
+      if x is stop:
+        if exc_info: raise exc_info[0], exc_info[1], exc_info[2]
+        return
+      yield x
+  finally:
+    closed.set()
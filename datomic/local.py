@@ -0,0 +1,246 @@
+# -*- coding: utf-8 -*-
+""" Evaluating simple queries in process, over locally held datoms.
+"""
+import operator
+from collections import defaultdict
+import edn
+from edn import Form, Var, BLANK
+
+from edn import key
+
+
+class Unsupported(Exception):
+  " the query uses something the local engine does not evaluate "
+
+
+""" Predicates usable as [(op ?x y)] clauses
+"""
+PREDICATES = {
+  '<':  operator.lt,
+  '>':  operator.gt,
+  '<=': operator.le,
+  '>=': operator.ge,
+  '=':  operator.eq,
+  '!=': operator.ne,
+}
+
+""" Bound values looked up one by one in an index, rather than scanning
+the whole attribute, up to this many distinct values.
+"""
+LOOKUP_MAX = 1000
+
+
+def read_forms(s):
+  " the forms of a query fragment, see `edn.read_forms` "
+  try:
+    return edn.read_forms(s)
+  except ValueError, e:
+    raise Unsupported(str(e))
+
+
+class DatomIndex(object):
+  """ Datoms held in memory, hashed by attribute, entity and value.
+  Takes the dicts `DB.datoms` yields; `a` may be an id or an ident, and
+  `idents` maps idents to ids.
+
+  Only the attributes it has datoms of, or those named in `attrs`, are
+  held; queries on any other attribute go to the peer.
+
+  >>> local = DatomIndex(db.datoms('aevt', a='person/name', idents=True))
+  """
+
+  def __init__(self, datoms=(), idents=None, attrs=()):
+    self.idents = dict((key(k), v) for k, v in (idents or {}).iteritems())
+    self.attrs  = set(self.attr_id(a) for a in attrs)
+    self.by_a   = defaultdict(list)
+    self.by_ea  = defaultdict(list)
+    self.by_av  = defaultdict(list)
+    for d in datoms:
+      self.add(d)
+
+  def __repr__(self):
+    return "<datomic datom index, %i attributes>" % len(self.by_a)
+
+  def add(self, d):
+    if not d.get('added', True): return
+    d = dict(d, a=self.attr_id(d['a']))
+    self.by_a[d['a']].append(d)
+    self.by_ea[(d['e'], d['a'])].append(d)
+    try:
+      self.by_av[(d['a'], d['v'])].append(d)
+    except TypeError:
+      " unhashable values can only be scanned "
+
+  def attr_id(self, a):
+    if isinstance(a, (int, long)): return a
+    return self.idents.get(key(a), key(a))
+
+  def holds(self, a):
+    " whether every datom of attribute `a` is here "
+    a = self.attr_id(a)
+    return a in self.attrs or a in self.by_a
+
+  def datoms(self, index='aevt', e=None, a=None, v=None):
+    a = self.attr_id(a)
+    if e is not None:  rows = self.by_ea.get((int(e), a), ())
+    elif v is not None: rows = self.by_av.get((a, v), ())
+    else:               rows = self.by_a.get(a, ())
+    for d in rows:
+      if (e is None or d['e'] == e) and (v is None or d['v'] == v):
+        yield d
+
+class LocalEngine(object):
+  """ Evaluates the where clauses of a `Query` over a datom source, a
+  `Replica` or a `DatomIndex`, with the inputs bound by `param()`.
+
+  Handled are data patterns with a keyword attribute the source holds,
+  [(< ?x 10)] style predicates, and scalar, tuple, collection and
+  relation inputs. Each pattern is resolved by index lookups when its
+  entity or value is already bound to few values, by an attribute scan
+  otherwise, and is hash joined with the bindings so far.
+
+  >>> engine = LocalEngine(replica)
+  >>> engine.q(db.find('?e ?a').where('?e :person/name ?n', '?e :person/age ?a').param('?n', 'Bob'))
+  [[17592186045459, 25]]
+
+  Anything else runs on the REST peer, see `q`, or `DB(..., local=engine)`
+  to answer `Query.all()` this way.
+  """
+
+  def __init__(self, source):
+    self.source = source
+
+  def __repr__(self):
+    return "<datomic local engine over %r>" % self.source
+
+  def q(self, query):
+    " rows of `query`, from the peer when it can't be evaluated here "
+    rs = self.run(query)
+    return query.all(local=False) if rs is None else rs
+
+  def run(self, query):
+    " rows of `query`, or None when it can't be evaluated here "
+    if query._history or query._as_of: return None
+    try:
+      rs = self.evaluate(query)
+    except Unsupported:
+      return None
+    offset = query._offset or 0
+    return rs[offset:offset + query._limit] if query._limit else rs[offset:]
+
+  def evaluate(self, query):
+    find, where, bindings = query._shape()
+    finds = [Var(x) for f in find for x in f.split()]
+    if not finds or not all(f.startswith('?') for f in finds):
+      raise Unsupported("find spec")
+    clauses = []
+    for w in where:
+      for c in ([w] if isinstance(w, basestring) else w):
+        clauses += read_forms(u"[%s]" % c)
+    rel, bound = [{}], set()
+    for binding, (_, value) in zip(bindings, query._input):
+      rel, bound = self.bind_input(rel, bound, read_forms(binding), value)
+    preds = [c for c in clauses if c and isinstance(c[0], Form) and c[0].kind == '(']
+    pats  = [c for c in clauses if c not in preds]
+    for c in pats:
+      rel, bound = self.pattern(rel, bound, c)
+      rel, preds = self.predicates(rel, bound, preds)
+      if not rel: return []
+    if preds: raise Unsupported("predicate on unbound variables")
+    if not set(finds) <= bound: raise Unsupported("unbound :find variable")
+    return [list(r) for r in set(tuple(b[f] for f in finds) for b in rel)]
+
+  def bind_input(self, rel, bound, forms, value):
+    " join the bindings with one :in input "
+    if len(forms) != 1: raise Unsupported("input binding")
+    form = forms[0]
+    if isinstance(form, Var):
+      names, rows = [form], [(plain(value),)]
+    elif isinstance(form, Form) and len(form) == 2 and form[1] == '...':
+      names, rows = [form[0]], [(plain(v),) for v in value]
+    elif isinstance(form, Form) and len(form) == 1 and isinstance(form[0], Form):
+      names, rows = list(form[0]), [tuple(plain(v) for v in r) for r in value]
+    elif isinstance(form, Form):
+      names, rows = list(form), [tuple(plain(v) for v in value)]
+    else:
+      raise Unsupported("input binding")
+    if not all(isinstance(n, Var) for n in names): raise Unsupported("input binding")
+    return join(rel, bound, names, rows)
+
+  def pattern(self, rel, bound, clause):
+    " resolve a data pattern and join it with the bindings "
+    if not isinstance(clause, Form) or len(clause) not in (2, 3) or clause.kind != '[':
+      raise Unsupported("clause %r" % (clause,))
+    e, a, v = (list(clause) + [BLANK])[:3]
+    if not (isinstance(a, tuple) and a[0] == ':'):
+      raise Unsupported("attribute must be a keyword")
+    if isinstance(v, tuple) or isinstance(e, tuple) or isinstance(e, Form) or isinstance(v, Form):
+      raise Unsupported("keyword or collection value")
+    attr = a[1]
+    if not self.source.holds(attr):
+      raise Unsupported("attribute %s not held locally" % attr)
+    lookups = None
+    if isinstance(e, Var) and e in bound:
+      es = set(b[e] for b in rel)
+      if len(es) <= LOOKUP_MAX: lookups = [dict(e=x) for x in es]
+    if lookups is None and isinstance(v, Var) and v in bound:
+      vs = set(b[v] for b in rel)
+      if len(vs) <= LOOKUP_MAX: lookups = [dict(v=x) for x in vs]
+    const = {}
+    if not isinstance(e, Var) and e is not BLANK: const['e'] = e
+    if not isinstance(v, Var) and v is not BLANK: const['v'] = v
+    rows = []
+    for lookup in (lookups or [{}]):
+      lookup = dict(const, **lookup)
+      index = 'eavt' if 'e' in lookup else 'avet' if 'v' in lookup else 'aevt'
+      for d in self.source.datoms(index, a=attr, **lookup):
+        rows.append((d['e'], d['v']))
+    names, cols = [], []
+    for i, x in enumerate((e, v)):
+      if isinstance(x, Var) and x not in names:
+        names.append(x)
+        cols.append(i)
+      elif isinstance(x, Var):
+        " [?x :a ?x] "
+        rows = [r for r in rows if r[0] == r[1]]
+    return join(rel, bound, names, [tuple(r[i] for i in cols) for r in rows])
+
+  def predicates(self, rel, bound, preds):
+    " filter by the predicates whose variables are all bound "
+    left = []
+    for p in preds:
+      call = p[0]
+      if len(p) != 1 or len(call) != 3 or call[0] not in PREDICATES:
+        raise Unsupported("predicate %r" % (call,))
+      args = call[1:]
+      if any(isinstance(x, Var) and x not in bound for x in args):
+        left.append(p)
+        continue
+      fn = PREDICATES[call[0]]
+      get = lambda b, x: b[x] if isinstance(x, Var) else x
+      rel = [b for b in rel if fn(get(b, args[0]), get(b, args[1]))]
+    return rel, left
+
+
+def plain(v):
+  " entities as their ids "
+  return int(v) if hasattr(v, 'eid') else v
+
+def join(rel, bound, names, rows):
+  """ hash join binding dicts with rows of values for `names`, on the
+  names already bound
+  """
+  shared = [n for n in names if n in bound]
+  fresh  = [(i, n) for i, n in enumerate(names) if n not in bound]
+  if not shared:
+    out = [dict(b, **dict((n, r[i]) for i, n in fresh)) for b in rel for r in rows]
+  else:
+    pos   = [names.index(n) for n in shared]
+    table = defaultdict(list)
+    for r in rows:
+      table[tuple(r[i] for i in pos)].append(r)
+    out = []
+    for b in rel:
+      for r in table.get(tuple(b[n] for n in shared), ()):
+        out.append(dict(b, **dict((n, r[i]) for i, n in fresh)))
+  return out, bound | set(names)
@@ -0,0 +1,212 @@
+# -*- coding: utf-8 -*-
+""" Spreading requests over several REST peers.
+"""
+import itertools
+import logging
+import threading
+import time
+
+import urllib3
+from urllib3.exceptions import HTTPError
+
+
+""" Idempotent methods, retried on another peer
+"""
+RETRY_METHODS = ('GET', 'HEAD')
+RETRY_STATUS  = (502, 503, 504)
+
+
+class StatusError(Exception):
+  " a REST call answered with a status other than the expected ones "
+  def __init__(self, status):
+    Exception.__init__(self, "Invalid status code: %s" % status)
+    self.status = status
+
+
+def endpoint(peer, port=None):
+  " (host, port) of 'host', 'host:port' or a (host, port) pair "
+  if isinstance(peer, (tuple, list)):
+    return peer[0], int(peer[1])
+  host, _, p = peer.rpartition(':') if ':' in peer else (peer, None, port)
+  return host, int(p)
+
+
+class Peer(object):
+  """ One REST peer, its connection pool and health.
+  """
+
+  def __init__(self, host, port, **pool_kwargs):
+    self.host, self.port = host, port
+    self.pool        = urllib3.connectionpool.HTTPConnectionPool(host, port=port, **pool_kwargs)
+    self.outstanding = 0
+    self.failures    = 0
+    self.ejected     = None
+
+  def __repr__(self):
+    return "<datomic peer %s:%i%s>" % (self.host, self.port, ' ejected' if self.ejected else '')
+
+
+class PeerPool(object):
+  """ Connection pools to one or more REST peers serving the same
+  storage, with the `request_encode_body` of a urllib3 pool.
+
+  Requests go to the next healthy peer, in turn with
+  `balance='round-robin'`, or to the one with the fewest requests in
+  flight with `balance='least'`. A peer failing `eject_after` requests
+  in a row is left out for `eject_for` seconds, then tried again.
+  Idempotent requests failing with a connection error or a 502/503/504
+  are retried up to `retries` times on another peer, sleeping `backoff`
+  seconds, doubled on each attempt, between them.
+
+  >>> pool = PeerPool(['peer1:8888', 'peer2:8888'], balance='least')
+  >>> db = DB(['peer1:8888', 'peer2:8888'], 8888, 'dev', 'test', retries=3)
+  """
+
+  def __init__(self, peers, port=None, timeout=3, maxsize=20, headers=None,
+                     balance='round-robin', retries=2, backoff=0.05,
+                     eject_after=3, eject_for=30.0, health_uri='/data/'):
+    assert balance in ('round-robin', 'least'), "unknown balance: %s" % balance
+    if isinstance(peers, basestring): peers = [peers]
+    self.peers       = [Peer(*endpoint(p, port), timeout=timeout, maxsize=maxsize,
+                             headers=headers, retries=False) for p in peers]
+    assert self.peers, "at least one peer is required"
+    self.headers     = dict(headers or {})
+    self.balance     = balance
+    self.retries     = retries
+    self.backoff     = backoff
+    self.eject_after = eject_after
+    self.eject_for   = eject_for
+    self.health_uri  = health_uri
+    self.lock        = threading.Lock()
+    self.turn        = itertools.count()
+
+  def __repr__(self):
+    return "<datomic peer pool, %i of %i healthy>" % (
+      len(self.healthy()), len(self.peers))
+
+  def healthy(self):
+    " peers not ejected, readmitting those whose time is up "
+    now = time.time()
+    for p in self.peers:
+      if p.ejected and now - p.ejected >= self.eject_for:
+        p.ejected = None
+    return [p for p in self.peers if not p.ejected]
+
+  def pick(self, exclude=()):
+    " the peer for the next request "
+    with self.lock:
+      peers = [p for p in self.healthy() if p not in exclude] or \
+              [p for p in self.peers if p not in exclude] or self.peers
+      if self.balance == 'least':
+        peer = min(peers, key=lambda p: p.outstanding)
+      else:
+        peer = peers[next(self.turn) % len(peers)]
+      peer.outstanding += 1
+    return peer
+
+  def done(self, peer, ok):
+    with self.lock:
+      peer.outstanding -= 1
+      if ok:
+        peer.failures, peer.ejected = 0, None
+        return
+      peer.failures += 1
+      if peer.failures >= self.eject_after and not peer.ejected:
+        logging.warning("ejecting datomic peer %s:%i after %i failures" % (
+          peer.host, peer.port, peer.failures))
+        peer.ejected = time.time()
+
+  def request_encode_body(self, method, uri, **kwargs):
+    """ `urllib3.HTTPConnectionPool.request_encode_body` on a peer,
+    retried on others when idempotent.
+    """
+    return self.send('request_encode_body', method, uri, kwargs)
+
+  def urlopen(self, method, uri, **kwargs):
+    " `urllib3.HTTPConnectionPool.urlopen` on a peer, like above "
+    return self.send('urlopen', method, uri, kwargs)
+
+  def send(self, call, method, uri, kwargs):
+    retries = self.retries if method.upper() in RETRY_METHODS else 0
+    tried, delay = [], self.backoff
+    while True:
+      peer = self.pick(exclude=tried)
+      tried.append(peer)
+      try:
+        r = getattr(peer.pool, call)(method, uri, **kwargs)
+      except (HTTPError, IOError):
+        self.done(peer, False)
+        if len(tried) > retries: raise
+      else:
+        ok = r.status not in RETRY_STATUS
+        self.done(peer, ok)
+        if ok or len(tried) > retries: return r
+        " read the error body so the connection can be reused "
+        r.drain_conn()
+        r.release_conn()
+      time.sleep(delay)
+      delay *= 2
+
+  def utilization(self):
+    " requests in flight, open and idle connections of every peer "
+    return [dict(peer='%s:%i' % (p.host, p.port), outstanding=p.outstanding,
+                 failures=p.failures, ejected=bool(p.ejected),
+                 connections=p.pool.num_connections, requests=p.pool.num_requests,
+                 idle=p.pool.pool.qsize() if p.pool.pool else 0,
+                 maxsize=p.pool.pool.maxsize if p.pool.pool else 0)
+            for p in self.peers]
+
+  def check(self):
+    """ GET `health_uri` on every peer, ejecting those that fail and
+    readmitting those that answer. Returns the healthy peers.
+    """
+    for peer in list(self.peers):
+      with self.lock:
+        peer.outstanding += 1
+      try:
+        r = peer.pool.request('GET', self.health_uri)
+        ok = r.status < 500
+      except (HTTPError, IOError):
+        ok = False
+      if not ok:
+        " eject right away "
+        with self.lock:
+          peer.failures = max(peer.failures, self.eject_after - 1)
+      self.done(peer, ok)
+    with self.lock:
+      return self.healthy()
+
+
+class Traffic(object):
+  """ Bytes sent and received, as encoded on the wire and as raw edn.
+
+  >>> db.traffic.stats()
+  {'requests': 12, 'sent_raw': 48213, 'sent_wire': 9120, 'recv_raw': 1836410, 'recv_wire': 201377}
+  >>> db.traffic.last
+  {'uri': '/api/query', 'sent_raw': 212, 'sent_wire': 212, 'recv_raw': 40211, 'recv_wire': 4417}
+  """
+  fields = ('sent_raw', 'sent_wire', 'recv_raw', 'recv_wire')
+
+  def __init__(self):
+    self.lock   = threading.Lock()
+    self.counts = dict.fromkeys(('requests',) + self.fields, 0)
+    self.last   = None
+
+  def __repr__(self):
+    return "<datomic traffic, %(requests)i requests, %(recv_wire)i bytes received>" % self.counts
+
+  def add(self, uri, sent_raw, sent_wire, recv_raw, recv_wire):
+    " count one call "
+    call = dict(uri=uri, sent_raw=sent_raw, sent_wire=sent_wire,
+                recv_raw=recv_raw, recv_wire=recv_wire)
+    with self.lock:
+      self.counts['requests'] += 1
+      for k in self.fields:
+        self.counts[k] += call[k]
+      self.last = call
+    logging.debug("%(uri)s sent %(sent_wire)i/%(sent_raw)i received "
+                  "%(recv_wire)i/%(recv_raw)i bytes (wire/raw)", call)
+
+  def stats(self):
+    with self.lock:
+      return dict(self.counts)
@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+""" Fetching graphs of entities a level at a time.
+"""
+from edn import key
+
+
+""" Every value comes with the type, cardinality and component flag of
+its attribute, so refs are known without a local schema
+"""
+Q_ALL   = u"""[ :find ?e ?ident ?v ?type ?card ?comp :in $ [?e ...] :where
+  [?e ?a ?v] [?a :db/ident ?ident]
+  [?a :db/valueType ?t] [?t :db/ident ?type]
+  [?a :db/cardinality ?c] [?c :db/ident ?card]
+  [(get-else $ ?a :db/isComponent false) ?comp] ]"""
+Q_ATTRS = u"""[ :find ?e ?ident ?v ?type ?card ?comp :in $ [?e ...] [?ident ...] :where
+  [?a :db/ident ?ident] [?e ?a ?v]
+  [?a :db/valueType ?t] [?t :db/ident ?type]
+  [?a :db/cardinality ?c] [?c :db/ident ?card]
+  [(get-else $ ?a :db/isComponent false) ?comp] ]"""
+
+
+class Pattern(object):
+  """ Which attributes of an entity to fetch, and which refs to follow.
+
+  `'*'` fetches every attribute and follows every ref. A list names
+  attributes; a `{ref: pattern}` item follows that ref with its own
+  pattern, a `'*'` item adds every attribute.
+  >>> Pattern(['person/name', {'person/likes': ['person/name']}])
+  """
+
+  def __init__(self, spec='*'):
+    self.star, self.attrs, self.refs = False, set(), {}
+    for item in ([spec] if isinstance(spec, basestring) else spec):
+      if isinstance(item, dict):
+        for a, sub in item.iteritems():
+          self.refs[key(a)] = sub if isinstance(sub, Pattern) else Pattern(sub)
+          self.attrs.add(key(a))
+      elif item == '*':
+        self.star = True
+      else:
+        self.attrs.add(key(item))
+
+  def __repr__(self):
+    return "<datomic pattern %s>" % ('*' if self.star else sorted(self.attrs))
+
+
+class Pull(object):
+  """ Fetches the attributes of every entity of a level with one query
+  per `batch` entities, run concurrently, then moves on to the
+  entities their refs point to.
+  """
+
+  def __init__(self, db, batch=1000):
+    self.db    = db
+    self.batch = batch
+    self.refs  = set()
+    self.many  = set()
+    self.comps = set()
+
+  def is_ref(self, a):
+    return a in self.refs
+
+  def is_many(self, a):
+    return a in self.many
+
+  def is_component(self, a):
+    return a in self.comps
+
+  def entity(self, eid, attrs):
+    " the attributes of one entity like `DB.e` has them, refs as {'db/id': id} "
+    d = {'db/id': eid}
+    for a, v in attrs.iteritems():
+      if self.is_ref(a):
+        v = [{'db/id': x} for x in v] if isinstance(v, list) else {'db/id': v}
+      d[a] = v
+    return d
+
+  def run(self, eids, spec='*', depth=1):
+    """ {eid: {attr: value or [values]}} of `eids` and of the entities
+    reachable from them within `depth` refs. Ref values are entity ids,
+    `is_ref` tells the attributes holding them.
+    """
+    pattern = spec if isinstance(spec, Pattern) else Pattern(spec)
+    data, level = {}, dict((int(e), pattern) for e in eids)
+    for d in xrange(depth + 1):
+      todo = dict((e, p) for e, p in level.iteritems() if e not in data)
+      if not todo: break
+      for e in todo:
+        data[e] = {}
+      self.fetch(data, todo)
+      if d == depth: break
+      level = {}
+      for e, p in todo.iteritems():
+        for a, sub in self.follow(data[e], p):
+          for child in data[e][a]:
+            level.setdefault(child, sub)
+    for attrs in data.itervalues():
+      for a, vs in attrs.items():
+        if len(vs) == 1 and not self.is_many(a): attrs[a] = vs[0]
+    return data
+
+  def follow(self, attrs, pattern):
+    " (attr, pattern) of the refs to walk from one entity "
+    for a in attrs:
+      if not self.is_ref(a): continue
+      if a in pattern.refs: yield a, pattern.refs[a]
+      elif pattern.star:    yield a, pattern
+
+  def fetch(self, data, todo):
+    " fill `data` for the entities of one level "
+    star  = [e for e, p in todo.iteritems() if p.star]
+    named = [e for e, p in todo.iteritems() if not p.star]
+    attrs = set(a for e in named for a in todo[e].attrs)
+    jobs  = [(star[i:i + self.batch], None) for i in xrange(0, len(star), self.batch)]
+    if attrs:
+      jobs += [(named[i:i + self.batch], attrs) for i in xrange(0, len(named), self.batch)]
+    if len(jobs) > 1:
+      results = [f.result() for f in
+                 self.db.executor.map(lambda job: self.query(*job), jobs)]
+    else:
+      results = [self.query(*job) for job in jobs]
+    for rows in results:
+      for e, ident, v, vtype, card, comp in rows:
+        a = key(ident)
+        if key(vtype) == 'db.type/ref':         self.refs.add(a)
+        if key(card)  == 'db.cardinality/many': self.many.add(a)
+        if comp:                                self.comps.add(a)
+        if not todo[e].star and a not in todo[e].attrs: continue
+        data[e].setdefault(a, []).append(v)
+
+  def query(self, eids, attrs=None):
+    inputs = [u'[%s]' % u' '.join(str(e) for e in eids)]
+    if attrs is None:
+      return self.db.q(Q_ALL, inputs=inputs)
+    inputs.append(u'[%s]' % u' '.join(u':' + a for a in sorted(attrs)))
+    return self.db.q(Q_ATTRS, inputs=inputs)
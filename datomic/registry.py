@@ -0,0 +1,194 @@
+# -*- coding: utf-8 -*-
+""" Attribute definitions as installed in the database.
+"""
+import json
+import os
+import threading
+import time
+from collections import namedtuple
+
+from edn import kw
+
+
+Attribute = namedtuple('Attribute', 'id ident valueType cardinality unique isComponent')
+
+Q_ATTRS = u"""[ :find ?a ?ident ?type ?card %(in)s :where
+  %(installed)s
+  [?a :db/ident ?ident]
+  [?a :db/valueType ?t] [?t :db/ident ?type]
+  [?a :db/cardinality ?c] [?c :db/ident ?card] ]"""
+Q_UNIQUE = u"""[ :find ?a ?u %(in)s :where
+  %(installed)s [?a :db/unique ?x] [?x :db/ident ?u] ]"""
+Q_COMPONENT = u"""[ :find ?a %(in)s :where
+  %(installed)s [?a :db/isComponent true] ]"""
+
+""" Datoms that install or alter an attribute, the attribute as :v
+"""
+INSTALLS    = ('db.install/attribute', 'db.alter/attribute')
+""" Datoms that define an attribute, the attribute as :e
+"""
+DEFINITIONS = ('db/ident', 'db/cardinality', 'db/unique', 'db/isComponent')
+""" Entity keys that are never attributes
+"""
+NOT_ATTRIBUTES = (u':db/id',)
+
+
+
+class AttributeRegistry(object):
+  """ Every attribute of the database, by id and by ident.
+
+  Loaded with three queries the first time it is used, then kept in
+  memory and, with `path`, in a json file tagged with the basis-t it
+  was read at. A later load, or a lookup of an unknown attribute, only
+  fetches the attributes installed or altered since that basis-t.
+  Unknown attributes are looked up again once basis-t moves, checked at
+  most every `poll_ms`.
+
+  >>> reg = db.attributes
+  >>> reg[62]
+  Attribute(id=62, ident=u':person/name', valueType=u':db.type/string', ...)
+  >>> reg.ident(62), reg.value_type('person/name')
+  (u':person/name', u':db.type/string')
+  """
+
+  def __init__(self, db, path=None, poll_ms=1000):
+    self.db       = db
+    self.path     = path
+    self.poll_ms  = poll_ms
+    self.by_id    = {}
+    self.by_ident = {}
+    self.basis_t  = None
+    self.polled   = 0
+    self.missing  = set()
+    self.lock     = threading.RLock()
+
+  def __repr__(self):
+    return "<datomic attributes, %i at basis-t %s>" % (len(self.by_id), self.basis_t)
+
+  def __len__(self):
+    self.load()
+    return len(self.by_id)
+
+  def __iter__(self):
+    self.load()
+    return iter(self.by_id.values())
+
+  def __contains__(self, key):
+    return self.get(key) is not None
+
+  def __getitem__(self, key):
+    attr = self.get(key)
+    if attr is None: raise KeyError(key)
+    return attr
+
+  def get(self, key, default=None):
+    """ Attribute by id or ident. An unknown key refreshes the registry
+    once, and is then remembered as missing until basis-t moves. Keys
+    that are never attributes, like db/id, are not looked up.
+    """
+    if not isinstance(key, (int, long)) and kw(key) in NOT_ATTRIBUTES: return default
+    self.load()
+    attr = self.find(key)
+    if attr is None and (key not in self.missing or
+                         (time.time() - self.polled) * 1000.0 >= self.poll_ms):
+      self.refresh()
+      attr = self.find(key)
+      if attr is None: self.missing.add(key)
+    return attr or default
+
+  def find(self, key):
+    if isinstance(key, (int, long)): return self.by_id.get(key)
+    return self.by_ident.get(kw(key))
+
+  def ident(self, a):
+    attr = self.get(a)
+    return attr.ident if attr else a
+
+  def value_type(self, a):
+    attr = self.get(a)
+    return attr.valueType if attr else None
+
+  def is_many(self, a):
+    attr = self.get(a)
+    return bool(attr) and attr.cardinality == u':db.cardinality/many'
+
+  def is_ref(self, a):
+    attr = self.get(a)
+    return bool(attr) and attr.valueType == u':db.type/ref'
+
+  def attr(self, a):
+    """ The attribute as a schema style dict, so the registry can stand
+    in for a `Schema`.
+    """
+    attr = self.get(a)
+    if attr is None: return None
+    d = {':db/ident': attr.ident, ':db/valueType': attr.valueType,
+         ':db/cardinality': attr.cardinality}
+    if attr.unique:      d[':db/unique'] = attr.unique
+    if attr.isComponent: d[':db/isComponent'] = 'true'
+    return d
+
+  def load(self):
+    " read the disk cache and catch up, or fetch everything "
+    if self.basis_t is not None: return
+    with self.lock:
+      if self.basis_t is not None: return
+      if self.path and os.path.exists(self.path):
+        with open(self.path) as f:
+          state = json.load(f)
+        for row in state['attributes']:
+          self.install(Attribute(*row))
+        self.basis_t = state['basis-t']
+      self.refresh()
+
+  def refresh(self):
+    " fetch attributes installed or altered since basis-t, or all of them "
+    with self.lock:
+      t = self.db.info()['basis-t']
+      self.polled = time.time()
+      if self.basis_t is not None and t == self.basis_t: return
+      ids = None
+      if self.basis_t is not None:
+        ids = set()
+        for a in INSTALLS + DEFINITIONS:
+          for d in self.db.datoms('aevt', a=a, since=self.basis_t, history=True,
+                                  chunk=1000):
+            ids.add(d['v'] if a in INSTALLS else d['e'])
+        ids = sorted(ids)
+      if ids is None or ids:
+        for attr in self.fetch(ids):
+          self.install(attr)
+        " serializers compiled from the old definitions "
+        self.db.encoder = None
+      self.basis_t = t
+      self.missing = set()
+      self.save()
+
+  def fetch(self, ids=None):
+    " Attributes for `ids`, or for every installed attribute "
+    if ids is None:
+      args = dict(installed='[:db.part/db :db.install/attribute ?a]', **{'in': ''})
+      inputs = []
+    else:
+      args = dict(installed='', **{'in': ':in $ [?a ...]'})
+      inputs = [u'[%s]' % u' '.join(str(int(i)) for i in ids)]
+    unique = dict((a, kw(u)) for a, u in self.db.q(Q_UNIQUE % args, inputs=inputs))
+    comp   = set(row[0] for row in self.db.q(Q_COMPONENT % args, inputs=inputs))
+    for a, ident, vtype, card in self.db.q(Q_ATTRS % args, inputs=inputs):
+      yield Attribute(a, kw(ident), kw(vtype), kw(card), unique.get(a), a in comp)
+
+  def install(self, attr):
+    old = self.by_id.get(attr.id)
+    if old is not None and old.ident != attr.ident:
+      " renamed "
+      self.by_ident.pop(old.ident, None)
+    self.by_id[attr.id] = attr
+    self.by_ident[attr.ident] = attr
+
+  def save(self):
+    if not self.path: return
+    tmp = self.path + '.tmp'
+    with open(tmp, 'w') as f:
+      json.dump({'basis-t': self.basis_t,
+                 'attributes': [list(a) for a in self.by_id.values()]}, f)
+    os.rename(tmp, self.path)
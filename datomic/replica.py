@@ -0,0 +1,415 @@
+# -*- coding: utf-8 -*-
+""" A local, memory mapped copy of a database's current datoms.
+"""
+import bisect
+import datetime
+import decimal
+import fcntl
+import heapq
+import itertools
+import json
+import mmap
+import os
+import shutil
+import struct
+import time
+import uuid
+
+from edn import kw, loads
+
+
+""" One datom: e, a, tx << 1 | added, and the offset of its value in
+the segment's value file.
+"""
+RECORD = struct.Struct('<qqqq')
+LENGTH = struct.Struct('<I')
+
+""" Sort order of each index, as positions in (e, a, v, tx)
+"""
+INDEXES = {
+  'eavt': (0, 1, 2, 3),
+  'aevt': (1, 0, 2, 3),
+  'avet': (1, 2, 0, 3),
+}
+
+""" :db/ident has this entity id in every datomic database
+"""
+DB_IDENT = 10
+
+
+def dump_value(v):
+  """ A datom value as json, instants, uuids and big decimals tagged.
+  Unlike a pickle, reading it back runs no code from the file.
+  """
+  if isinstance(v, datetime.datetime):
+    v = {'#inst': v.isoformat() + ('' if v.tzinfo else '+00:00')}
+  elif isinstance(v, uuid.UUID):
+    v = {'#uuid': str(v)}
+  elif isinstance(v, decimal.Decimal):
+    v = {'#decimal': str(v)}
+  return json.dumps(v, separators=(',', ':'))
+
+def load_value(blob):
+  " a value written by `dump_value` "
+  v = json.loads(blob)
+  if not isinstance(v, dict): return v
+  if '#inst' in v: return loads('#inst "%s"' % v['#inst'])
+  if '#uuid' in v: return uuid.UUID(v['#uuid'])
+  return decimal.Decimal(v['#decimal'])
+
+
+def mapfile(path):
+  " read-only mmap of a file, '' when it is empty "
+  with open(path, 'rb') as f:
+    if not os.fstat(f.fileno()).st_size: return ''
+    return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+def write_segment(path, datoms, run=100000):
+  """ Write (e, a, v, tx, added) tuples as a segment directory: one
+  value file and one sorted record file per index.
+
+  `datoms` may be any iterable and is consumed once. Values go straight
+  to disk, and each index is sorted in runs of `run` datoms which are
+  then merged, so memory stays bounded by `run`.
+  """
+  tmp = path + '.tmp'
+  if os.path.exists(tmp): shutil.rmtree(tmp)
+  os.makedirs(tmp)
+  runs, buf = [], []
+  with open(os.path.join(tmp, 'values'), 'wb') as f:
+    pos = 0
+    for d in datoms:
+      blob = dump_value(d[2])
+      f.write(LENGTH.pack(len(blob)))
+      f.write(blob)
+      buf.append(tuple(d[:5]) + (pos,))
+      pos += LENGTH.size + len(blob)
+      if len(buf) >= run:
+        runs.append(write_run(tmp, len(runs), buf))
+        buf = []
+  if buf or not runs:
+    runs.append(write_run(tmp, len(runs), buf))
+  for name in INDEXES:
+    if len(runs) == 1:
+      os.rename(runs[0][name], os.path.join(tmp, name))
+      continue
+    merge_runs(tmp, name, [r[name] for r in runs])
+  os.rename(tmp, path)
+
+def write_run(tmp, i, buf):
+  " sort one run of (e, a, v, tx, added, ref) by every index, returns the files "
+  files = {}
+  for name, order in INDEXES.iteritems():
+    files[name] = os.path.join(tmp, '%s.run-%i' % (name, i))
+    buf.sort(key=lambda d: tuple(d[c] for c in order))
+    with open(files[name], 'wb') as f:
+      for e, a, v, tx, added, ref in buf:
+        f.write(RECORD.pack(e, a, tx << 1 | bool(added), ref))
+  return files
+
+def merge_runs(tmp, name, files):
+  " merge sorted runs of records into the index file, values read back from disk "
+  values = mapfile(os.path.join(tmp, 'values'))
+  order  = INDEXES[name]
+  def records(path):
+    data = mapfile(path)
+    for i in xrange(len(data) // RECORD.size):
+      e, a, t, ref = RECORD.unpack_from(data, i * RECORD.size)
+      n, = LENGTH.unpack_from(values, ref)
+      row = (e, a, load_value(values[ref + LENGTH.size:ref + LENGTH.size + n]), t >> 1)
+      yield tuple(row[c] for c in order), (e, a, t, ref)
+  with open(os.path.join(tmp, name), 'wb') as f:
+    for _, rec in heapq.merge(*[records(p) for p in files]):
+      f.write(RECORD.pack(*rec))
+  for p in files:
+    os.remove(p)
+
+
+class Segment(object):
+  """ Sorted datoms on disk, read through mmap.
+  """
+
+  def __init__(self, path):
+    self.path   = path
+    self.values = mapfile(os.path.join(path, 'values'))
+    self.index  = dict((name, mapfile(os.path.join(path, name))) for name in INDEXES)
+
+  def __repr__(self):
+    return "<datomic segment %s, %i datoms>" % (os.path.basename(self.path), len(self))
+
+  def __len__(self):
+    return len(self.index['eavt']) // RECORD.size
+
+  def value(self, ref):
+    n, = LENGTH.unpack_from(self.values, ref)
+    return load_value(self.values[ref + LENGTH.size:ref + LENGTH.size + n])
+
+  def datom(self, name, i):
+    " (e, a, v, tx, added) of the i-th record of an index "
+    e, a, t, ref = RECORD.unpack_from(self.index[name], i * RECORD.size)
+    return e, a, self.value(ref), t >> 1, bool(t & 1)
+
+  def scan(self, name, prefix):
+    " datoms of an index whose leading components equal `prefix` "
+    keys = Keys(self, name, len(prefix))
+    lo = bisect.bisect_left(keys, prefix)
+    hi = bisect.bisect_right(keys, prefix, lo)
+    for i in xrange(lo, hi):
+      yield self.datom(name, i)
+
+
+class Keys(object):
+  """ The first `k` sort components of each record, for bisect.
+  Values are only decoded when they are part of the key.
+  """
+
+  def __init__(self, segment, name, k):
+    self.segment, self.name, self.k = segment, name, k
+    self.order = INDEXES[name][:k]
+    self.data  = segment.index[name]
+
+  def __len__(self):
+    return len(self.data) // RECORD.size
+
+  def __getitem__(self, i):
+    e, a, t, ref = RECORD.unpack_from(self.data, i * RECORD.size)
+    row = (e, a, None, t >> 1)
+    return tuple(self.segment.value(ref) if c == 2 else row[c] for c in self.order)
+
+
+class Replica(object):
+  """ A read replica of a database's current datoms in local files.
+
+  `pull` copies every datom once; `sync` then only fetches what was
+  asserted or retracted since the replica's basis-t and stores it as a
+  small delta segment, folded into a new base by `compact` once there
+  are `max_deltas` of them. Reads never touch the network.
+
+  >>> rep = Replica('/var/lib/app/replica', db)
+  >>> rep.sync()
+  >>> rep.datoms('aevt', a='person/name')
+  >>> rep.e(17592186045459)
+  {'db/id': 17592186045459, 'person/name': u'John Doe', 'person/likes': [{'db/id': ...}]}
+
+  The files are only replaced, never changed in place. Any number of
+  processes may open the same path without a `db` and read it through
+  the shared page cache; `refresh` picks up the latest sync.
+  """
+
+  def __init__(self, path, db=None, max_deltas=8, chunk=10000, run=100000):
+    self.path       = path
+    self.db         = db
+    self.max_deltas = max_deltas
+    self.chunk      = chunk
+    self.run        = run
+    self.manifest   = None
+    self.mtime      = None
+    self.segments   = {}
+    self.base       = None
+    self.deltas     = []
+    self._attrs     = None
+    self._idents    = None
+    if not os.path.isdir(path): os.makedirs(path)
+    self.refresh()
+
+  def __repr__(self):
+    return "<datomic replica %s at basis-t %s, %i deltas>" % (
+      self.path, self.basis_t, len(self.deltas))
+
+  @property
+  def basis_t(self):
+    return self.manifest['basis-t'] if self.manifest else None
+
+  """ writing
+  """
+  def pull(self):
+    """ copy every current datom, as of the db's basis-t
+
+    The peer only resumes avet scans by value, so eavt is paged by
+    offset: each chunk makes the peer walk past the ones before it.
+    Pinning the pages to one basis-t keeps them consistent.
+    """
+    t = self.db.basis_t()
+    rows = self.db.datoms('eavt', as_of=t, chunk=self.chunk, prefetch=2)
+    datoms = ((d['e'], d['a'], d['v'], d['tx'], True) for d in rows)
+    with self.locked():
+      name = self.segment_name('base')
+      write_segment(os.path.join(self.path, name), datoms, self.run)
+      self.commit(dict(base=name, deltas=[]), t)
+
+  def sync(self):
+    """ fetch what changed since the replica's basis-t, or pull. The
+    history since then is paged by offset like `pull`, but is small.
+    """
+    if self.basis_t is None: return self.pull()
+    t = self.db.basis_t()
+    if t == self.basis_t: return
+    rows = self.db.datoms('eavt', since=self.basis_t, as_of=t, history=True,
+                          chunk=self.chunk, prefetch=2)
+    datoms = [(d['e'], d['a'], d['v'], d['tx'], d['added']) for d in rows]
+    with self.locked():
+      self.refresh()
+      if self.basis_t >= t: return
+      name = self.segment_name('delta')
+      write_segment(os.path.join(self.path, name), datoms)
+      self.commit(dict(base=self.manifest['base'],
+                       deltas=self.manifest['deltas'] + [name]), t)
+    if len(self.deltas) >= self.max_deltas:
+      self.compact()
+
+  def compact(self):
+    " fold the deltas into a new base segment, streamed in runs "
+    with self.locked():
+      self.refresh()
+      if not self.deltas: return
+      datoms = (d[:4] + (True,) for d in self.current('eavt', ()))
+      name = self.segment_name('base')
+      write_segment(os.path.join(self.path, name), datoms, self.run)
+      self.commit(dict(base=name, deltas=[]), self.basis_t)
+
+  def segment_name(self, kind):
+    return '%s-%i-%i' % (kind, int(time.time() * 1000000), os.getpid())
+
+  def commit(self, manifest, t):
+    " point the manifest at new segments, drop the ones it no longer uses "
+    manifest['basis-t'] = t
+    path = os.path.join(self.path, 'manifest.json')
+    with open(path + '.tmp', 'w') as f:
+      json.dump(manifest, f)
+    os.rename(path + '.tmp', path)
+    self.refresh()
+    used = set([manifest['base']] + manifest['deltas'])
+    for name in os.listdir(self.path):
+      if name.startswith(('base-', 'delta-')) and name not in used:
+        " readers holding the old files keep their mappings "
+        shutil.rmtree(os.path.join(self.path, name), ignore_errors=True)
+
+  def locked(self):
+    return Lock(os.path.join(self.path, 'lock'))
+
+  """ reading
+  """
+  def refresh(self, attempts=10):
+    """ reopen the segments if another process synced. A sync may
+    replace them while we read the manifest, then we read it again, up
+    to `attempts` times.
+    """
+    path = os.path.join(self.path, 'manifest.json')
+    open_ = lambda name: self.segments.get(name) or Segment(os.path.join(self.path, name))
+    for attempt in range(attempts):
+      if not os.path.exists(path): return
+      st = os.stat(path)
+      mtime = (st.st_mtime, st.st_ino)
+      if mtime == self.mtime: return
+      with open(path) as f:
+        manifest = json.load(f)
+      try:
+        base, deltas = open_(manifest['base']), [open_(n) for n in manifest['deltas']]
+      except (IOError, OSError), e:
+        continue
+      self.base, self.deltas = base, deltas
+      self.segments = dict((os.path.basename(s.path), s) for s in [self.base] + self.deltas)
+      self.manifest, self.mtime = manifest, mtime
+      self._attrs = self._idents = None
+      return
+    raise IOError("replica %s: segments of the manifest missing after %i reads, %s" % (
+      self.path, attempts, e))
+
+  def current(self, name, prefix):
+    " (e, a, v, tx, added) in index order, with the deltas applied "
+    if self.base is None: return
+    if not self.deltas:
+      for d in self.base.scan(name, prefix): yield d
+      return
+    """ every segment's scan is in index order: merge them, and keep the
+    last of each datom's entries, from the newest segment and tx """
+    order = INDEXES[name][:3]
+    def keyed(rank, seg):
+      for d in seg.scan(name, prefix):
+        yield tuple(d[c] for c in order), rank, d[3], d[4], d
+    merged = heapq.merge(*[keyed(rank, seg) for rank, seg in
+                           enumerate([self.base] + self.deltas)])
+    for _, entries in itertools.groupby(merged, lambda x: x[0]):
+      for x in entries: pass
+      if x[-1][4]: yield x[-1]
+
+  def datoms(self, index='aevt', e=None, a=None, v=None):
+    """ Current datoms like `DB.datoms` yields them, from local files.
+    `a` is an attribute ident or id.
+    """
+    assert index in INDEXES, "index not replicated: %s" % index
+    self.refresh()
+    bound = {0: e, 1: self.attr_id(a) if a is not None else None, 2: v}
+    if a is not None and bound[1] is None: return
+    prefix = []
+    for c in INDEXES[index]:
+      if bound.get(c) is None: break
+      prefix.append(int(bound[c]) if c < 2 else bound[c])
+    rest = [(c, bound[c]) for c in (0, 1, 2) if bound[c] is not None and
+            c not in INDEXES[index][:len(prefix)]]
+    for d in self.current(index, tuple(prefix)):
+      if all(d[c] == x for c, x in rest):
+        yield dict(e=d[0], a=d[1], v=d[2], tx=d[3], added=d[4])
+
+  def e(self, eid):
+    """ An entity like `DB.e` returns it: attribute idents without the
+    colon, refs as {'db/id': id}, cardinality many values as lists.
+    """
+    rs = {'db/id': int(eid)}
+    attrs = self.attributes()
+    for d in self.datoms('eavt', e=int(eid)):
+      ident, ref, many = attrs.get(d['a'], (d['a'], False, False))
+      v = {'db/id': d['v']} if ref else d['v']
+      if many: rs.setdefault(ident, []).append(v)
+      else:    rs[ident] = v
+    return rs
+
+  def idents(self):
+    " entity id of every ident, per replica generation "
+    if self._idents is None:
+      self._idents = dict((kw(d[2]), d[0]) for d in self.current('aevt', (DB_IDENT,)))
+    return self._idents
+
+  def attr_id(self, a):
+    if isinstance(a, (int, long)): return a
+    return self.idents().get(kw(a))
+
+  def holds(self, a):
+    " whether attribute `a` is replicated, every known one once pulled "
+    self.refresh()
+    return self.base is not None and self.attr_id(a) is not None
+
+  def attributes(self):
+    " (ident, is ref, is many) by attribute id, per replica generation "
+    if self._attrs is not None: return self._attrs
+    idents = self.idents()
+    names  = dict((e, i) for i, e in idents.iteritems())
+    vtype, card = idents.get(u':db/valueType'), idents.get(u':db/cardinality')
+    install = idents.get(u':db.install/attribute')
+    attrs = {}
+    if install is None: return attrs
+    for a in set(d[2] for d in self.current('aevt', (install,))):
+      info = dict((d[1], d[2]) for d in self.current('eavt', (a,)))
+      attrs[a] = (names.get(a, unicode(a)).lstrip(':'),
+                  names.get(info.get(vtype)) == u':db.type/ref',
+                  names.get(info.get(card))  == u':db.cardinality/many')
+    self._attrs = attrs
+    return attrs
+
+
+class Lock(object):
+  """ Exclusive lock on a file, held by one syncing process at a time.
+  """
+
+  def __init__(self, path):
+    self.path = path
+
+  def __enter__(self):
+    self.f = open(self.path, 'a')
+    fcntl.flock(self.f, fcntl.LOCK_EX)
+    return self
+
+  def __exit__(self, exc_type, exc, tb):
+    fcntl.flock(self.f, fcntl.LOCK_UN)
+    self.f.close()
@@ -0,0 +1,147 @@
+# -*- coding: utf-8 -*-
+""" Helpers for paging through the datom indexes.
+"""
+import base64
+import json
+
+from executor import iter_ahead
+
+
+class ChunkSizer(object):
+  """ Picks the size of the next datoms chunk.
+
+  Without a `target_ms` the chunk size stays fixed. With one, each
+  measured request moves the chunk size toward the number of datoms
+  that would take `target_ms` to fetch, at most doubling or halving per
+  step, and never asking for more than `max_bytes` of edn.
+
+  >>> sizer = ChunkSizer(100, target_ms=250)
+  >>> sizer.update(100, 50.0, 8000)
+  >>> sizer.chunk
+  200
+  """
+
+  def __init__(self, chunk=100, target_ms=None, min_chunk=10,
+                     max_chunk=10000, max_bytes=None):
+    self.chunk     = int(chunk)
+    self.target_ms = target_ms
+    self.min_chunk = min_chunk
+    self.max_chunk = max_chunk
+    self.max_bytes = max_bytes
+
+  def __repr__(self):
+    return "<datomic chunk sizer, %i datoms>" % self.chunk
+
+  def update(self, count, ms, nbytes):
+    " feed back the datom count, latency and payload size of a request "
+    if not self.target_ms or count == 0: return
+    size = self.chunk * min(max(self.target_ms / max(ms, 1.0), 0.5), 2.0)
+    if self.max_bytes and nbytes:
+      size = min(size, self.max_bytes / (float(nbytes) / count))
+    self.chunk = int(min(max(size, self.min_chunk), self.max_chunk))
+
+
+def keyset_field(data):
+  """ The datom component `start` positions a scan at, None when the
+  scan pages by offset: the peer only honours `start` as a value bound
+  of the avet index of one attribute.
+  """
+  bound = [c for c in 'eav' if data.get(c) not in ('', None)]
+  return 'v' if data['index'] == 'avet' and bound == ['a'] else None
+
+
+class DatomCursor(object):
+  """ Keyset paging over a datom index.
+
+  Rather than growing `offset`, every chunk restarts the index walk at
+  the last datom seen: `start` is set to the value of that datom and
+  `offset` only skips the datoms sharing that value which were already
+  consumed. Deep scans therefore cost the same per chunk as shallow
+  ones. The peer only honours `start` on the avet index of one
+  attribute, other scans page by offset with the same resumable token.
+
+  >>> cur = db.datoms('avet', a='person/name', cursor=True)
+  >>> for d in cur: break
+  >>> token = cur.token
+
+  Later, or in another process, continue after the last consumed datom
+  >>> for d in db.datoms(cursor=token): print d
+  """
+
+  def __init__(self, db, data, sizer, limit=None, prefetch=0, encode=str):
+    self.db       = db
+    self.data     = dict(data)
+    self.sizer    = sizer
+    self.left     = limit
+    self.prefetch = prefetch
+    self.encode   = encode
+    self.field    = keyset_field(self.data)
+    self.key      = self.data.get('start') or ''
+    self.skip     = int(self.data.get('offset') or 0)
+
+  def __repr__(self):
+    return "<datomic cursor %s at %s+%i>" % (self.data['index'], self.key, self.skip)
+
+  @classmethod
+  def load(cls, db, token, sizer, prefetch=0, encode=str):
+    " rebuild a cursor from its `token` "
+    state = json.loads(base64.urlsafe_b64decode(str(token)))
+    cur = cls(db, state['data'], sizer, state['left'], prefetch, encode)
+    cur.key, cur.skip = state['key'], state['skip']
+    return cur
+
+  @property
+  def token(self):
+    " serializable position after the last consumed datom "
+    return base64.urlsafe_b64encode(json.dumps(dict(
+      data = self.data,
+      key  = self.key,
+      skip = self.skip,
+      left = self.left,
+    )))
+
+  def __iter__(self):
+    pages = self.pages()
+    if self.prefetch:
+      pages = iter_ahead(self.db.executor, pages, self.prefetch)
+    for rs in pages:
+      for r in rs:
+        self.advance(r)
+        yield r
+
+  def advance(self, datom):
+    " move the consumed position past datom "
+    if self.left is not None: self.left -= 1
+    if self.field is None:
+      self.skip += 1
+      return
+    key = self.encode(datom[self.field])
+    if key == self.key:
+      self.skip += 1
+    else:
+      self.key, self.skip = key, 1
+
+  def pages(self):
+    " fetch chunks, each resuming after the previous one "
+    data, key, skip, left = dict(self.data), self.key, self.skip, self.left
+    last = None
+    while left is None or left > 0:
+      data['start'], data['offset'] = key, skip
+      data['limit'] = self.sizer.chunk if left is None else min(self.sizer.chunk, left)
+      rs, ms, nbytes = self.db.datom_chunk(data)
+      if not len(rs): return
+      if last is not None and (rs[0] == last or
+          (self.field is not None and rs[0][self.field] < last[self.field])):
+        raise Exception, "datoms page did not move past %s+%i of %s, start ignored?" % (
+          key, skip, data['index'])
+      last = rs[-1]
+      yield rs
+      if left is not None: left -= len(rs)
+      for r in rs:
+        if self.field is None:
+          skip += 1
+          continue
+        k = self.encode(r[self.field])
+        if k == key: skip += 1
+        else:        key, skip = k, 1
+      self.sizer.update(len(rs), ms, nbytes)
@@ -79,12 +79,14 @@ class Schema(object):
   part   = 'db'
   schema = []
   cache  = None
+  attrs  = None
 
   def __init__(self, struct, part=None):
     """
     Pythonic schemas for Datomic
     """
     self.cache  = {}
+    self.attrs  = {}
     if part: self.part = part
     self.build_attributes(struct)
 
@@ -122,12 +124,18 @@ class Schema(object):
     if ':db/cardinality' in missing: attrs.append(ONE)
 
     attrs.append((':db.install/_attribute',':db.part/db'))
+    self.attrs[attrs[1][1]] = dict(attrs[1:])
     self.schema.append("{%s}" % "\n ".join(("%s %s" % (k,v)) for k,v in attrs))
 
     if enums: 
       for option in enums:
         self.build_enum(ns, struct[0], option)
 
+  def attr(self, ident):
+    " the definition of an attribute as a dict, or None "
+    if not ident.startswith(':'): ident = ':' + ident
+    return self.attrs.get(ident)
+
   def build_enum(self, ns, ident, option):
     if ns:
       st = " [:db/add #db/id[:db.part/user] :db/ident :%s.%s/%s] " % \
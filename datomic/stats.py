@@ -0,0 +1,129 @@
+# -*- coding: utf-8 -*-
+""" Latency, error and pool metrics of a `DB`.
+"""
+import bisect
+import logging
+import threading
+
+
+""" Histogram bucket upper bounds in ms, powers of two from 1/8ms to ~65s
+"""
+BUCKETS = [2.0 ** i for i in range(-3, 17)]
+
+
+class Histogram(object):
+  """ Latencies in log scale buckets, percentiles are bucket bounds.
+
+  >>> h = Histogram()
+  >>> for ms in (1.2, 3.5, 40.0): h.add(ms)
+  >>> h.summary()
+  {'count': 3, 'mean': 14.9, 'min': 1.2, 'max': 40.0, 'p50': 4.0, 'p90': 64.0, 'p99': 64.0}
+  """
+
+  def __init__(self):
+    self.counts = [0] * (len(BUCKETS) + 1)
+    self.n      = 0
+    self.total  = 0.0
+    self.min    = None
+    self.max    = None
+
+  def __repr__(self):
+    return "<datomic histogram, %i samples>" % self.n
+
+  def add(self, ms):
+    self.counts[bisect.bisect_left(BUCKETS, ms)] += 1
+    self.n     += 1
+    self.total += ms
+    self.min    = ms if self.min is None else min(self.min, ms)
+    self.max    = ms if self.max is None else max(self.max, ms)
+
+  def percentile(self, p):
+    " upper bound of the bucket holding the p-th percentile "
+    if not self.n: return None
+    rank, seen = p / 100.0 * self.n, 0
+    for i, c in enumerate(self.counts):
+      seen += c
+      if seen >= rank and c:
+        return BUCKETS[i] if i < len(BUCKETS) else self.max
+    return self.max
+
+  def summary(self):
+    return dict(count=self.n, mean=self.total / self.n if self.n else None,
+                min=self.min, max=self.max, p50=self.percentile(50),
+                p90=self.percentile(90), p99=self.percentile(99))
+
+
+class Stats(object):
+  """ Per operation latency histograms, split by phase, error counts
+  and gauges read when a snapshot is taken.
+
+  Phases of a request are `encode` (building the request body), `http`
+  (sending it and reading the response, or its headers when streamed)
+  and `decode` (parsing edn, and reading the rest of a streamed body).
+  `TX` times building its tx-data as the `build` phase of `tx`.
+
+  Disabled unless a `DB` is created with `stats=True` or a `Stats`;
+  without one nothing is timed.
+
+  >>> db = DB(HOST, PORT, STORE, DBN, S, stats=True)
+  >>> db.stats.hook(lambda ev: statsd.timing('datomic.%(op)s.%(phase)s' % ev, ev['ms']))
+  >>> db.stats.snapshot()
+  {'latency': {'q': {'encode': {...}, 'http': {...}, 'decode': {...}}},
+   'errors': {'q': 1}, 'bytes': {...}, 'pool': [...]}
+  """
+
+  def __init__(self):
+    self.lock    = threading.Lock()
+    self.latency = {}
+    self.errors  = {}
+    self.hooks   = []
+    self.gauges  = {}
+
+  def __repr__(self):
+    return "<datomic stats, %i ops>" % len(self.latency)
+
+  def hook(self, fn):
+    """ call `fn(event)` for every measurement and error, the event is
+    a dict with `op`, `phase` and `ms`, or `op`, `phase='error'` and
+    `error`.
+    """
+    self.hooks.append(fn)
+    return fn
+
+  def gauge(self, name, fn):
+    " report `fn()` as `name` in snapshots "
+    self.gauges[name] = fn
+
+  def record(self, op, phase, ms):
+    with self.lock:
+      phases = self.latency.setdefault(op, {})
+      if phase not in phases: phases[phase] = Histogram()
+      phases[phase].add(ms)
+    if self.hooks: self.emit(dict(op=op, phase=phase, ms=ms))
+
+  def error(self, op, exc):
+    with self.lock:
+      self.errors[op] = self.errors.get(op, 0) + 1
+    if self.hooks: self.emit(dict(op=op, phase='error', error=exc))
+
+  def emit(self, event):
+    for fn in self.hooks:
+      try:
+        fn(event)
+      except Exception:
+        logging.exception("datomic stats hook failed")
+
+  def snapshot(self):
+    " everything measured so far, plus the current gauges "
+    with self.lock:
+      rs = dict(
+        latency = dict((op, dict((ph, h.summary()) for ph, h in phases.iteritems()))
+                       for op, phases in self.latency.iteritems()),
+        errors  = dict(self.errors))
+    for name, fn in self.gauges.iteritems():
+      rs[name] = fn()
+    return rs
+
+  def reset(self):
+    with self.lock:
+      self.latency, self.errors = {}, {}
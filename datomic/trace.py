@@ -0,0 +1,123 @@
+# -*- coding: utf-8 -*-
+""" Nested timing spans, exported as Chrome trace events.
+"""
+import itertools
+import json
+import os
+import threading
+import time
+
+
+class Span(object):
+  """ An open span; `args` may be filled in until it is closed.
+  """
+  __slots__ = ('tracer', 'name', 'args', 'id', 'parent', 'start')
+
+  def __init__(self, tracer, name, args, parent):
+    self.tracer, self.name, self.args = tracer, name, args
+    self.id     = next(tracer.ids)
+    self.parent = parent
+
+  def __repr__(self):
+    return "<datomic span %s>" % self.name
+
+  def __enter__(self):
+    self.tracer.stack.append(self)
+    self.start = time.time()
+    return self
+
+  def __exit__(self, exc_type, exc, tb):
+    end = time.time()
+    self.tracer.stack.pop()
+    if exc_type is not None: self.args['error'] = repr(exc)
+    if self.parent is not None: self.args['parent'] = self.parent
+    self.args['span'] = self.id
+    self.tracer.complete(self.name, self.start, end, **self.args)
+
+
+class Tracer(object):
+  """ Records spans per thread and exports them in the Chrome trace
+  event format, to be opened in chrome://tracing or Perfetto.
+
+  Spans nest on the thread that opens them. Work handed to another
+  thread through `wrap` keeps the span that was open when it was
+  handed over as its parent.
+
+  >>> db = DB(HOST, PORT, STORE, DBN, S, tracer=True)
+  >>> with db.tracer.span('dashboard', user=42):
+  ...   qa.all()
+  >>> db.tracer.export('trace.json')
+  """
+
+  def __init__(self, max_events=1000000):
+    self.max_events = max_events
+    self.events     = []
+    self.dropped    = 0
+    self.lock       = threading.Lock()
+    self.local      = threading.local()
+    self.ids        = itertools.count(1)
+    self.names      = {}
+    self.pid        = os.getpid()
+
+  def __repr__(self):
+    return "<datomic tracer, %i events>" % len(self.events)
+
+  @property
+  def stack(self):
+    stack = getattr(self.local, 'stack', None)
+    if stack is None:
+      stack = self.local.stack = []
+    return stack
+
+  def current(self):
+    " id of the innermost open span of this thread, or of the submitter "
+    stack = self.stack
+    if stack: return stack[-1].id
+    return getattr(self.local, 'parent', None)
+
+  def span(self, name, **args):
+    " a span around a with block "
+    return Span(self, name, args, self.current())
+
+  def complete(self, name, start, end, **args):
+    " record a span that already ended under the open one, times from time.time() "
+    t = threading.current_thread()
+    parent = self.current()
+    if parent is not None: args.setdefault('parent', parent)
+    event = dict(name=name, ph='X', pid=self.pid, tid=t.ident,
+                 ts=start * 1e6, dur=(end - start) * 1e6, args=args)
+    with self.lock:
+      if len(self.events) >= self.max_events:
+        self.dropped += 1
+        return
+      self.events.append(event)
+      self.names[t.ident] = t.name
+
+  def wrap(self, defn):
+    " `defn` run on another thread, under the span open here "
+    parent = self.current()
+    def traced(*args, **kwargs):
+      outer, self.local.parent = getattr(self.local, 'parent', None), parent
+      try:
+        return defn(*args, **kwargs)
+      finally:
+        self.local.parent = outer
+    return traced
+
+  def to_chrome(self):
+    " the trace event json object "
+    with self.lock:
+      events = list(self.events)
+      names  = dict(self.names)
+    meta = [dict(name='thread_name', ph='M', pid=self.pid, tid=tid, args=dict(name=name))
+            for tid, name in names.iteritems()]
+    return dict(traceEvents=meta + events, displayTimeUnit='ms',
+                otherData=dict(dropped=self.dropped))
+
+  def export(self, path):
+    with open(path, 'w') as f:
+      json.dump(self.to_chrome(), f)
+
+  def clear(self):
+    with self.lock:
+      self.events, self.dropped = [], 0
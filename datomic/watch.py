@@ -0,0 +1,161 @@
+# -*- coding: utf-8 -*-
+""" Following a database's transactions as they commit.
+"""
+import logging
+import re
+import time
+from collections import namedtuple
+
+from urllib3.exceptions import HTTPError, ReadTimeoutError
+from peers import StatusError
+
+
+""" The datoms of one or more transactions, those after basis-t `since`
+up to and including basis-t `t`
+"""
+Delta = namedtuple('Delta', 'since t datoms')
+
+_basis = re.compile(r':basis-t\s+(\d+)')
+
+
+def tx_t(tx):
+  " basis-t of a transaction entity id "
+  return tx & (2 ** 42 - 1)
+
+
+class Unavailable(Exception):
+  " the peer has no event stream for this database "
+
+
+class Watch(object):
+  """ Iterates over the changes of a database as `Delta`s, starting
+  after basis-t `since_t` (the current basis-t by default).
+
+  Wakes up on the REST event stream of the database when the peer
+  serves one, or by polling basis-t every `poll_ms` otherwise. Every
+  wake up fetches the datoms since the last delivered basis-t, asserted
+  and retracted, with one cursor scan pinned to the newest basis-t.
+  Transactions that committed while the consumer was busy are thereby
+  fetched together; they are delivered one `Delta` per transaction, or
+  as a single one with `batch`.
+
+  A dropped event stream is reconnected with backoff, and nothing is
+  missed: `t` is the basis-t delivered so far, a later
+  `db.watch(since_t=w.t)` resumes where this one stopped.
+
+  >>> w = db.watch()
+  >>> for delta in w:
+  ...   cache.invalidate(d['e'] for d in delta.datoms)
+  """
+
+  def __init__(self, db, since_t=None, poll_ms=1000, batch=False, events=True,
+                     chunk=1000, backoff=0.5, max_backoff=30.0):
+    self.db          = db
+    self.t           = since_t
+    self.poll_ms     = poll_ms
+    self.batch       = batch
+    self.events      = events
+    self.chunk       = chunk
+    self.backoff     = backoff
+    self.max_backoff = max_backoff
+    self.closed      = False
+    self.uri_events  = "/events/%s/%s" % (db.store, db.db)
+
+  def __repr__(self):
+    return "<datomic watch %s/%s after basis-t %s>" % (self.db.store, self.db.db, self.t)
+
+  def __iter__(self):
+    if self.t is None: self.t = self.db.basis_t()
+    for t in self.ticks():
+      if self.closed: return
+      if t is not None and t <= self.t: continue
+      t, txs = self.fetch()
+      for delta in self.deliver(t, txs):
+        yield delta
+        if self.closed: return
+
+  def close(self):
+    self.closed = True
+
+  def ticks(self):
+    " basis-t values as they are announced, None when unknown "
+    delay = self.backoff
+    while self.events and not self.closed:
+      try:
+        " catch up on what committed while disconnected "
+        yield None
+        for t in self.stream():
+          delay = self.backoff
+          yield t
+        time.sleep(self.poll_ms / 1000.0)
+      except ReadTimeoutError:
+        " idle longer than the read timeout, reconnect "
+        pass
+      except Unavailable:
+        logging.info("no event stream for %s, polling" % self.uri_events)
+        self.events = False
+      except (HTTPError, IOError), e:
+        logging.warning("event stream %s dropped: %s" % (self.uri_events, e))
+        time.sleep(delay)
+        delay = min(delay * 2, self.max_backoff)
+    while not self.closed:
+      yield None
+      time.sleep(self.poll_ms / 1000.0)
+
+  def stream(self):
+    " basis-t of each server sent event "
+    r = self.db.pool.urlopen('GET', self.uri_events, preload_content=False,
+                             headers={'Accept': 'text/event-stream'})
+    if r.status != 200:
+      " read the error body so the connection can be reused "
+      r.drain_conn()
+      r.release_conn()
+      raise Unavailable(r.status)
+    buf = ''
+    try:
+      for chunk in r.stream(4096):
+        buf += chunk
+        while '\n\n' in buf:
+          event, buf = buf.split('\n\n', 1)
+          data = ''.join(l[5:].strip() for l in event.splitlines() if l.startswith('data:'))
+          if not data: continue
+          m = _basis.search(data)
+          yield int(m.group(1)) if m else None
+    finally:
+      r.close()
+
+  def fetch(self):
+    """ The newest basis-t and the datoms of every transaction since the
+    last delivered one, by tx. Requests failing with a connection error
+    or a 5xx status are retried.
+    """
+    delay = self.backoff
+    while True:
+      try:
+        t, txs = self.db.basis_t(), {}
+        if t > self.t:
+          for d in self.db.datoms('eavt', since=self.t, as_of=t, history=True,
+                                  cursor=True, chunk=self.chunk):
+            txs.setdefault(d['tx'], []).append(d)
+        return t, txs
+      except (HTTPError, IOError, StatusError), e:
+        " a peer error is passing, a bad request is not "
+        if isinstance(e, StatusError) and e.status < 500: raise
+        logging.warning("fetching changes since %s failed: %s" % (self.t, e))
+        time.sleep(delay)
+        delay = min(delay * 2, self.max_backoff)
+
+  def deliver(self, t, txs):
+    " the fetched transactions as deltas, advancing `self.t` "
+    if not txs:
+      self.t = max(self.t, t)
+      return
+    order = sorted(txs)
+    if self.batch:
+      since, self.t = self.t, t
+      yield Delta(since, t, [d for tx in order for d in txs[tx]])
+      return
+    for tx in order:
+      since  = self.t
+      self.t = t if tx == order[-1] else tx_t(tx)
+      yield Delta(since, self.t, txs[tx])
@@ -11,7 +11,7 @@ setup(
   url='https://github.com/tony-landis/datomic-py',
   install_requires=[
     'edn_format',
-    'urllib3',
+    'urllib3>=1.26',
     'termcolor',
   ],
   packages = ['datomic', ],